@@ -0,0 +1,307 @@
+#
+# LSST
+# Clock rules checker over rendered timelines
+#
+# A rule is a condition on the states of the sequencer outputs, written with channel
+# names and 'and', 'or', 'not' (for instance "not P2 and not P3"), with a constraint
+# on the duration of the intervals during which it holds: never, at least or at most
+# a given time. Rules are evaluated run by run on the run-length encoded timelines
+# (see timeline.py), for each function alone and for whole mains.
+#
+# Rules file format, one rule per line:
+# <name>: <condition>: never | >= <duration> | <= <duration>
+# where the duration is a number of clock cycles, a time with unit (ns, us, ms, s),
+# or the name of a time constant of the sequencer file.
+#
+# Syntax in a script:
+# import rebtxt, clockrules
+# seq = rebtxt.Sequencer.fromtxtfile("FP_ITL_2s_ir2_v26.seq", verbose=False)
+# rules = clockrules.read_rules("clockrules.txt", seq.parameters)
+# print(clockrules.violations_report(clockrules.check_main(seq, "Read", rules), seq.parameters))
+#
+# Syntax as main:
+# python clockrules.py clockrules.txt FP_ITL_2s_ir2_v26.seq [Read Clear ...]
+from __future__ import print_function
+import sys
+import ast
+from functools import reduce
+import numpy as np
+
+import rebtxt
+import timeline
+
+time_units = rebtxt.TxtParser.time_units
+
+
+class Rule(object):
+    """
+    Constraint on the duration of the intervals during which a condition on the outputs holds.
+    """
+
+    def __init__(self, name, condition, min_cycles=None, max_cycles=None):
+        """
+        :param name:
+        :param condition: boolean expression of channel names, with 'and', 'or', 'not', '==', '!=', 0 and 1
+        :param min_cycles: minimum duration of the intervals (clock cycles)
+        :param max_cycles: maximum duration of the intervals (clock cycles), 0 if the condition must never hold
+        """
+        self.name = name
+        self.condition = condition
+        self.min_cycles = min_cycles
+        self.max_cycles = max_cycles
+        self.tree = ast.parse(condition, mode='eval').body
+        self.channel_names = sorted(set(node.id for node in ast.walk(self.tree) if isinstance(node, ast.Name)))
+
+    def __repr__(self):
+        if self.max_cycles == 0:
+            constraint = 'never'
+        else:
+            constraint = []
+            if self.min_cycles is not None:
+                constraint.append('>= %d' % self.min_cycles)
+            if self.max_cycles is not None:
+                constraint.append('<= %d' % self.max_cycles)
+            constraint = ', '.join(constraint)
+        return "%s: %s: %s" % (self.name, self.condition, constraint)
+
+    @classmethod
+    def fromstring(cls, s, parameters=None):
+        """
+        Rule from a line of a rules file (see read_rules()).
+        :param s:
+        :param parameters: sequencer parameters (Sequencer.parameters), for the clock period and
+        durations given by constant names
+        :return: Rule
+        """
+        try:
+            name, condition, constraint = [elem.strip() for elem in s.split(':')]
+        except ValueError:
+            raise ValueError('Badly formatted rule: %s' % s)
+
+        if constraint == 'never':
+            return cls(name, condition, max_cycles=0)
+        if constraint[:2] == '>=':
+            return cls(name, condition, min_cycles=duration_cycles(constraint[2:], parameters))
+        if constraint[:2] == '<=':
+            return cls(name, condition, max_cycles=duration_cycles(constraint[2:], parameters))
+
+        raise ValueError('Unknown constraint in rule %s: %s' % (name, constraint))
+
+    def evaluate(self, tl, channels):
+        """
+        Value of the condition on each run of the timeline.
+        :param tl: timeline.Timeline
+        :param channels: channel map
+        :return: np.array of bool
+        """
+        states = {}
+        for cname in self.channel_names:
+            if not channels.has_key(cname):
+                raise ValueError('Unknown channel %s in rule %s' % (cname, self.name))
+            states[cname] = ((tl.words >> channels[cname]) & 1).astype(bool)
+
+        return np.broadcast_to(evaluate_node(self.tree, states), tl.words.shape)
+
+    def intervals(self, tl, channels):
+        """
+        Intervals during which the condition holds.
+        :param tl: timeline.Timeline
+        :param channels: channel map
+        :return: start times, durations (np.arrays), and whether each one is cut by the
+        beginning or end of the timeline
+        """
+        holds = self.evaluate(tl, channels).astype(np.int8)
+        changes = np.diff(np.concatenate(([0], holds, [0])))
+        first = np.nonzero(changes == 1)[0]
+        last = np.nonzero(changes == -1)[0]
+
+        ends = tl.starts + tl.durations
+        starts = tl.starts[first]
+        durations = ends[last - 1] - starts
+        cut = (first == 0) | (last == len(tl))
+
+        return starts, durations, cut
+
+    def violations(self, tl, channels):
+        """
+        Intervals that violate the rule. An interval cut by the beginning or end of the timeline
+        may go on in the preceding or following part of the sequence, so it is only reported if
+        already too long.
+        :param tl: timeline.Timeline
+        :param channels: channel map
+        :return: start times, durations (np.arrays)
+        """
+        starts, durations, cut = self.intervals(tl, channels)
+
+        bad = np.zeros(len(starts), dtype=bool)
+        if self.min_cycles is not None:
+            bad |= (durations < self.min_cycles) & ~cut
+        if self.max_cycles == 0:
+            bad[:] = True
+        elif self.max_cycles is not None:
+            bad |= durations > self.max_cycles
+
+        return starts[bad], durations[bad]
+
+
+def evaluate_node(node, states):
+    """
+    Vectorized evaluation of a condition.
+    :param node: ast node of the condition
+    :param states: dict channel name: states (np.array of bool)
+    :return: np.array of bool, or bool for constants
+    """
+    if isinstance(node, ast.Name):
+        return states[node.id]
+    if isinstance(node, ast.Num) and node.n in [0, 1]:
+        return bool(node.n)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        return np.logical_not(evaluate_node(node.operand, states))
+    if isinstance(node, ast.BoolOp):
+        values = [evaluate_node(operand, states) for operand in node.values]
+        if isinstance(node.op, ast.And):
+            return reduce(np.logical_and, values)
+        return reduce(np.logical_or, values)
+    if isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in [ast.Eq, ast.NotEq]:
+        left = evaluate_node(node.left, states)
+        right = evaluate_node(node.comparators[0], states)
+        if isinstance(node.ops[0], ast.Eq):
+            return np.equal(left, right)
+        return np.not_equal(left, right)
+
+    raise ValueError('Unsupported expression in rule condition: %s' % ast.dump(node))
+
+
+def duration_cycles(s, parameters=None):
+    """
+    Converts a duration to clock cycles.
+    :param s: number of cycles, time with unit ('50 ns'), or name of a time constant
+    :param parameters: sequencer parameters, with the clock period
+    :return: int
+    """
+    if parameters is None:
+        parameters = {}
+    clockperiod = parameters.get('clockperiod', 10e-9)
+
+    elems = s.split()
+    if len(elems) == 1:
+        if elems[0] in parameters:
+            if isinstance(parameters[elems[0]], float):
+                # time constants are stored in seconds
+                return int(round(parameters[elems[0]] / clockperiod))
+            return int(parameters[elems[0]])
+        return int(elems[0])
+    if len(elems) == 2 and elems[1] in time_units:
+        return int(round(float(elems[0]) * time_units[elems[1]] / clockperiod))
+
+    raise ValueError('Unable to parse duration: %s' % s)
+
+
+def read_rules(rulefile, parameters=None):
+    """
+    Reads a rules file: one rule per line, '#' for comments.
+    :param rulefile:
+    :param parameters: sequencer parameters (Sequencer.parameters)
+    :return: list of Rule
+    """
+    rules = []
+    rulef = open(rulefile, 'r')
+    for line in rulef:
+        line = line.split('#')[0].strip()
+        if line:
+            rules.append(Rule.fromstring(line, parameters))
+    rulef.close()
+
+    return rules
+
+
+def check_timeline(tl, rules, channels):
+    """
+    Checks the rules on a timeline.
+    :param tl: timeline.Timeline
+    :param rules: list of Rule
+    :param channels: channel map
+    :return: dict rule name: (start times, durations) of the violations, for violated rules only
+    """
+    violations = {}
+    for rule in rules:
+        starts, durations = rule.violations(tl, channels)
+        if len(starts):
+            violations[rule.name] = (starts, durations)
+
+    return violations
+
+
+def check_functions(seq, rules):
+    """
+    Checks the rules on each function alone. Rules whose channels are not all defined
+    in the sequencer are skipped.
+    :param seq: Sequencer
+    :param rules: list of Rule
+    :return: dict function name: violations (see check_timeline()), for functions with violations only
+    """
+    rules = [rule for rule in rules if all(seq.channels.has_key(cname) for cname in rule.channel_names)]
+
+    results = {}
+    for func_id in sorted(seq.functions):
+        func = seq.functions[func_id]
+        violations = check_timeline(timeline.Timeline.fromfunction(func), rules, seq.channels)
+        if violations:
+            results[func.name] = violations
+
+    return results
+
+
+def check_main(seq, subr, rules, infinite=1):
+    """
+    Checks the rules on the whole timeline of a main or subroutine.
+    :param seq: Sequencer
+    :param subr: name of the main or subroutine
+    :param rules: list of Rule
+    :param infinite: number of repetitions for functions called with repeat(infinity)
+    :return: violations (see check_timeline())
+    """
+    return check_timeline(timeline.render(seq, subr, infinite), rules, seq.channels)
+
+
+def violations_report(violations, parameters=None, maxlines=3):
+    """
+    Text report of the violations found by check_timeline().
+    :param violations:
+    :param parameters: sequencer parameters, to print times with the clock period
+    :param maxlines: number of violations printed for each rule
+    :return: string
+    """
+    if not violations:
+        return "No rule violated"
+    if parameters is None:
+        parameters = {}
+    clockperiod = parameters.get('clockperiod', 10e-9)
+
+    lines = []
+    for name in sorted(violations):
+        starts, durations = violations[name]
+        lines.append("%s: %d violations" % (name, len(starts)))
+        for start, duration in zip(starts[:maxlines], durations[:maxlines]):
+            lines.append("    at %d (%.3f us) for %d cycles" % (start, start * clockperiod * 1e6, duration))
+        if len(starts) > maxlines:
+            lines.append("    ...")
+
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Syntax: python clockrules.py <rules-file> <sequencer-file> [<main> ...]")
+        sys.exit(1)
+
+    seq = rebtxt.Sequencer.fromtxtfile(sys.argv[2], verbose=False, cache=True)
+    rules = read_rules(sys.argv[1], seq.parameters)
+
+    for funcname, violations in sorted(check_functions(seq, rules).iteritems()):
+        print("Function %s:" % funcname)
+        print(violations_report(violations, seq.parameters))
+
+    for subr in sys.argv[3:]:
+        print("Main %s:" % subr)
+        print(violations_report(check_main(seq, subr, rules), seq.parameters))
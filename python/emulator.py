@@ -0,0 +1,355 @@
+#
+# LSST
+# Software emulator of the REB sequencer
+#
+# Executes the FPGA memory image (functions outputs and slices, program, pointers,
+# as written by seqcompiler.write_compfile) with an explicit call stack, and produces
+# the run-length encoded timeline of the outputs, from which the Start Of Image,
+# End Of Image and ADC trigger times are extracted.
+# Each subroutine is stepped through once: later calls re-use the timeline of its
+# first iteration (run-length stepping), so a full frame readout takes seconds.
+#
+# Syntax in a script:
+# import emulator
+# emu = emulator.Emulator.fromcompfile("FP_ITL_2s_ir2_v26.compiled")
+# run = emu.run('Read')
+# print(run.trigger_times()[:10])
+from __future__ import print_function
+import numpy as np
+
+import timeline
+import seqcompiler
+from sequencer import Instruction, Function, Sequencer, SequencerPointer
+
+# base addresses of the pointers, by type
+pointer_base_addr = SequencerPointer.Base_Ptr
+
+
+def read_compfile(compfile):
+    """
+    Reads a text compiled file (see seqcompiler.write_compfile).
+    :param compfile:
+    :return: image (dict address: value), number of slices by function id, subroutine addresses by name
+    """
+    image = {}
+    nslices = {}
+    exectimes = {}
+    subroutines = {}
+
+    func_id = None
+    section = None
+    compf = open(compfile, 'r')
+    for line in compf:
+        line = line.strip()
+        if line.startswith('0x'):
+            addr, value = line.split('#')[0].split(':')
+            image[int(addr, 16)] = int(value, 16)
+        elif line.startswith('# ['):
+            section = line[2:]
+        elif line.startswith('## function: #'):
+            func_id = int(line[len('## function: #'):])
+        elif line.startswith('##   execution time:'):
+            exectimes[func_id] = int(line.split(':')[1])
+        elif section == '[subroutines/mains]' and line.startswith('# '):
+            name, addr = line[2:].split(':')
+            subroutines[name.strip()] = int(addr, 16)
+    compf.close()
+
+    # number of slices: the one giving the recorded execution time
+    for func_id in exectimes:
+        durations = [image.get(seqcompiler.slices_base_addr | (func_id << 4) | sl, 0) for sl in range(16)]
+        words = [image.get(seqcompiler.outputs_base_addr | (func_id << 4) | sl, 0) for sl in range(16)]
+        used = [sl + 1 for sl in range(16) if durations[sl] or words[sl]]
+        n = max(used + [1])
+        while n < 16 and sum(durations[:n]) + 3 != exectimes[func_id]:
+            n += 1
+        nslices[func_id] = n
+
+    return image, nslices, subroutines
+
+
+class Execution(object):
+    """
+    Result of an emulator run.
+    """
+
+    def __init__(self, tl, start_address, stop_address, stop_reason, channels):
+        """
+        :param tl: timeline.Timeline of the outputs
+        :param start_address:
+        :param stop_address: address of the last instruction executed
+        :param stop_reason: 'END', 'RTS' (return from the starting subroutine),
+        'budget' (cycle budget exhausted) or 'infinite loop' (reached without cycle budget)
+        :param channels: channel map
+        """
+        self.timeline = tl
+        self.start_address = start_address
+        self.stop_address = stop_address
+        self.stop_reason = stop_reason
+        self.channels = channels
+
+    def __repr__(self):
+        return "Execution from 0x%03x: stopped by %s at 0x%03x after %d clock cycles" % (
+            self.start_address, self.stop_reason, self.stop_address, self.timeline.total_time())
+
+    def channel_number(self, channel):
+        if isinstance(channel, str):
+            return self.channels[channel]
+        return channel
+
+    def rising_edges(self, channel):
+        """
+        Times (clock cycles) at which the channel goes up.
+        :param channel: name or number
+        :return: np.array
+        """
+        return self.timeline.edges(self.channel_number(channel), rising=True)
+
+    def trigger_times(self):
+        """
+        Times of the ADC triggers (TRG, or SPL in the default channel map).
+        :return: np.array
+        """
+        if self.channels.has_key('TRG'):
+            return self.rising_edges('TRG')
+        return self.rising_edges('SPL')
+
+    def soi_times(self):
+        """
+        Times of the Start Of Image signals.
+        :return: np.array
+        """
+        return self.rising_edges('SOI')
+
+    def eoi_times(self):
+        """
+        Times of the End Of Image signals.
+        :return: np.array
+        """
+        return self.rising_edges('EOI')
+
+
+class Emulator(object):
+    """
+    Software model of the REB sequencer, executing a memory image.
+    """
+
+    def __init__(self, image, nslices=None, subroutines=None, channels=Sequencer.default_channels, max_depth=16):
+        """
+        :param image: dict address: value
+        :param nslices: number of slices by function id. If not known, the slices up to
+        the last one with a non-zero duration or output are used.
+        :param subroutines: dict name: address, to start from a subroutine by name
+        :param channels: channel map
+        :param max_depth: size of the call stack
+        """
+        if nslices is None:
+            nslices = {}
+        if subroutines is None:
+            subroutines = {}
+        self.subroutines = subroutines
+        self.channels = channels
+        self.max_depth = max_depth
+
+        self.functions = {}
+        for func_id in range(16):
+            slices_addr = seqcompiler.slices_base_addr | (func_id << 4)
+            outputs_addr = seqcompiler.outputs_base_addr | (func_id << 4)
+            if slices_addr not in image:
+                continue
+            func = Function(name='#%d' % func_id, channels=channels)
+            func.durations[:] = [image.get(slices_addr | sl, 0) for sl in range(16)]
+            func.words[:] = [image.get(outputs_addr | sl, 0) for sl in range(16)]
+            if func_id in nslices:
+                func.nslices = nslices[func_id]
+            else:
+                used = np.nonzero(func.durations | func.words)[0]
+                func.nslices = int(used[-1]) + 1 if len(used) else 1
+            if func_id == 0:
+                # only the first slice is stored for function #0
+                func.nslices = min(func.nslices, 1)
+            self.functions[func_id] = func
+
+        # decoded program, by relative address
+        addrs = np.array(sorted([addr for addr in image if addr & 0xff0000 == seqcompiler.program_base_addr]),
+                         dtype=np.uint32)
+        fields = Instruction.decode_array([image[addr] for addr in addrs])
+        self.program = dict(zip((addrs & 0x3ff).tolist(),
+                                zip(fields['opcode'].tolist(), fields['function_id'].tolist(),
+                                    fields['infinite_loop'].tolist(), fields['repeat'].tolist(),
+                                    fields['address'].tolist())))
+
+        self.pointers = dict((addr, image[addr]) for addr in image if addr >= pointer_base_addr['MAIN'])
+
+        self.functimelines = {}
+
+    @classmethod
+    def fromsequencer(cls, seq, max_depth=16):
+        """
+        Emulator of a compiled sequencer.
+        :param seq: sequencer.Sequencer
+        :return: Emulator
+        """
+        return cls(seqcompiler.compiled_image(seq),
+                   nslices=dict((func_id, func.nslices) for func_id, func in seq.functions.iteritems()),
+                   subroutines=dict(seq.program.subroutines),
+                   channels=seq.channels,
+                   max_depth=max_depth)
+
+    @classmethod
+    def fromcompfile(cls, compfile, max_depth=16):
+        """
+        Emulator of a text compiled file. Channels are the default ones.
+        :param compfile:
+        :return: Emulator
+        """
+        image, nslices, subroutines = read_compfile(compfile)
+        return cls(image, nslices=nslices, subroutines=subroutines, max_depth=max_depth)
+
+    @classmethod
+    def fromimage(cls, compimage, max_depth=16):
+        """
+        Emulator of a binary compiled image.
+        :param compimage: seqcompiler.CompiledImage
+        :return: Emulator
+        """
+        return cls(compimage.image(),
+                   nslices=dict((func_id, n) for func_id, n, name in compimage.symbols('FUNC')),
+                   subroutines=dict((name, addr) for addr, size, name in compimage.symbols('SUBR')),
+                   channels=compimage.channels(),
+                   max_depth=max_depth)
+
+    def pointer(self, pointer_type, num):
+        addr = pointer_base_addr[pointer_type] + num
+        if addr not in self.pointers:
+            raise ValueError('Undefined pointer %s #%d' % (pointer_type, num))
+        return self.pointers[addr]
+
+    def function_timeline(self, func_id):
+        if func_id not in self.functions:
+            raise ValueError('Call to undefined function #%d' % func_id)
+        if func_id not in self.functimelines:
+            self.functimelines[func_id] = timeline.Timeline.fromfunction(self.functions[func_id])
+        return self.functimelines[func_id]
+
+    def run(self, start=None, cycle_budget=None):
+        """
+        Executes the program.
+        :param start: name or relative address of the main or subroutine to start from,
+        the main pointed by the MAIN pointer if None
+        :param cycle_budget: maximum number of clock cycles to execute. Without budget,
+        execution stops when it reaches a function called with repeat(infinity).
+        :return: Execution
+        """
+        if start is None:
+            start = self.pointer('MAIN', 0)
+        elif isinstance(start, str):
+            if start not in self.subroutines:
+                raise ValueError('Unknown subroutine name: %s' % start)
+            start = self.subroutines[start]
+
+        parts = []
+        # [cycles so far]
+        total = [0]
+        # timelines of one iteration of the subroutines already executed, by address
+        subrmemo = {}
+
+        def append(tl, repetitions):
+            """
+            Appends repetitions of the timeline, within the cycle budget.
+            Returns False if the budget is exhausted.
+            """
+            duration = tl.total_time() * repetitions
+            if duration == 0:
+                return True
+            if cycle_budget is None or total[0] + duration <= cycle_budget:
+                if repetitions == 1:
+                    parts.append(tl)
+                elif repetitions > 1:
+                    parts.append(tl.repeat(repetitions))
+                total[0] += duration
+                return True
+
+            remaining = cycle_budget - total[0]
+            full = remaining // tl.total_time()
+            if full:
+                parts.append(tl.repeat(full))
+            parts.append(tl.slice(0, remaining - full * tl.total_time()))
+            total[0] = cycle_budget
+            return False
+
+        # call stack: [subroutine address, return address, remaining repetitions, index of its first part]
+        stack = []
+        pc = start
+        while True:
+            if pc not in self.program:
+                raise ValueError('No instruction at address 0x%03x' % pc)
+            opcode, function_id, infinite_loop, repeat, address = self.program[pc]
+
+            if opcode in Instruction.Call_codes:
+                if opcode in [Instruction.OP_CallFunction, Instruction.OP_CallFuncPointerRepeat]:
+                    funcnum = function_id
+                else:
+                    funcnum = self.pointer('PTR_FUNC', function_id)
+                tl = self.function_timeline(funcnum)
+
+                if infinite_loop:
+                    if cycle_budget is None:
+                        reason = 'infinite loop'
+                        break
+                    # repeats until the budget is exhausted
+                    append(tl, (cycle_budget - total[0]) // tl.total_time() + 1)
+                    reason = 'budget'
+                    break
+
+                if opcode in [Instruction.OP_CallFunction, Instruction.OP_CallPointerFunction]:
+                    repetitions = repeat
+                else:
+                    repetitions = self.pointer('REP_FUNC', repeat)
+                if not append(tl, repetitions):
+                    reason = 'budget'
+                    break
+                pc += 1
+
+            elif opcode in Instruction.Jsr_codes:
+                if opcode in [Instruction.OP_JumpToSubroutine, Instruction.OP_JumpSubPointerRepeat]:
+                    target = address
+                else:
+                    target = self.pointer('PTR_SUBR', address)
+                if opcode in [Instruction.OP_JumpToSubroutine, Instruction.OP_JumpPointerSubroutine]:
+                    repetitions = repeat
+                else:
+                    repetitions = self.pointer('REP_SUBR', repeat)
+
+                if repetitions == 0:
+                    pc += 1
+                elif target in subrmemo:
+                    # already executed: re-uses its timeline
+                    if not append(subrmemo[target], repetitions):
+                        reason = 'budget'
+                        break
+                    pc += 1
+                else:
+                    if len(stack) >= self.max_depth:
+                        raise ValueError('Call stack overflow at address 0x%03x' % pc)
+                    stack.append([target, pc + 1, repetitions, len(parts)])
+                    pc = target
+
+            elif opcode == Instruction.OP_ReturnFromSubroutine:
+                if not stack:
+                    reason = 'RTS'
+                    break
+                target, return_address, repetitions, first = stack.pop()
+                # first iteration done: the other ones are identical
+                subrmemo[target] = timeline.Timeline.concatenate(parts[first:])
+                parts[first:] = [subrmemo[target]]
+                if not append(subrmemo[target], repetitions - 1):
+                    reason = 'budget'
+                    break
+                pc = return_address
+
+            else:
+                reason = 'END'
+                break
+
+        return Execution(timeline.Timeline.concatenate(parts), start, pc, reason, self.channels)
@@ -0,0 +1,238 @@
+#
+# LSST
+# Selective reading of the image extensions of CCD FITS files
+#
+# Reads only the requested segments (image extensions 1 to 16) and only the requested
+# row/column region of interest:
+# - uncompressed extensions are memory-mapped, and only the ROI is scaled (BZERO/BSCALE);
+# - tile-compressed extensions (RICE .fz files from fpack or CCS) are decompressed only
+# for the tiles covering the requested rows: the tiles are copied from the file heap into
+# a small in-memory compressed HDU that astropy decompresses.
+#
+# Syntax in a script:
+# import fitsdata
+# data = fitsdata.read_segments("s00/tm-scan.fits.fz", range(16), rows=slice(100, 1900), cols=slice(530, 576))
+# print(data.shape, data.mean(axis=(1, 2)))
+from __future__ import print_function
+import io
+import threading
+import numpy as np
+import astropy.io.fits as pyfits
+from astropy.io.fits.column import FITS2NUMPY
+
+# on-disk data types, by BITPIX
+bitpix_dtypes = {8: 'u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+
+# astropy switches image compression off and back on globally while reading the headers
+# of a file opened with disable_image_compression: headers are read under this lock,
+# so that files can be read from several threads
+headers_lock = threading.Lock()
+
+
+def open_fits(fitsfile):
+    """
+    Opens the file for selective reading: data is memory-mapped and compressed images
+    are left as binary tables (their header holds the image keywords as well).
+    All headers are read when opening.
+    :param fitsfile:
+    :return: HDUList
+    """
+    with headers_lock:
+        return pyfits.open(fitsfile, memmap=True, disable_image_compression=True, lazy_load_hdus=False)
+
+
+def scaled(raw, bitpix, bzero=0, bscale=1):
+    """
+    Physical values from stored values, with the same data types as astropy.
+    :param raw: stored values
+    :param bitpix:
+    :param bzero:
+    :param bscale:
+    :return: np.array
+    """
+    if bscale == 1 and bitpix in [16, 32, 64] and bzero == 1 << (bitpix - 1):
+        # unsigned integers stored with an offset
+        data = raw.view('>u%d' % (bitpix // 8)).astype('u%d' % (bitpix // 8))
+        data ^= bzero
+        return data
+    if bscale != 1 or bzero != 0:
+        if bitpix in [8, 16, -32]:
+            data = raw.astype(np.float32)
+        else:
+            data = raw.astype(np.float64)
+        if bscale != 1:
+            data *= bscale
+        if bzero != 0:
+            data += bzero
+        return data
+
+    return raw.astype(raw.dtype.newbyteorder('='))
+
+
+def image_memmap(hdulist, ext):
+    """
+    Stored values of an uncompressed image extension, memory-mapped.
+    :param hdulist: from open_fits()
+    :param ext: extension number
+    :return: 2D np.memmap
+    """
+    header = hdulist[ext].header
+
+    return np.memmap(hdulist.filename(), dtype=bitpix_dtypes[header['BITPIX']], mode='r',
+                     offset=hdulist.fileinfo(ext)['datLoc'], shape=(header['NAXIS2'], header['NAXIS1']))
+
+
+def image_roi(hdulist, ext, rows=slice(None), cols=slice(None)):
+    """
+    Region of interest of an uncompressed image extension, memory-mapped.
+    :param hdulist: from open_fits()
+    :param ext: extension number
+    :param rows:
+    :param cols:
+    :return: 2D np.array
+    """
+    header = hdulist[ext].header
+    raw = image_memmap(hdulist, ext)
+
+    return scaled(raw[rows, cols], header['BITPIX'], header.get('BZERO', 0), header.get('BSCALE', 1))
+
+
+def compressed_roi(hdulist, ext, rows=slice(None), cols=slice(None)):
+    """
+    Region of interest of a tile-compressed image extension: only the tiles covering
+    the rows are decompressed.
+    :param hdulist: from open_fits()
+    :param ext: extension number
+    :param rows: only a slice with positive step restricts the tiles that are decompressed
+    :param cols:
+    :return: 2D np.array
+    """
+    table = hdulist[ext]
+    header = table.header
+    width, height = header['ZNAXIS1'], header['ZNAXIS2']
+    tilewidth, tileheight = header.get('ZTILE1', width), header.get('ZTILE2', 1)
+    # tiles are stored by rows of tiles
+    ntiles = -(-width // tilewidth)
+
+    ntilerows = -(-height // tileheight)
+    if isinstance(rows, slice) and rows.indices(height)[2] > 0:
+        start, stop, step = rows.indices(height)
+        firsttile = min(start // tileheight, ntilerows - 1)
+        lasttile = max(-(-stop // tileheight), firsttile + 1)
+        # rows relative to the first tile
+        rows = slice(start - firsttile * tileheight, stop - firsttile * tileheight, step)
+    else:
+        firsttile, lasttile = 0, ntilerows
+
+    # table rows and heap, as stored in the file
+    rowsize, nrows = header['NAXIS1'], header['NAXIS2']
+    theap = header.get('THEAP', rowsize * nrows)
+    raw = np.memmap(hdulist.filename(), dtype=np.uint8, mode='r', offset=hdulist.fileinfo(ext)['datLoc'],
+                    shape=(theap + header['PCOUNT'],))
+    rowdtype = np.dtype([(col.name, np.dtype(col.format.recformat).newbyteorder('>')) for col in table.columns])
+    tiles = raw[:rowsize * nrows].view(rowdtype)[firsttile * ntiles:lasttile * ntiles].copy()
+
+    # copies the variable length arrays of the selected tiles to a new heap
+    heap = []
+    heapsize = 0
+    for col in table.columns:
+        if col.format.p_format is None:
+            continue
+        descriptors = tiles[col.name]
+        nbytes = descriptors[:, 0].astype(np.int64) * np.dtype(FITS2NUMPY[col.format.p_format]).itemsize
+        offsets = heapsize + np.cumsum(nbytes) - nbytes
+        heap.append(raw[theap + np.repeat(descriptors[:, 1] - offsets, nbytes) +
+                        np.arange(heapsize, heapsize + nbytes.sum())])
+        descriptors[:, 1] = offsets
+        heapsize += int(nbytes.sum())
+
+    subheader = header.copy()
+    subheader['NAXIS2'] = len(tiles)
+    subheader['PCOUNT'] = heapsize
+    if 'THEAP' in subheader:
+        del subheader['THEAP']
+    subheader['ZNAXIS2'] = min(lasttile * tileheight, height) - firsttile * tileheight
+
+    data = tiles.tobytes() + b''.join([h.tobytes() for h in heap])
+    data += b'\0' * (-len(data) % 2880)
+    subfile = io.BytesIO(pyfits.PrimaryHDU().header.tostring().encode('ascii') +
+                         subheader.tostring().encode('ascii') + data)
+    with headers_lock:
+        subhdulist = pyfits.open(subfile, lazy_load_hdus=False)
+    tiledata = subhdulist[1].data
+    subhdulist.close()
+
+    return tiledata[rows, cols]
+
+
+def segment_roi(hdulist, ext, rows=slice(None), cols=slice(None)):
+    """
+    Region of interest of an image extension, compressed or not.
+    :param hdulist: from open_fits()
+    :param ext: extension number
+    :param rows:
+    :param cols:
+    :return: 2D np.array
+    """
+    if hdulist[ext].header.get('ZIMAGE', False):
+        return compressed_roi(hdulist, ext, rows, cols)
+
+    return image_roi(hdulist, ext, rows, cols)
+
+
+def segment_reader(hdulist, ext):
+    """
+    Function reading regions of interest of an image extension, compressed or not, for
+    repeated reads of the same extension: the header and the position of the data in
+    the file are looked up once.
+    :param hdulist: from open_fits()
+    :param ext: extension number
+    :return: function of (rows, cols), returning a 2D np.array
+    """
+    header = hdulist[ext].header
+    if header.get('ZIMAGE', False):
+        return lambda rows=slice(None), cols=slice(None): compressed_roi(hdulist, ext, rows, cols)
+
+    raw = image_memmap(hdulist, ext)
+    bitpix, bzero, bscale = header['BITPIX'], header.get('BZERO', 0), header.get('BSCALE', 1)
+
+    return lambda rows=slice(None), cols=slice(None): scaled(raw[rows, cols], bitpix, bzero, bscale)
+
+
+def roi_layout(hdulist, ext, rows=slice(None), cols=slice(None)):
+    """
+    Shape and data type of a region of interest, from the header only.
+    :param hdulist: from open_fits()
+    :param ext: extension number
+    :param rows:
+    :param cols:
+    :return: shape (tuple), np.dtype
+    """
+    header = hdulist[ext].header
+    if header.get('ZIMAGE', False):
+        height, width, bitpix = header['ZNAXIS2'], header['ZNAXIS1'], header['ZBITPIX']
+    else:
+        height, width, bitpix = header['NAXIS2'], header['NAXIS1'], header['BITPIX']
+    shape = np.broadcast_to(np.int8(0), (height, width))[rows, cols].shape
+    dtype = scaled(np.zeros(0, dtype=bitpix_dtypes[bitpix]), bitpix,
+                   header.get('BZERO', 0), header.get('BSCALE', 1)).dtype
+
+    return shape, dtype
+
+
+def read_segments(fitsfile, segments=range(16), rows=slice(None), cols=slice(None)):
+    """
+    Reads the region of interest of the given segments.
+    :param fitsfile:
+    :param segments: segment numbers (0-15), in extensions 1 to 16
+    :param rows:
+    :param cols:
+    :return: np.array (nseg, rows, cols)
+    """
+    hdulist = open_fits(fitsfile)
+    try:
+        data = np.stack([segment_roi(hdulist, seg + 1, rows, cols) for seg in segments])
+    finally:
+        hdulist.close()
+
+    return data
@@ -0,0 +1,320 @@
+#
+# LSST
+# Focal plane datasets: CCD files of many rafts, read and reduced segment by segment
+#
+# The files of a focal plane acquisition (one FITS file per CCD, with the raft and CCD
+# in the file name, as in "MC_C_20200305_000123-R22-S11.fits") are found once, then
+# reduced across a pool of processes: each process reads one segment at a time, applies
+# the reduction (mean and standard deviation, mean scan...) and sends back only the
+# result, which is streamed out to the caller. The number of processes is bounded by
+# a memory budget, so that the whole focal plane is never held in memory.
+#
+# Syntax in a script:
+# import focalplane
+# fp = focalplane.FocalPlane.fromdirectory(datadir)
+# for raft, ccd, segments, results in fp.reduce(focalplane.segment_stats, rows=slice(100, 1900)):
+#     print(raft, ccd, results)
+#
+# Syntax as main:
+# python focalplane.py [-j <processes>] [-m <megabytes>] [-r <rafts>] <datadir>
+from __future__ import print_function
+import sys
+import os
+import re
+import multiprocessing
+import optparse
+import numpy as np
+
+import fitsdata
+import raftdata
+
+# rafts with 4 CCDs (guiding and wavefront sensors) in the corners of the focal plane
+corner_rafts = ['R00', 'R04', 'R40', 'R44']
+corner_ccds = ['SG0', 'SG1', 'SW0', 'SW1']
+
+# default memory budget for the segments read at the same time (bytes)
+default_memory = 1 << 30
+
+# raft and CCD in a file name, separated by '-' or '_'
+ccd_name_pattern = re.compile(r'(R[0-4][0-4])[-_](S[0-2][0-2]|SG[01]|SW[01])(?![0-9])')
+
+
+def raft_ids():
+    """
+    All rafts of the focal plane, corner rafts included.
+    :return: list of strings, from 'R00' to 'R44'
+    """
+    return ['R%d%d' % (i, j) for i in range(5) for j in range(5)]
+
+
+def ccd_ids(raft):
+    """
+    CCDs of a raft.
+    :param raft:
+    :return: list of strings
+    """
+    if raft in corner_rafts:
+        return list(corner_ccds)
+
+    return ['S' + slot for slot in raftdata.slot_ids()]
+
+
+def parse_ccd_name(filename):
+    """
+    Raft and CCD from a file name.
+    :param filename:
+    :return: (raft, ccd), or None if not found
+    """
+    match = ccd_name_pattern.search(os.path.basename(filename))
+    if match is None:
+        return None
+
+    return match.group(1), match.group(2)
+
+
+def segment_stats(data):
+    """
+    Reduction: mean and standard deviation of the segment.
+    :param data: 2D np.array
+    :return: (mean, std)
+    """
+    return data.mean(), data.std()
+
+
+def segment_scan(data):
+    """
+    Reduction: mean over the lines of the segment (scan profile).
+    :param data: 2D np.array
+    :return: 1D np.array
+    """
+    return data.mean(axis=0)
+
+
+def segment_count(path):
+    """
+    Number of segments (image extensions) in a CCD file.
+    :param path:
+    :return: int
+    """
+    hdulist = fitsdata.open_fits(path)
+    try:
+        nseg = len(hdulist) - 1
+    finally:
+        hdulist.close()
+
+    return nseg
+
+
+def reduce_ccd(task):
+    """
+    Applies the reduction to the segments of a CCD file, one segment at a time.
+    Segments that are not in the file (corner rafts have 8) are skipped.
+    :param task: (raft, ccd, path, segments, rows, cols, reduction)
+    :return: (raft, ccd, list of segments, list of results)
+    """
+    raft, ccd, path, segments, rows, cols, reduction = task
+
+    hdulist = fitsdata.open_fits(path)
+    try:
+        segments = [seg for seg in segments if seg + 1 < len(hdulist)]
+        results = [reduction(fitsdata.segment_roi(hdulist, seg + 1, rows, cols)) for seg in segments]
+    finally:
+        hdulist.close()
+
+    return raft, ccd, segments, results
+
+
+class FocalPlane(object):
+    """
+    Files of a focal plane acquisition, by raft and CCD.
+    """
+
+    def __init__(self, files):
+        """
+        :param files: dict (raft, ccd): path to the file
+        """
+        self.files = files
+
+    def __len__(self):
+        return len(self.files)
+
+    def __repr__(self):
+        return "FocalPlane(%d rafts, %d CCDs)" % (len(self.rafts()), len(self.files))
+
+    @classmethod
+    def fromdirectory(cls, datadir, rafts=None):
+        """
+        Finds the CCD files under the directory, from the raft and CCD in their names.
+        If several files are found for the same CCD, the first one in alphabetical order is used.
+        :param datadir:
+        :param rafts: only these rafts, all if None
+        :return: FocalPlane
+        """
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(datadir):
+            dirnames.sort()
+            for f in sorted(filenames):
+                if os.path.splitext(f)[1] not in [".fits", ".fz"]:
+                    continue
+                key = parse_ccd_name(f)
+                if key is None or (rafts is not None and key[0] not in rafts):
+                    continue
+                files.setdefault(key, os.path.join(dirpath, f))
+
+        return cls(files)
+
+    def keys(self):
+        """
+        :return: list of (raft, ccd), sorted
+        """
+        return sorted(self.files)
+
+    def rafts(self):
+        """
+        :return: list of rafts with at least one CCD file, sorted
+        """
+        return sorted(set(raft for raft, ccd in self.files))
+
+    def raft_files(self, raft):
+        """
+        Files of the CCDs of a raft.
+        :param raft:
+        :return: list of paths, list of CCDs
+        """
+        ccds = [ccd for ccd in ccd_ids(raft) if (raft, ccd) in self.files]
+
+        return [self.files[(raft, ccd)] for ccd in ccds], ccds
+
+    def read_raft(self, raft, segments=range(16), rows=slice(None), cols=slice(None), threads=9):
+        """
+        Reads the region of interest of the CCDs of a raft (see raftdata.read_raft()).
+        As in reduce_ccd(), segments that are not in the files are skipped: only the
+        segments present in all the CCD files of the raft are read (8 for the
+        wavefront sensors of the corner rafts).
+        :param raft:
+        :param segments:
+        :param rows:
+        :param cols:
+        :param threads:
+        :return: np.array (CCD, segment, rows, columns), list of CCDs
+        """
+        raftfits, ccds = self.raft_files(raft)
+        if not raftfits:
+            raise ValueError('No CCD file for raft %s' % raft)
+
+        nseg = min(segment_count(path) for path in raftfits)
+        segments = [seg for seg in segments if seg < nseg]
+        if not segments:
+            raise ValueError('None of the requested segments in the CCD files of raft %s (%d segments)' %
+                             (raft, nseg))
+
+        return raftdata.read_raft(raftfits, segments, rows, cols, threads), ccds
+
+    def segment_bytes(self, rows=slice(None)):
+        """
+        Memory needed to read and reduce one segment, from the header of the first file.
+        The whole width of the rows is counted, as compressed tiles are decompressed along
+        full rows, plus two float64 temporaries per pixel for the reduction.
+        :param rows:
+        :return: int
+        """
+        hdulist = fitsdata.open_fits(self.files[self.keys()[0]])
+        try:
+            shape, dtype = fitsdata.roi_layout(hdulist, 1, rows)
+        finally:
+            hdulist.close()
+
+        return int(np.prod(shape)) * (dtype.itemsize + 16)
+
+    def pool_size(self, processes=None, memory=default_memory, rows=slice(None)):
+        """
+        Number of processes that fit in the memory budget, each one reading a segment at a time.
+        :param processes: maximum number of processes, number of CPUs if None
+        :param memory: memory budget (bytes)
+        :param rows:
+        :return: int
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        nbytes = self.segment_bytes(rows)
+        if nbytes > memory:
+            raise ValueError('Memory budget of %d bytes too small to read a segment (%d bytes)' % (memory, nbytes))
+
+        return max(1, min(processes, memory // nbytes, len(self.files)))
+
+    def reduce(self, reduction=segment_stats, segments=range(16), rows=slice(None), cols=slice(None),
+               processes=None, memory=default_memory):
+        """
+        Applies a reduction to each segment, across a pool of processes. Results are yielded
+        as soon as each CCD is done, in the order of keys().
+        :param reduction: function of the segment data (2D np.array), defined at module level
+        so that it can be sent to the processes
+        :param segments: segment numbers (0-15)
+        :param rows:
+        :param cols:
+        :param processes: maximum number of processes, number of CPUs if None
+        :param memory: memory budget for the segments read at the same time (bytes)
+        :return: generator of (raft, ccd, list of segments, list of results)
+        """
+        if not self.files:
+            return
+        segments = list(segments)
+        tasks = [key + (self.files[key], segments, rows, cols, reduction) for key in self.keys()]
+
+        pool = multiprocessing.Pool(self.pool_size(processes, memory, rows))
+        try:
+            for result in pool.imap(reduce_ccd, tasks, chunksize=1):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def reduce_array(self, reduction=segment_stats, segments=range(16), rows=slice(None), cols=slice(None),
+                     processes=None, memory=default_memory):
+        """
+        Gathers the results of reduce() in an array, NaN for missing segments.
+        :return: np.array (CCD in the order of keys(), segment, result...), list of (raft, ccd)
+        """
+        segments = list(segments)
+        keys = self.keys()
+        index = dict((key, num) for num, key in enumerate(keys))
+
+        table = None
+        for raft, ccd, segs, results in self.reduce(reduction, segments, rows, cols, processes, memory):
+            for seg, result in zip(segs, results):
+                result = np.asarray(result, dtype=np.float64)
+                if table is None:
+                    table = np.full((len(keys), len(segments)) + result.shape, np.nan)
+                table[index[(raft, ccd)], segments.index(seg)] = result
+
+        return table, keys
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage=
+    """
+    %prog [-j <processes>] [-m <megabytes>] [-r <rafts>] <datadir>
+
+    Mean and standard deviation of all the segments of a focal plane acquisition,
+    printed as the CCDs are processed.
+    """)
+    parser.add_option('-j', '--jobs', default=None, type='int',
+                      help='Maximum number of processes (default: number of CPUs)')
+    parser.add_option('-m', '--memory', default=default_memory >> 20, type='int',
+                      help='Memory budget in MB (default: %d)' % (default_memory >> 20))
+    parser.add_option('-r', '--rafts', default=None,
+                      help='Comma-separated list of rafts (default: all)')
+
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+
+    rafts = None
+    if options.rafts:
+        rafts = options.rafts.split(',')
+    fp = FocalPlane.fromdirectory(args[0], rafts)
+    print(fp)
+    for raft, ccd, segs, results in fp.reduce(segment_stats, processes=options.jobs, memory=options.memory << 20):
+        for seg, (mean, std) in zip(segs, results):
+            print("%s %s %2d %10.2f %10.2f" % (raft, ccd, seg, mean, std))
@@ -4,6 +4,7 @@
 #
 # Author: Laurent Le Guillou
 from __future__ import print_function
+import os
 import re
 
 class SeqParser(object):
@@ -46,15 +47,17 @@ class SeqParser(object):
         self.verbose = verbose
         
         # compiling patterns
-        self.p_zmsp =    re.compile("^" + self._p_zmsp)
-        self.p_omsp =    re.compile("^" + self._p_omsp)
-        self.p_newline = re.compile("^" + self._p_newline)
-        self.p_comment = re.compile("^" + self._p_comment)
-        self.p_integer = re.compile("^" + self._p_integer)
-        self.p_address = re.compile("^" + self._p_address)
-        self.p_name =    re.compile("^" + self._p_name)
-        self.p_duration_unit = re.compile("^" + self._p_duration_unit)
-        self.p_file = re.compile("^" + self._p_file)
+        # no '^' anchor: patterns are applied with match(s, pos), which is
+        # anchored at pos and avoids copying the rest of the string each time
+        self.p_zmsp =    re.compile(self._p_zmsp)
+        self.p_omsp =    re.compile(self._p_omsp)
+        self.p_newline = re.compile(self._p_newline)
+        self.p_comment = re.compile(self._p_comment)
+        self.p_integer = re.compile(self._p_integer)
+        self.p_address = re.compile(self._p_address)
+        self.p_name =    re.compile(self._p_name)
+        self.p_duration_unit = re.compile(self._p_duration_unit)
+        self.p_file = re.compile(self._p_file)
 
     #=======================================================================
 
@@ -67,12 +70,11 @@ class SeqParser(object):
             return pos
 
         # Always match, eat spaces
-        matches = self.p_zmsp.search(self.s[pos:])
+        matches = self.p_zmsp.match(self.s, pos)
         if matches is None:
             return pos
 
-        l = matches.end()
-        pnext = pos + l
+        pnext = matches.end()
         return pnext
 
 
@@ -81,12 +83,11 @@ class SeqParser(object):
         if pos >= self.length:
             return None
         
-        matches = self.p_omsp.search(self.s[pos:])
+        matches = self.p_omsp.match(self.s, pos)
         if matches == None:
             return None
 
-        l = matches.end()
-        pnext = pos + l
+        pnext = matches.end()
         return pnext
     
     #-----------------------------------------------------------------------
@@ -96,13 +97,12 @@ class SeqParser(object):
         if pos >= self.length:
             return None
 
-        matches = self.p_newline.search(self.s[pos:])
+        matches = self.p_newline.match(self.s, pos)
         if matches == None:
             return None
 
         # start = matches.start()
-        l = matches.end()
-        pnext = pos + l
+        pnext = matches.end()
 
         return pnext
 
@@ -113,14 +113,13 @@ class SeqParser(object):
         if pos >= self.length:
             return None
 
-        matches = self.p_comment.search(self.s[pos:])
+        matches = self.p_comment.match(self.s, pos)
         if matches == None:
             return None
 
         # start = matches.start()
-        l = matches.end()
         comment = matches.group(1)
-        pnext = pos + l
+        pnext = matches.end()
 
         comment = comment.strip()
         
@@ -163,13 +162,12 @@ class SeqParser(object):
     def m_integer(self, pos):
         pnext = pos
 
-        matches = self.p_integer.search(self.s[pnext:])
+        matches = self.p_integer.match(self.s, pnext)
         if matches == None:
             return None
 
-        l = matches.end()
         integer = int(matches.group(1))
-        pnext = pnext + l
+        pnext = matches.end()
 
         return (pnext, integer)
 
@@ -179,13 +177,12 @@ class SeqParser(object):
     def m_address(self, pos):
         pnext = pos
 
-        matches = self.p_integer.search(self.s[pnext:])
+        matches = self.p_integer.match(self.s, pnext)
         if matches == None:
             return None
 
-        l = matches.end()
         address = int(matches.group(1), 16)
-        pnext = pnext + l
+        pnext = matches.end()
 
         return (pnext, address)
 
@@ -195,13 +192,12 @@ class SeqParser(object):
     def m_name(self, pos):
         pnext = pos
 
-        matches = self.p_name.search(self.s[pnext:])
+        matches = self.p_name.match(self.s, pnext)
         if matches == None:
             return None
 
-        l = matches.end()
         name = matches.group(1)
-        pnext = pnext + l
+        pnext = matches.end()
 
         return (pnext, name)
 
@@ -243,13 +239,12 @@ class SeqParser(object):
     def m_duration_unit(self, pos):
         pnext = pos
 
-        matches = self.p_duration_unit.search(self.s[pos:])
+        matches = self.p_duration_unit.match(self.s, pos)
         if matches == None:
             return None
 
-        l = matches.end()
         unit = matches.group(1)
-        pnext = pos + l
+        pnext = matches.end()
 
         return pnext, unit
 
@@ -281,13 +276,12 @@ class SeqParser(object):
     def m_file_name(self,pos):
         pnext = pos
 
-        matches = self.p_file.search(self.s[pnext:])
+        matches = self.p_file.match(self.s, pnext)
         if matches == None:
             return None
 
-        l = matches.end()
         name = matches.group(1)
-        pnext = pnext + l
+        pnext = matches.end()
 
         return (pnext, name)
 
@@ -2146,12 +2140,60 @@ def merge_result(stronger, weaker):
     merge_section_dicts(stronger['mains'], weaker['mains'], 'name')
 
 
-def parse_file(txtfile, verbose=True):
+def parse_includes(txtfile):
     """
-    Parses input file, manages 'includes' section.
+    Parses only the 'includes' section of the input file (no recursion).
+    :param txtfile:
+    :return: list of included file names
+    """
+    sfile = open(txtfile, 'r')
+    s = sfile.read()
+    sfile.close()
+
+    seq = SeqParser(s, verbose=False)
+    r = seq.m_include_section(seq.m_empty_lines(0))
+    if r is None:
+        return []
+
+    return [parentfile[0] for parentfile in r[1]]
+
+
+# memory of the files already parsed in this session
+# absolute path -> (modification time, size, result of SeqParser.m_seq before merging includes)
+parsed_files = {}
+
+
+def copy_result(result):
+    """
+    Copies the section lists of a parser 'result', so that merging into the copy
+    leaves the original untouched. Definitions themselves are shared.
+    :param result:
+    :return:
+    """
+    copy = dict(result)
+    for section in ['includes', 'constants', 'clocks', 'functions', 'subroutines', 'mains']:
+        copy[section] = list(result[section])
+    # tuple of lists, one list per type of pointers
+    copy['pointers'] = type(result['pointers'])([list(l) for l in result['pointers']])
+
+    return copy
+
+
+def parse_single_file(txtfile, verbose=True):
+    """
+    Parses input file alone (includes are not followed), once per session as long as the file does not change.
+    The returned result is shared and should not be modified.
     :param txtfile:
     :return:
     """
+    fullname = os.path.abspath(txtfile)
+    st = os.stat(fullname)
+
+    if fullname in parsed_files:
+        mtime, size, result = parsed_files[fullname]
+        if (mtime, size) == (st.st_mtime, st.st_size):
+            return result
+
     sfile = open(txtfile, 'r')
     s = sfile.read()
     sfile.close()
@@ -2159,16 +2201,35 @@ def parse_file(txtfile, verbose=True):
     seq = SeqParser(s, verbose)
     result = seq.m_seq(0)
 
+    parsed_files[fullname] = (st.st_mtime, st.st_size, result)
+
+    return result
+
+
+def parse_file(txtfile, verbose=True, including=()):
+    """
+    Parses input file, manages 'includes' section.
+    Each physical file is parsed only once per session (see parse_single_file), and include cycles are detected.
+    :param txtfile:
+    :param including: chain of files currently being included (internal)
+    :return:
+    """
+    fullname = os.path.abspath(txtfile)
+    if fullname in including:
+        raise ValueError('Include cycle: %s' % ' -> '.join(including + (fullname,)))
+
+    result = parse_single_file(txtfile, verbose)
+    if result is None:
+        return None
+    result = copy_result(result)
+
     # child values overwrite parents in case of conflict, with inheritance order from [includes]
-    # manages recursivity (even though it is a terribly dangerous idea)
 
     # includes section is a list of tuples (file, comment)
     for parentfile in reversed(result['includes']):
         parentname = parentfile[0]
         print('Including sequencer file: %s ' % parentname)
-        parentresult = parse_file(parentname, verbose)
+        parentresult = parse_file(parentname, verbose, including + (fullname,))
         merge_result(result, parentresult)
 
     return result
-
-
@@ -7,6 +7,7 @@ import numpy as np
 from matplotlib import pyplot as plt
 from matplotlib import colors as mplcol
 import raftstats
+import fitsdata
 
 
 def get_scan_data(hfile, datadir, ROI=slice(1, 1000)):
@@ -15,21 +16,13 @@ def get_scan_data(hfile, datadir, ROI=slice(1, 1000)):
     """
     fitsfile = os.path.join(datadir, hfile)
     try:
-        h = pyfits.open(fitsfile)
+        roidata = fitsdata.read_segments(fitsfile, range(16), rows=ROI)
     except:
         print("Failed to open %s" % fitsfile)
         return [], []
 
-    imax = h[1].data.shape[1]
-    linedata = np.zeros((16, imax))
-    linestd = np.zeros((16, imax))
-
-    for channel in range(16):
-        linedata[channel, :] = h[channel + 1].data[ROI, :].mean(axis=0)
-        linestd[channel, :] = h[channel + 1].data[ROI, :].std(axis=0)
-
-    h.close()
-    del h
+    linedata = roidata.mean(axis=1)
+    linestd = roidata.std(axis=1)
 
     return linedata, linestd
 
@@ -20,6 +20,8 @@ import numpy as np
 from matplotlib import pyplot as plt
 from matplotlib import colors as mplcol
 import scope
+import raftdata
+import focalplane
 from astropy.io import fits
 
 
@@ -27,28 +29,16 @@ def get_scandata_raft(inputfile, datadir=''):
     """
     Builds up list of data arrays from all raft files (one array per CCD), plus list of segment names.
     :param datadir: optional, directory where data is stored
-    :param inputfile: the first file (for Reb0 or S00). Full path if datadir is not given
-    :return:
+    :param inputfile: the first file (for Reb0 or S00). Full path if datadir is not given.
+    If empty, will look for FITS files in the S00 to S22 subdirectories of datadir.
+    :return: FITS data as a single array (CCD, channel, lines, columns), list of arrays for raw data
     """
-    raftarrays = []
-    if os.path.splitext(inputfile)[1] in [".fits", ".fz"]:
-        # starts with 00 through 22
-        seglist = slot_ids()
-        # when REB2 data is missing
-        #seglist = ["%d%d" % (i, j) for i in range(2) for j in range(3)]
-
-        # if there is "00" elsewhere in the file name, modify as appropriate
-        if '00_0_' in inputfile:  # new numbering scheme from eTraveler
-            raftfits = [os.path.join(datadir, inputfile.replace("00_0", s + '_' + s[1:])) for s in seglist]
-        elif '00_' in inputfile:
-            raftfits = [inputfile.replace("00_", s + '_', 1) for s in seglist]
-        elif 'S00' in inputfile:
-            raftfits = [inputfile.replace("S00", 'S' + s, 1) for s in seglist]
-        else:
-            raftfits = [inputfile.replace("00-", s + '-', 1) for s in seglist]
-        for f in raftfits:
-            raftarrays.append(scope.get_scandata_fromfile(f, datadir))
+    if inputfile == '' or os.path.splitext(inputfile)[1] in [".fits", ".fz"]:
+        # starts with 00 through 22, files read concurrently into a single array
+        raftarrays, seglist = raftdata.get_raft_data(inputfile, datadir)
+        print("Read data from raft: " + raftarrays.shape.__repr__())
     elif os.path.splitext(inputfile)[1] == ".dat":
+        raftarrays = []
         # starts with Reb0 through Reb2
         reblist = ["Reb0", "Reb1", "Reb2"]
         rebraws = [inputfile.replace("Reb0", s) for s in reblist]
@@ -57,36 +47,23 @@ def get_scandata_raft(inputfile, datadir=''):
             fullreb = scope.get_scandata_fromfile(f, datadir)  # 3D array: 48 channels, lines, columns
             #print fullreb.shape
             raftarrays.extend([a for a in np.split(fullreb, 3, axis=0)])  # splits REB data into 3 CCDs
-    elif inputfile == '':
-        seglist = slot_ids()
-        for segstr in seglist:
-            d = os.path.join(datadir, 'S%s' % segstr)
-            for f in os.listdir(d):
-                #print f
-                if os.path.splitext(f)[1] in [".fits", ".fz"]  and os.stat(os.path.join(d, f)).st_size > 1e6:
-                    # one file per directory
-                    raftarrays.append(scope.get_scandata_fromfile(f, d))
-                    break
     else:
-        seglist = []
+        raftarrays, seglist = [], []
 
     return raftarrays, seglist
 
 
 def get_scandata_bot(raft, datadir):
-    lf = []
-    for f in os.listdir(datadir):
-        if raft in f:
-            lf.append(f)
-    lf = sorted(lf)
-    
-    seglist = []
-    raftarrays = []
-    for f in lf:
-        ccd = f.split('-')[2]
-        raftarrays.append(scope.get_scandata_fromfile(f, datadir))
-        seglist.append(ccd)
-        
+    """
+    Reads the data of a raft from focal plane files (raft and CCD in the file names).
+    :param raft: raft in format 'Rxx'
+    :param datadir: directory where data is stored
+    :return: single array (CCD, channel, lines, columns), list of CCD names
+    """
+    fp = focalplane.FocalPlane.fromdirectory(datadir, [raft])
+    raftarrays, seglist = fp.read_raft(raft)
+    print("Read data from %s: " % raft + raftarrays.shape.__repr__())
+
     return raftarrays, seglist
 
 
@@ -121,7 +98,7 @@ def raft_display_allchans(inputfile, datadir='', suptitle='', outdir='', bot=Fal
 
 
 def slot_ids():
-    return ["%d%d" % (i, j) for i in range(3) for j in range(3)]
+    return raftdata.slot_ids()
 
 
 def plot_raft_allchans(raftarrays, seglist, suptitle=''):
@@ -8,6 +8,11 @@
 import os
 import sys
 import numpy as np
+import statscache
+
+# overscan region, as in raftstats.repr_stats()
+overscan_rows = slice(100, 1900)
+overscan_cols = slice(540, 576)
 
 def half_median(table):
     """
@@ -78,16 +83,30 @@ def parse_summary_dump(dumpfile, selectitem):
     outf.close()
 
 
-def parse_all_directory(datadir, Nfits=1):
+def parse_all_directory(datadir, Nfits=1, fromfits=False, headers=False, cache=False):
     """
     Parses all summary files in directory and finds maximum/median/etc. outputs to file.
     :param datadir:
     :param Nfits:
+    :param fromfits: uses the overscan statistics of the FITS files in the directory instead
+    of the summary files
+    :param headers: with fromfits, uses the AVGBIAS header values when present
+    :param cache: with fromfits, the statistics are computed once and kept in sidecar files (see statscache)
     :return:
     """
     outf = open(os.path.join(datadir, "allsummary-average.txt"), 'w')
 
     for f in sorted(os.listdir(datadir)):
+        if fromfits:
+            if os.path.splitext(f)[1] not in [".fits", ".fz"]:
+                continue
+            print("Opening %s" % f)
+            keywords = statscache.overscan_keywords if headers else None
+            table = statscache.roi_stats(os.path.join(datadir, f), overscan_rows, overscan_cols, headers=keywords,
+                                         cache=cache)[0]
+            outf.write("%s\t %.2f\n" % (os.path.splitext(f)[0], np.array(table).mean()))
+            continue
+
         if f[:7] != "summary":
             continue
 
@@ -0,0 +1,142 @@
+#
+# LSST
+# Raft dataset loader
+#
+# Resolves the paths of the nine CCD files of a raft (slots S00 to S22) once, then reads
+# the selected segments and region of interest of all of them concurrently, with a pool
+# of threads (the memory-mapped reads and the decompression of the tiles do most of their
+# work outside of the GIL), into a single preallocated (CCD, segment, rows, columns) array.
+#
+# Syntax in a script:
+# import raftdata
+# raftfits, seglist = raftdata.raft_files("00_0_scan_20180701021633_TM.fits", datadir)
+# data = raftdata.read_raft(raftfits, rows=slice(100, 1900), cols=slice(530, 576))
+# print(data.shape, data.mean(axis=(2, 3)))
+from __future__ import print_function
+import os
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+import fitsdata
+
+
+def slot_ids():
+    """
+    Slots of the CCDs in the raft.
+    :return: list of strings, from '00' to '22'
+    """
+    return ["%d%d" % (i, j) for i in range(3) for j in range(3)]
+
+
+def slot_file(inputfile, slot):
+    """
+    Name of the file of a CCD, from the name of the file of the first CCD (slot 00).
+    :param inputfile: name of the first file
+    :param slot: slot of the CCD ('00' to '22')
+    :return: string
+    """
+    # if there is "00" elsewhere in the file name, modify as appropriate
+    if '00_0_' in inputfile:  # new numbering scheme from eTraveler
+        return inputfile.replace("00_0", slot + '_' + slot[1:])
+    if '00_' in inputfile:
+        return inputfile.replace("00_", slot + '_', 1)
+    if 'S00' in inputfile:
+        return inputfile.replace("S00", 'S' + slot, 1)
+    if '00-' in inputfile:
+        return inputfile.replace("00-", slot + '-', 1)
+
+    raise ValueError('Unable to find the slot number in file name %s' % inputfile)
+
+
+def tree_file(slotdir, minsize=1e6):
+    """
+    Finds the image file in the directory of a CCD (one file per directory).
+    :param slotdir: directory of the CCD (S00 to S22)
+    :param minsize: minimum size of the file, to skip small auxiliary files
+    :return: path to the file, or None if there is none
+    """
+    for f in sorted(os.listdir(slotdir)):
+        if os.path.splitext(f)[1] in [".fits", ".fz"]:
+            path = os.path.join(slotdir, f)
+            if os.path.getsize(path) > minsize:
+                return path
+
+    return None
+
+
+def raft_files(inputfile='', datadir=''):
+    """
+    Paths to the files of all the CCDs of the raft, with their slots.
+    :param inputfile: the first file (for S00). Full path if datadir is not given.
+    If empty, the files are looked for in the S00 to S22 subdirectories of datadir.
+    :param datadir: directory where data is stored
+    :return: list of paths, list of slots (slots without a file in the tree structure are skipped)
+    """
+    raftfits = []
+    seglist = []
+    for slot in slot_ids():
+        if inputfile:
+            path = os.path.join(datadir, slot_file(inputfile, slot))
+        else:
+            path = tree_file(os.path.join(datadir, 'S%s' % slot))
+            if path is None:
+                continue
+        raftfits.append(path)
+        seglist.append(slot)
+
+    return raftfits, seglist
+
+
+def read_raft(raftfits, segments=range(16), rows=slice(None), cols=slice(None), threads=9):
+    """
+    Reads the region of interest of the given segments for all the CCD files, concurrently.
+    All files must have the same geometry and data type as the first one.
+    :param raftfits: list of paths to the CCD files
+    :param segments: segment numbers (0-15), in extensions 1 to 16
+    :param rows:
+    :param cols:
+    :param threads: number of files read at the same time
+    :return: np.array (CCD, segment, rows, columns)
+    """
+    segments = list(segments)
+    hdulist = fitsdata.open_fits(raftfits[0])
+    try:
+        shape, dtype = fitsdata.roi_layout(hdulist, segments[0] + 1, rows, cols)
+    finally:
+        hdulist.close()
+    data = np.empty((len(raftfits), len(segments)) + shape, dtype=dtype)
+
+    def read_ccd(num):
+        ccdlist = fitsdata.open_fits(raftfits[num])
+        try:
+            for iseg, seg in enumerate(segments):
+                data[num, iseg] = fitsdata.segment_roi(ccdlist, seg + 1, rows, cols)
+        finally:
+            ccdlist.close()
+
+    pool = ThreadPool(max(1, min(threads, len(raftfits))))
+    try:
+        pool.map(read_ccd, range(len(raftfits)))
+    finally:
+        pool.close()
+        pool.join()
+
+    return data
+
+
+def get_raft_data(inputfile='', datadir='', segments=range(16), rows=slice(None), cols=slice(None), threads=9):
+    """
+    Finds the raft files and reads them (see raft_files() and read_raft()).
+    :param inputfile: the first file (for S00), or empty for the tree structure
+    :param datadir: directory where data is stored
+    :param segments:
+    :param rows:
+    :param cols:
+    :param threads:
+    :return: np.array (CCD, segment, rows, columns), list of slots
+    """
+    raftfits, seglist = raft_files(inputfile, datadir)
+    if not raftfits:
+        raise ValueError('No raft file found in %s' % datadir)
+
+    return read_raft(raftfits, segments, rows, cols, threads), seglist
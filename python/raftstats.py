@@ -9,6 +9,9 @@ import astropy.io.fits as pyfits
 import numpy as np
 from matplotlib import pyplot as plt
 from matplotlib import colors as mplcol
+import fitsdata
+import raftdata
+import statscache
 
 def get_fits_raft(inputfile='', datadir=''):
     """
@@ -17,57 +20,49 @@ def get_fits_raft(inputfile='', datadir=''):
     :param inputfile: the first file (00_). Can also work with full path if datadir is not given.
     :return:
     """
-    # starts with 00 through 22
-    seglist = ["%d%d" % (i, j) for i in range(3) for j in range(3)]
-
-    # if all files in same directory
-    if inputfile:
-        if '00_0_' in inputfile:  # new numbering scheme from eTraveler
-            raftfits = [os.path.join(datadir, inputfile.replace("00_0", s + '_' + s[1:])) for s in seglist]
-        elif '00_' in inputfile:
-            raftfits = [os.path.join(datadir, inputfile.replace("00_", s + '_', 1)) for s in seglist]
-        else:
-            raftfits = [os.path.join(datadir, inputfile.replace("00-", s + '-', 1)) for s in seglist]
-    # tree structure
-    else:
-        raftfits = []
-        for segstr in seglist:
-            d = os.path.join(datadir, 'S%s' % segstr)
-            for f in os.listdir(d):
-                print(f)
-                if f[-4:] == 'fits' and os.stat(os.path.join(d, f)).st_size > 1e6:
-                    # one file per directory
-                    raftfits.append(os.path.join(d, f))
-                    break
+    # starts with 00 through 22, in the same directory or in a tree structure
+    raftfits, seglist = raftdata.raft_files(inputfile, datadir)
 
     return raftfits, seglist
 
 
 def repr_stats(fitsfile, recalc=False, ROI1rows=slice(100, 1900), ROI1cols=slice(20, 500),
-               ROI2rows=slice(100, 1900), ROI2cols=slice(540, 576)):
+               ROI2rows=slice(100, 1900), ROI2cols=slice(540, 576), cache=False):
     """
     String from statistics stored in extension headers or recalculated.
+    :param cache: recalculated statistics are kept in a sidecar file (see statscache),
+    for regions of interest given as slices
     :return:
     """
 
-    hdulist = pyfits.open(fitsfile)
     statstr = ""
-    if recalc:
+    if recalc and not (statscache.cacheable(ROI1rows, ROI1cols) and statscache.cacheable(ROI2rows, ROI2cols)):
+        # other indices (lists, arrays...): computed directly
+        hdulist = fitsdata.open_fits(fitsfile)
         for i in range(16):
             h = hdulist[i + 1].header
-            data = hdulist[i + 1].data
-            statstr += "%s %10.2f %10.2f %10.2f %8.2f\n" % (h['EXTNAME'], data[ROI1rows, ROI1cols].mean(),
-                                                            data[ROI1rows, ROI1cols].std(),
-                                                            data[ROI2rows, ROI2cols].mean(),
-                                                            data[ROI2rows, ROI2cols].std())
+            data1 = fitsdata.segment_roi(hdulist, i + 1, ROI1rows, ROI1cols)
+            data2 = fitsdata.segment_roi(hdulist, i + 1, ROI2rows, ROI2cols)
+            statstr += "%s %10.2f %10.2f %10.2f %8.2f\n" % (h['EXTNAME'], data1.mean(), data1.std(),
+                                                            data2.mean(), data2.std())
+        hdulist.close()
+
+    elif recalc:
+        # both ROIs in a single pass over each segment
+        tables = statscache.ccd_table(fitsfile, {'roi1': (ROI1rows, ROI1cols), 'roi2': (ROI2rows, ROI2cols)},
+                                      cache=cache)[0]
+        for roi1, roi2 in zip(tables['roi1'], tables['roi2']):
+            statstr += "%s %10.2f %10.2f %10.2f %8.2f\n" % (roi1['extname'], roi1['mean'], roi1['std'],
+                                                            roi2['mean'], roi2['std'])
 
     else:
+        hdulist = fitsdata.open_fits(fitsfile)
         for i in range(16):
             h = hdulist[i + 1].header
             statstr += "%s %10.2f %10.2f %10.2f %8.2f\n" % (h['EXTNAME'], h['AVERAGE'], h['STDEV'],h['AVGBIAS'], h['STDVBIAS'])
 
-    hdulist.close()
-    del hdulist
+        hdulist.close()
+        del hdulist
 
     return statstr
 
@@ -80,38 +75,47 @@ def print_header_stats(fitsfile, recalc=False):
     print(repr_stats(fitsfile, recalc=recalc))
 
 
-def plothisto_overscan(fitsfile, ROIrows=slice(100, 1900), ROIcols=slice(540, 576)):
+def plothisto_overscan(fitsfile, ROIrows=slice(100, 1900), ROIcols=slice(540, 576), cache=False):
     """
     Display distribution of data in overscan region for each channel of a CCD file.
     :param fitsfile:
+    :param cache: histograms are kept in a sidecar file (see statscache), for regions of
+    interest given as slices
     :return:
     """
-    hdulist = pyfits.open(fitsfile)
+    if statscache.cacheable(ROIrows, ROIcols):
+        # histograms accumulated while reading, one bin per value
+        tables, histograms = statscache.ccd_table(fitsfile, {'overscan': (ROIrows, ROIcols)}, cache=cache)
+        extnames = tables['overscan']['extname']
+        histograms = histograms['overscan']
+    else:
+        # other indices (lists, arrays...): histograms of the data
+        hdulist = fitsdata.open_fits(fitsfile)
+        extnames = [hdulist[i + 1].header['EXTNAME'] for i in range(16)]
+        histograms = []
+        for i in range(16):
+            d = fitsdata.segment_roi(hdulist, i + 1, ROIrows, ROIcols).flatten()
+            # one bin per value
+            histograms.append(np.histogram(d, max(int(np.amax(d) - np.amin(d)), 1)))
+        hdulist.close()
 
     fig, axes = plt.subplots(nrows = 4, ncols = 4, figsize=(13, 9))
     #color_idx = [plt.cm.jet(i) for i in np.linspace(0, 1, 16)]
 
     # single CCD plot
     for i in range(16):
-        h = hdulist[i + 1].header
-        d = hdulist[i + 1].data[ROIrows , ROIcols].flatten()
-        #print h['EXTNAME'], h['AVGBIAS'], d.mean(), h['STDVBIAS'], d.std()
+        counts, edges = histograms[i]
 
         ax = axes[i / 4, i % 4]
 
         # the histogram of the data
-        # one bin per value
-        num_bins = np.amax(d) - np.amin(d)
-        n, bins, patches = ax.hist(d, num_bins)
+        n, bins, patches = ax.hist((edges[:-1] + edges[1:]) / 2., edges, weights=counts)
         #print bins[num_bins/2 : num_bins/2 + 10]
         if i/4 == 3:
             ax.set_xlabel('ADU')
         if i%4 == 0:
             ax.set_ylabel('Number of pixels')
-        ax.set_title(h['EXTNAME'])
-
-    hdulist.close()
-    del hdulist
+        ax.set_title(extnames[i])
 
     datadir, dataname = os.path.split(fitsfile)
     dataname = os.path.splitext(dataname)[0]
@@ -119,17 +123,34 @@ def plothisto_overscan(fitsfile, ROIrows=slice(100, 1900), ROIcols=slice(540, 57
     plt.show()
 
 
-def average_1D_tofile(listfile, listsensor, datadir, axis, ROI, norm=False):
+def average_1D_tofile(listfile, listsensor, datadir, axis, ROI, norm=False, cache=False):
     """
     Output to file of frames averaging over one direction.
     0 = average over lines, stack for each column
     1 = average over columns, stack for each line
+    With cache, the profiles are kept in sidecar files (see statscache), for a ROI given as a slice.
     """
     outfile = open(os.path.join(datadir, 'average1D.txt'), 'w')
 
+    # profiles along the ROI, all lines or columns
+    if axis == 0:
+        rois = {'roi': (ROI, slice(None))}
+        profile = 'col'
+    else:
+        rois = {'roi': (slice(None), ROI)}
+        profile = 'row'
+
     for num, hfile in enumerate(listfile):
         try:
-            h = pyfits.open(os.path.join(datadir, hfile))
+            if statscache.cacheable(*rois['roi']):
+                table = statscache.ccd_table(os.path.join(datadir, hfile), rois, cache=cache)[0]['roi']
+                linedata = table[profile + 'mean']
+                linestd = table[profile + 'std']
+            else:
+                # other indices (lists, arrays...): computed directly
+                data = fitsdata.read_segments(os.path.join(datadir, hfile), range(16), *rois['roi'])
+                linedata = data.mean(axis=axis + 1)
+                linestd = data.std(axis=axis + 1)
         except:
             continue
 
@@ -137,18 +158,9 @@ def average_1D_tofile(listfile, listsensor, datadir, axis, ROI, norm=False):
             outfile.write('%s-%02d\t\t' % (listsensor[num], channel))
         outfile.write('\n')
 
-        #print h[1].data.shape
-        imax = h[1].data.shape[0 if axis else 1]
-        linedata = np.zeros((16, imax))
-        linestd = np.zeros((16, imax))
+        imax = linedata.shape[1]
 
         for channel in range(16):
-            if axis == 0:
-                linedata[channel, :] = h[channel + 1].data[ROI, :].mean(axis=axis)
-                linestd[channel, :] = h[channel + 1].data[ROI, :].std(axis=axis)
-            else:
-                linedata[channel, :] = h[channel + 1].data[:, ROI].mean(axis=axis)
-                linestd[channel, :] = h[channel + 1].data[:, ROI].std(axis=axis)
             # option to normalize
             if norm:
                 linedata[channel, :] = linedata[channel, :] - linedata[channel, -30:].mean()
@@ -158,8 +170,6 @@ def average_1D_tofile(listfile, listsensor, datadir, axis, ROI, norm=False):
                 outfile.write("%.2f\t%.2f\t" % (linedata[channel, i], linestd[channel, i] ))
             outfile.write('\n')
 
-        h.close()
-        del h
     outfile.close()
 
 
@@ -197,10 +207,13 @@ def average_1D_toplot(fitsfile, datadir, axis, ROIlines, ROIcols, norm=False, ti
     plt.show()
 
 
-def roistats_raft(raftsfits, ROIrows=slice(100, 1900), ROIcols=slice(530, 576)):
+def roistats_raft(raftsfits, ROIrows=slice(100, 1900), ROIcols=slice(530, 576), headers=None, cache=False):
     """
     Statistics in ROI for raft.
     :param raftsfits: file list
+    :param headers: to use the header values instead when present, statscache.image_keywords
+    or statscache.overscan_keywords
+    :param cache: statistics are kept in sidecar files (see statscache)
     :return:
     """
     allmean = np.zeros(16 * len(raftsfits))
@@ -208,14 +221,11 @@ def roistats_raft(raftsfits, ROIrows=slice(100, 1900), ROIcols=slice(530, 576)):
 
     for num, fl in enumerate(raftsfits):
         try:
-            h = pyfits.open(fl)
+            means, stds = statscache.roi_stats(fl, ROIrows, ROIcols, headers=headers, cache=cache)
         except:
             continue
-        for i in range(1, 17):
-            allmean[num * 16 + i - 1] = h[i].data[ROIrows, ROIcols].mean()
-            allstd[num * 16 + i - 1] = h[i].data[ROIrows, ROIcols].std()
-        h.close()
-        del h
+        allmean[num * 16:(num + 1) * 16] = means
+        allstd[num * 16:(num + 1) * 16] = stds
 
     return allmean, allstd
 
@@ -230,12 +240,9 @@ def corrcoef_raft(raftsfits, ROIrows=slice(10, 1990), ROIcols=slice(512, 521)):
     #nccd = len(raftsfits)
 
     for fl in raftsfits:
-        h = pyfits.open(fl)
-        for i in range(1, 17):
-            stackh.append(h[i].data[ROIrows, ROIcols].ravel())
-        h.close()
-        del h
-    stackh = np.stack(stackh)
+        roidata = fitsdata.read_segments(fl, range(16), ROIrows, ROIcols)
+        stackh.append(roidata.reshape(16, -1))
+    stackh = np.concatenate(stackh)
 
     a = np.corrcoef(stackh)
     # a.shape is (nccd * 16, nccd * 16)
@@ -285,7 +292,7 @@ if __name__ == '__main__':
             #outstats.write(f+'\n')
             #print_header_stats(f)
             #plothisto_overscan(f)
-            outstats.write(repr_stats(f, True))
+            outstats.write(repr_stats(f, True, cache=True))
 
     outstats.close()
 
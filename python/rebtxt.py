@@ -7,6 +7,7 @@
 from __future__ import print_function
 from sequencer import *
 import grammar
+import seqcache
 
 class TxtParser(object):
 
@@ -175,6 +176,7 @@ class TxtParser(object):
             if self.verbose:
                 print(channel_position)
             self.functions_desc[name]['clocks'] = func['clocks']  # list of active channels
+            self.functions_desc[name]['nslices'] = len(func['slices'])  # before truncation to 16
 
             # self.timelengths = {0: 12, 1: 14}
             # self.outputs = {0: '0b01001101...', 1: '0b1111000...', ... }
@@ -183,6 +185,10 @@ class TxtParser(object):
 
             islice = 0
             for timeslice in func['slices']:
+                if islice > 15:
+                    print('Warning: too many slices in function %s' % name)
+                    break
+
                 duration = self.process_value(timeslice[0])
 
                 if islice == 0:
@@ -214,9 +220,6 @@ class TxtParser(object):
                 outputs[islice] = output
 
                 islice += 1
-                if islice > 15:
-                    print('Warning: too many slices in function %s' % name)
-                    break
 
             function.timelengths = dict(timelengths)
             function.outputs = dict(outputs)
@@ -422,11 +425,18 @@ class TxtParser(object):
 
 # @classmethod
 # def fromxmlfile(cls, xmlfile):
-def fromtxtfile(txtfile, verbose=True):
+def fromtxtfile(txtfile, verbose=True, cache=False):
     """
     Create and return a Sequencer instance from a text file.
     Raise an exception if the syntax is wrong.
+    If cache is set, re-uses the compiled instance stored in the on-disk cache
+    (see seqcache) as long as neither the file nor its includes have changed.
     """
+    if cache:
+        key = seqcache.cache_key(txtfile)
+        seq = seqcache.load(key)
+        if seq is not None:
+            return seq
 
     functions = {}
     parameters = {}
@@ -465,6 +475,9 @@ def fromtxtfile(txtfile, verbose=True):
                     parameters=parameters,
                     pointers=prg.seq_pointers)
 
+    if cache:
+        seqcache.store(key, seq)
+
     return seq
 
 
@@ -28,6 +28,7 @@ from matplotlib import pyplot as plt
 
 # add sequencer reading method
 import rebtxt
+import fitsdata
 
 # global for path to sequencer file
 seqpath = "/Users/nayman/Documents/REB/TS8/sequencer-files"
@@ -54,6 +55,72 @@ def set_legend_outside(ax):
     plt.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.)
 
 
+class RawScan(object):
+    """
+    Lazy (channel, line, column) view of a raw REB scan file (.dat), memory-mapped.
+    Values are set straight for 18-bit data only for the channels, lines and columns that are indexed.
+    """
+    # number of scan lines converted at once
+    chunk_lines = 1024
+
+    def __init__(self, filename, nchannels=48, ncolumns=256):
+        """
+        :param filename:
+        :param nchannels: number of channels in the file (48 for a full REB)
+        :param ncolumns: number of columns (time increments) of a scan line
+        """
+        buff = np.memmap(filename, dtype=np.dtype('i4'), mode='r')
+        # temporary fix for missing last pixel
+        nlines = buff.shape[0] // (ncolumns * nchannels)
+        # samples of the channels are interleaved
+        self.raw = buff[:nlines * ncolumns * nchannels].reshape(nlines, ncolumns, nchannels)
+        self.shape = (nchannels, nlines, ncolumns)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self):
+        return self[:]
+
+    def __getitem__(self, key):
+        """
+        Indexing as for a (channel, line, column) array, with integers, slices or lists.
+        :param key:
+        :return: np.array
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 3:
+            raise IndexError('Too many indices for scan data')
+        key = key + (slice(None),) * (3 - len(key))
+
+        # selected indexes along each axis, and axes to drop
+        indexes = []
+        scalar = []
+        for axis, k in enumerate(key):
+            idx = np.arange(self.shape[axis])[k]
+            scalar.append(np.ndim(idx) == 0)
+            indexes.append(np.atleast_1d(idx))
+        chans, lines, cols = indexes
+
+        chandata = np.empty((len(chans), len(lines), len(cols)), dtype=self.raw.dtype)
+        for i in range(0, len(lines), self.chunk_lines):
+            chunk = lines[i:i + self.chunk_lines]
+            if np.all(np.diff(chunk) == 1):
+                # contiguous increasing lines: no copy of the mapped data before selection
+                block = self.raw[chunk[0]:chunk[-1] + 1]
+            else:
+                block = self.raw[chunk]
+            # for 18-bit data:
+            # negative numbers are translated, sign is inverted on all data, also make all values positive
+            # 0 -> 1FFFF, 1FFFF -> 0, 20000 -> 3FFFF, 3FFFF -> 20000
+            # this works by XORing the lowest 17 bits
+            selected = np.bitwise_xor(block[np.ix_(np.arange(len(chunk)), cols, chans)], 0x1FFFF)
+            chandata[:, i:i + len(chunk), :] = np.transpose(selected, (2, 0, 1))  # puts the channel as first axis
+
+        return chandata[tuple([0 if s else slice(None) for s in scalar])]
+
+
 def get_scandata_fromfile(inputfile, datadir='', selectchannels=None):
     """
     Reads data from the file, sets it straight if raw values, returns 3D array of (scan-)image data.
@@ -69,15 +136,8 @@ def get_scandata_fromfile(inputfile, datadir='', selectchannels=None):
         else:
             displayamps = selectchannels
 
-        hdulist = fits.open(os.path.join(datadir, inputfile))
-        imgdata = []
-        for i in displayamps:
-            imgdata.append(hdulist[i + 1].data)
-            #print hdulist[i+1].data.shape
-        hdulist.close()
-        del hdulist  # clean-up
-
-        chandata = np.stack(imgdata)
+        # only the selected extensions are read
+        chandata = fitsdata.read_segments(os.path.join(datadir, inputfile), displayamps)
 
     else:
         nchannels = 48
@@ -86,20 +146,8 @@ def get_scandata_fromfile(inputfile, datadir='', selectchannels=None):
         else:
             displayamps = selectchannels
 
-        dt = np.dtype('i4')
-        buff = np.fromfile(os.path.join(datadir, inputfile), dtype=dt)
-        # for 18-bit data:
-        # negative numbers are translated, sign is inverted on all data, also make all values positive
-        # 0 -> 1FFFF, 1FFFF -> 0, 20000 -> 3FFFF, 3FFFF -> 20000
-        # this works by XORing the lowest 17 bits
-        rawdata = np.bitwise_xor(buff, 0x1FFFF)
-        # reshape by channel
-        length = rawdata.shape[0] / nchannels
-        # temporary fix for missing last pixel
-        rawdata = rawdata[:256 * (length/256) * nchannels]
-        rawdata = rawdata.reshape(length/256, 256, nchannels)  # assumes this is a scan image
-
-        chandata = np.transpose(rawdata[:, :, displayamps], (2, 0, 1))  # puts the channel as first axis
+        # assumes this is a scan image, only the selected channels are read
+        chandata = RawScan(os.path.join(datadir, inputfile), nchannels)[list(displayamps)]
         # TODO: match the order from the fits file
 
     #print chandata.shape
@@ -140,12 +188,11 @@ def plot_scan_states(ax, seq, readfunction, offset=0, extend=1, marktransitions=
 
     # creates waveform for each clock with matching timing
     clocktransitions = np.array([0, 255 + 256 * (extend - 1)])  # add boundaries of scan
+    scantimeline = funcscope.timeline().repeat(3 * extend).slice(offset, offset + 256 * extend)
     for i, clock in enumerate(clocklist):
         clockline = seq.channels[clock]
-        states = funcscope.scope(clockline)
-        scanstates = np.tile(np.array(states), 3 * extend)[offset:offset + 256 * extend]
-        #print find_transition_index(scanstates)
-        clocktransitions = np.concatenate((clocktransitions, find_transition_index(scanstates)))
+        scanstates = scantimeline.states([clockline])[0]
+        clocktransitions = np.concatenate((clocktransitions, scantimeline.transitions(clockline)))
         ax.plot(scanstates * 0.8 + i, drawstyle='steps-post')
 
     # setups X-axis
@@ -173,7 +220,7 @@ def sequencer_display(seqfile, readout='Acquisition', trigname='TRG'):
     """
 
     # gets sequencer object
-    seq = rebtxt.Sequencer.fromtxtfile(os.path.join(seqpath, seqfile), verbose=False)
+    seq = rebtxt.Sequencer.fromtxtfile(os.path.join(seqpath, seqfile), verbose=False, cache=True)
 
     # finds the function used for readout if given the Main
     if readout in seq.functions_desc:
@@ -294,7 +341,7 @@ def combined_scope_display(dsifile, tmfile, seqfile, c, readout='ReadPixel', dat
         tmscope = None
 
     # gets sequencer object
-    seq = rebtxt.Sequencer.fromtxtfile(os.path.join(seqpath, seqfile), verbose=False)
+    seq = rebtxt.Sequencer.fromtxtfile(os.path.join(seqpath, seqfile), verbose=False, cache=True)
 
     # finds the function used for readout if given the Main
     if readout in seq.functions_desc:
@@ -625,7 +672,7 @@ def plot_long_scan(scanfile, niter, datadir='', seqfile='', readfunction="ReadPi
     tmscope = stitch_long_scan(scanfile, niter, datadir, displayamps)
 
     # gets sequencer object
-    seq = rebtxt.Sequencer.fromtxtfile(os.path.join(seqpath, seqfile), verbose=False)
+    seq = rebtxt.Sequencer.fromtxtfile(os.path.join(seqpath, seqfile), verbose=False, cache=True)
 
     colors = [plt.cm.jet(i) for i in np.linspace(0, 1, nchan)]
 
@@ -0,0 +1,349 @@
+#
+# LSST
+# Single-pass statistics of regions of interest of CCD segments
+#
+# Each segment is read once, by chunks of rows (memory-mapped or from the tiles covering
+# the rows, see fitsdata.py), and every chunk updates the statistics of all the regions of
+# interest at once: count, mean, variance, min, max, histogram (one bin per ADU for integer
+# data), median estimated from the histogram, and profiles along the rows and columns.
+# Sums and sums of squares are accumulated column by column on data shifted by the mean
+# of the first chunk, which keeps the variances accurate (and the sums exact for integer
+# data), and are reduced to the statistics of the whole ROI at the end.
+#
+# Syntax in a script:
+# import segstats
+# rois = {'image': (slice(100, 1900), slice(20, 500)), 'overscan': (slice(100, 1900), slice(540, 576))}
+# table, histograms = segstats.raft_table(raftfits, rois, ccdnames=seglist)
+# print(table['overscan']['mean'], table['overscan']['std'])
+from __future__ import print_function
+import os
+import numpy as np
+
+import fitsdata
+
+# default number of rows read at once: each read of tile-compressed data has a large
+# fixed cost, so these are read by much larger chunks
+default_chunk_rows = 256
+default_compressed_chunk_rows = 2048
+
+# maximum number of bins of histograms, beyond which bins are merged by pairs, and
+# number of bins over the range of the first chunk for floating point data
+default_max_bins = 1 << 16
+default_float_bins = 1024
+
+
+class Histogram(object):
+    """
+    Histogram built chunk by chunk, with bins of equal width. For integer data, bins are
+    one value wide at first; for floating point data, the first chunk sets the width. The
+    range is extended as needed, and bins are merged by pairs beyond max_bins.
+    """
+
+    def __init__(self, integer=True, max_bins=default_max_bins, float_bins=default_float_bins):
+        """
+        :param integer: if the data are integer values
+        :param max_bins: maximum number of bins
+        :param float_bins: number of bins over the range of the first chunk, for floating point data
+        """
+        self.integer = integer
+        self.max_bins = max_bins
+        self.float_bins = float_bins
+        self.counts = np.zeros(0, dtype=np.int64)
+        # lower edge of the first bin and width of the bins
+        self.base = None
+        self.width = None
+
+    def add(self, values, lo=None, hi=None):
+        """
+        :param values: np.array
+        :param lo: minimum of the values, if already known
+        :param hi: maximum of the values, if already known
+        :return:
+        """
+        if values.size == 0:
+            return
+        values = values.ravel()
+        if lo is None or hi is None:
+            lo, hi = values.min(), values.max()
+        lo, hi = float(lo), float(hi)
+        if self.base is None:
+            if self.integer:
+                # integer values at the center of the bins
+                self.base, self.width = lo - 0.5, 1.
+            else:
+                self.base, self.width = lo, (hi - lo) / self.float_bins if hi > lo else 1.
+
+        if lo < self.base:
+            before = int(np.ceil((self.base - lo) / self.width))
+            self.counts = np.concatenate((np.zeros(before, dtype=np.int64), self.counts))
+            self.base -= before * self.width
+        after = int((hi - self.base) // self.width) + 1 - len(self.counts)
+        if after > 0:
+            self.counts = np.concatenate((self.counts, np.zeros(after, dtype=np.int64)))
+        while len(self.counts) > self.max_bins:
+            if len(self.counts) % 2:
+                self.counts = np.concatenate((self.counts, [0]))
+            self.counts = self.counts.reshape(-1, 2).sum(axis=1)
+            self.width *= 2
+
+        if self.integer:
+            # exact, the first bin starts at an integer value and widths are powers of 2
+            bins = np.subtract(values, int(self.base + 0.5), dtype=np.int64)
+            if self.width > 1:
+                bins >>= int(np.log2(self.width))
+        else:
+            bins = np.clip(((values - self.base) // self.width).astype(np.int64), 0, len(self.counts) - 1)
+        self.counts += np.bincount(bins, minlength=len(self.counts))
+
+    def edges(self):
+        """
+        :return: bin edges (np.array)
+        """
+        if self.base is None:
+            return np.zeros(0)
+
+        return self.base + np.arange(len(self.counts) + 1) * self.width
+
+    def median(self):
+        """
+        Median interpolated in the histogram, within a bin width (for integer data with
+        one-value bins, within half the difference of the two middle values).
+        :return: float
+        """
+        if not self.counts.sum():
+            return np.nan
+        edges = self.edges()
+        cumul = np.cumsum(self.counts)
+        half = cumul[-1] / 2.
+        k = np.searchsorted(cumul, half)
+        before = cumul[k - 1] if k else 0
+
+        return edges[k] + (half - before) / float(self.counts[k]) * (edges[k + 1] - edges[k])
+
+
+class RoiAccumulator(object):
+    """
+    Statistics of a region of interest of a segment, updated chunk of rows by chunk of rows.
+    """
+
+    def __init__(self, rows, cols, height, width, integer=True):
+        """
+        :param rows: slice of rows, with positive step
+        :param cols: slice of columns, with positive step
+        :param height: number of rows of the segment
+        :param width: number of columns of the segment
+        :param integer: if the data are integer values
+        """
+        self.rows = rows.indices(height)
+        self.cols = cols.indices(width)
+        if self.rows[2] <= 0 or self.cols[2] <= 0:
+            raise ValueError('Regions of interest must have positive steps')
+        ncols = len(range(*self.cols))
+
+        self.integer = integer
+        # sums are accumulated on data shifted by the mean of the first chunk, rounded for
+        # integer data so that the sums are exact
+        self.shift = None
+        self.nrows = 0
+        self.colsum = np.zeros(ncols)
+        self.colsqsum = np.zeros(ncols)
+        self.minval = np.inf
+        self.maxval = -np.inf
+        self.rowmean = []
+        self.rowstd = []
+        self.histogram = Histogram(integer)
+
+    def chunk_rows(self, r0, r1):
+        """
+        Rows of the ROI in the chunk of rows [r0, r1), relative to the chunk.
+        :param r0:
+        :param r1:
+        :return: slice, or None if there is none
+        """
+        start, stop, step = self.rows
+        first = start + max(0, -(-(r0 - start) // step)) * step
+        last = min(stop, r1)
+        if first >= last:
+            return None
+
+        return slice(first - r0, last - r0, step)
+
+    def add(self, block, r0, c0):
+        """
+        Updates the statistics with a chunk of rows.
+        :param block: 2D np.array, rows from r0, columns from c0
+        :param r0: first row of the chunk
+        :param c0: first column of the chunk
+        :return:
+        """
+        rows = self.chunk_rows(r0, r0 + len(block))
+        if rows is None:
+            return
+        raw = block[rows, self.cols[0] - c0:self.cols[1] - c0:self.cols[2]]
+        if raw.size == 0:
+            # no columns in the ROI
+            self.rowmean.append(np.full(len(raw), np.nan))
+            self.rowstd.append(np.full(len(raw), np.nan))
+            return
+        lo, hi = raw.min(), raw.max()
+        self.minval = min(self.minval, lo)
+        self.maxval = max(self.maxval, hi)
+        self.histogram.add(raw, lo, hi)
+
+        if self.shift is None:
+            self.shift = raw.mean(dtype=np.float64)
+            if self.integer:
+                self.shift = np.floor(self.shift)
+        data = np.subtract(raw, self.shift, dtype=np.float64)
+        squares = data * data
+        ncols = data.shape[1]
+
+        # profiles: the rows are complete in the chunk
+        rowsum = data.sum(axis=1)
+        self.rowmean.append((rowsum + self.shift * ncols) / ncols)
+        self.rowstd.append(np.sqrt(np.maximum(squares.sum(axis=1) / ncols - (rowsum / ncols) ** 2, 0)))
+
+        self.colsum += data.sum(axis=0)
+        self.colsqsum += squares.sum(axis=0)
+        self.nrows += len(data)
+
+    def result(self):
+        """
+        :return: dict of statistics: count, mean, var, std, min, max, median, rowmean, rowstd,
+        colmean, colstd, histogram (counts), edges
+        """
+        ncols = len(self.colsum)
+        count = self.nrows * ncols
+        if count == 0:
+            mean = var = np.nan
+            colmean = colstd = np.full(ncols, np.nan)
+        else:
+            mean = (self.colsum.sum() + self.shift * count) / count
+            var = max(self.colsqsum.sum() / count - (self.colsum.sum() / count) ** 2, 0)
+            colmean = (self.colsum + self.shift * self.nrows) / self.nrows
+            colstd = np.sqrt(np.maximum(self.colsqsum / self.nrows - (self.colsum / self.nrows) ** 2, 0))
+
+        if self.rowmean:
+            rowmean, rowstd = np.concatenate(self.rowmean), np.concatenate(self.rowstd)
+        else:
+            rowmean = rowstd = np.zeros(0)
+
+        return {'count': count, 'mean': mean, 'var': var, 'std': np.sqrt(var),
+                'min': self.minval if count else np.nan, 'max': self.maxval if count else np.nan,
+                'median': self.histogram.median(),
+                'rowmean': rowmean, 'rowstd': rowstd, 'colmean': colmean, 'colstd': colstd,
+                'histogram': self.histogram.counts, 'edges': self.histogram.edges()}
+
+
+def segment_stats(hdulist, ext, rois, chunk_rows=None):
+    """
+    Statistics of several regions of interest of a segment, in a single pass over the data.
+    :param hdulist: from fitsdata.open_fits()
+    :param ext: extension number
+    :param rois: dict name: (rows, cols), slices with positive steps
+    :param chunk_rows: number of rows read at once, default depends on the compression
+    :return: dict name: dict of statistics (see RoiAccumulator.result())
+    """
+    (height, width), dtype = fitsdata.roi_layout(hdulist, ext)
+    integer = dtype.kind in 'iu'
+    accumulators = dict((name, RoiAccumulator(rows, cols, height, width, integer))
+                        for name, (rows, cols) in rois.items())
+    if not accumulators:
+        return {}
+
+    # rows and columns covering all the regions of interest
+    r0 = min(acc.rows[0] for acc in accumulators.values())
+    r1 = max(acc.rows[1] for acc in accumulators.values())
+    c0 = min(acc.cols[0] for acc in accumulators.values())
+    c1 = max(acc.cols[1] for acc in accumulators.values())
+
+    read = fitsdata.segment_reader(hdulist, ext)
+    if chunk_rows is None:
+        if hdulist[ext].header.get('ZIMAGE', False):
+            chunk_rows = default_compressed_chunk_rows
+        else:
+            chunk_rows = default_chunk_rows
+    for start in range(r0, r1, chunk_rows):
+        stop = min(start + chunk_rows, r1)
+        # chunks without rows of interest are not read
+        if all(acc.chunk_rows(start, stop) is None for acc in accumulators.values()):
+            continue
+        block = read(slice(start, stop), slice(c0, max(c0, c1)))
+        for acc in accumulators.values():
+            acc.add(block, start, c0)
+
+    return dict((name, acc.result()) for name, acc in accumulators.items())
+
+
+def table_dtype(nrows, ncols):
+    """
+    Structured data type of a row of the statistics table.
+    :param nrows: number of rows of the ROI (length of the row profiles)
+    :param ncols: number of columns of the ROI (length of the column profiles)
+    :return: np.dtype
+    """
+    return np.dtype([('ccd', 'S16'), ('segment', 'i2'), ('extname', 'S16'), ('count', 'i8'),
+                     ('mean', 'f8'), ('std', 'f8'), ('var', 'f8'), ('min', 'f8'), ('max', 'f8'),
+                     ('median', 'f8'), ('rowmean', 'f8', (nrows,)), ('rowstd', 'f8', (nrows,)),
+                     ('colmean', 'f8', (ncols,)), ('colstd', 'f8', (ncols,))])
+
+
+def ccd_table(fitsfile, rois, segments=range(16), ccdname='', chunk_rows=None):
+    """
+    Statistics table of the segments of a CCD file.
+    :param fitsfile:
+    :param rois: dict name: (rows, cols)
+    :param segments: segment numbers (0-15), in extensions 1 to 16
+    :param ccdname: for the 'ccd' column of the table
+    :param chunk_rows: number of rows read at once, default depends on the compression
+    :return: dict name: structured np.array (one row per segment, see table_dtype()),
+    dict name: list of (counts, edges) histograms, one per segment
+    """
+    segments = list(segments)
+    hdulist = fitsdata.open_fits(fitsfile)
+    try:
+        tables = {}
+        histograms = {}
+        for name, (rows, cols) in rois.items():
+            nrows, ncols = fitsdata.roi_layout(hdulist, segments[0] + 1, rows, cols)[0]
+            tables[name] = np.zeros(len(segments), dtype=table_dtype(nrows, ncols))
+            histograms[name] = []
+
+        for num, seg in enumerate(segments):
+            stats = segment_stats(hdulist, seg + 1, rois, chunk_rows)
+            extname = hdulist[seg + 1].header.get('EXTNAME', '')
+            for name in rois:
+                table = tables[name]
+                table['ccd'][num], table['segment'][num], table['extname'][num] = ccdname, seg, extname
+                for field in table.dtype.names[3:]:
+                    table[field][num] = stats[name][field]
+                histograms[name].append((stats[name]['histogram'], stats[name]['edges']))
+    finally:
+        hdulist.close()
+
+    return tables, histograms
+
+
+def raft_table(raftfits, rois, ccdnames=None, segments=range(16), chunk_rows=None):
+    """
+    Statistics table of the segments of all the CCD files of a raft.
+    :param raftfits: list of paths to the CCD files
+    :param rois: dict name: (rows, cols)
+    :param ccdnames: names of the CCDs for the table, file names if None
+    :param segments: segment numbers (0-15)
+    :param chunk_rows: number of rows read at once, default depends on the compression
+    :return: dict name: structured np.array (CCD by CCD, segment by segment),
+    dict name: list of (counts, edges) histograms
+    """
+    if ccdnames is None:
+        ccdnames = [os.path.basename(f) for f in raftfits]
+
+    tables = dict((name, []) for name in rois)
+    histograms = dict((name, []) for name in rois)
+    for fitsfile, ccdname in zip(raftfits, ccdnames):
+        ccdtables, ccdhistograms = ccd_table(fitsfile, rois, segments, ccdname, chunk_rows)
+        for name in rois:
+            tables[name].append(ccdtables[name])
+            histograms[name].extend(ccdhistograms[name])
+
+    return dict((name, np.concatenate(tables[name])) for name in rois), histograms
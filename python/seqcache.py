@@ -0,0 +1,168 @@
+#
+# LSST
+# On-disk cache of compiled sequencer files
+#
+# A compiled Sequencer object is stored (pickled) under a key built from the content
+# of the sequencer file, of all the files it includes (recursively), and of the
+# compiler sources, so that any change in one of them gives a new key.
+# Least recently used entries are removed when the cache grows above maxsize.
+#
+# Syntax in a script:
+# import rebtxt
+# seq = rebtxt.Sequencer.fromtxtfile("seq-newflush.txt", verbose=False, cache=True)
+from __future__ import print_function
+import os
+import hashlib
+import pickle
+import tempfile
+
+import grammar
+
+# global for cache location and size bound (bytes)
+cachedir = os.path.join(os.path.expanduser('~'), '.cache', 'seqfiles')
+maxsize = 200 * 1024 * 1024
+
+# sources of the compiler and of the modules it imports (their classes end up in the
+# pickled objects): a change there invalidates all cached objects
+compiler_sources = ['grammar.py', 'rebtxt.py', 'sequencer.py', 'bidi.py', 'timeline.py']
+
+
+def include_tree(txtfile):
+    """
+    Lists the sequencer file and all the files it includes, recursively, in parsing order.
+    Included file names are resolved the same way as in grammar.parse_file().
+    :param txtfile:
+    :return: list of file names
+    """
+    tree = []
+    stack = [txtfile]
+
+    while stack:
+        fname = stack.pop()
+        if fname in tree:
+            # already there, no need to go through it again
+            continue
+        tree.append(fname)
+        stack.extend(reversed(grammar.parse_includes(fname)))
+
+    return tree
+
+
+def cache_key(txtfile):
+    """
+    Hash of the content of the sequencer file, of its includes, and of the compiler sources.
+    :param txtfile:
+    :return: string
+    """
+    h = hashlib.sha1()
+
+    srcdir = os.path.dirname(os.path.abspath(__file__))
+    for src in compiler_sources:
+        srcfile = open(os.path.join(srcdir, src), 'rb')
+        h.update(srcfile.read())
+        srcfile.close()
+
+    for fname in include_tree(txtfile):
+        h.update(fname.encode('utf-8'))
+        sfile = open(fname, 'rb')
+        h.update(sfile.read())
+        sfile.close()
+
+    return h.hexdigest()
+
+
+def cache_file(key):
+    return os.path.join(cachedir, key + '.pkl')
+
+
+def load(key):
+    """
+    Returns the cached object for the key, or None if not in cache.
+    :param key:
+    :return:
+    """
+    fname = cache_file(key)
+    try:
+        cfile = open(fname, 'rb')
+    except IOError:
+        return None
+
+    try:
+        obj = pickle.load(cfile)
+    except Exception:
+        # corrupted or incompatible entry: will be overwritten
+        obj = None
+    cfile.close()
+
+    if obj is not None:
+        # marks as recently used (not possible in a read-only cache)
+        try:
+            os.utime(fname, None)
+        except OSError:
+            pass
+
+    return obj
+
+
+def store(key, obj):
+    """
+    Stores the object in the cache, then evicts old entries if needed.
+    Failures to write (read-only or full disk) are ignored, the object is not cached.
+    :param key:
+    :param obj:
+    :return:
+    """
+    tmpname = None
+    try:
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+        # writes to a temporary file first so that readers never see a partial entry
+        fd, tmpname = tempfile.mkstemp(dir=cachedir, suffix='.tmp')
+        cfile = os.fdopen(fd, 'wb')
+        pickle.dump(obj, cfile, pickle.HIGHEST_PROTOCOL)
+        cfile.close()
+        os.rename(tmpname, cache_file(key))
+        tmpname = None
+
+        evict()
+    except (IOError, OSError):
+        if tmpname is not None and os.path.exists(tmpname):
+            os.remove(tmpname)
+
+
+def evict(size=None):
+    """
+    Removes least recently used entries until the cache size is below the given size (maxsize by default).
+    :param size:
+    :return:
+    """
+    if size is None:
+        size = maxsize
+
+    entries = []
+    for f in os.listdir(cachedir):
+        if f[-4:] != '.pkl':
+            continue
+        fname = os.path.join(cachedir, f)
+        st = os.stat(fname)
+        entries.append((st.st_mtime, st.st_size, fname))
+
+    total = sum([e[1] for e in entries])
+    for mtime, fsize, fname in sorted(entries):
+        if total <= size:
+            break
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
+        total -= fsize
+
+
+def clear():
+    """
+    Empties the cache.
+    :return:
+    """
+    if os.path.isdir(cachedir):
+        evict(0)
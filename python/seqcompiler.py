@@ -15,9 +15,14 @@
 
 import sys
 import os.path
+import errno
 import datetime
 
 import optparse
+import json
+import multiprocessing
+
+import numpy as np
 
 # from lsst.camera.generic.rebtxt import *
 from rebtxt import *
@@ -32,6 +37,84 @@ outputs_base_addr = 0x100000
 slices_base_addr  = 0x200000
 program_base_addr = 0x300000
 
+def compfile_lines(seq, seqfile):
+    """
+    Generates the lines (without end of line) of the text compiled file.
+    :param seq: Sequencer
+    :param seqfile: source file name
+    """
+    # Small header to described the file
+
+    yield "## LSST REB compiled sequencer file"
+    yield "## REB: REB5"
+    yield "## Source: %s" % seqfile
+    yield "## Compilation date: %s" % datetime.datetime.utcnow()
+    # yield "## Compiler: python seqcompiler %s" % version
+    yield "## Compiler: python seqcompiler %s" % version
+    yield "## Compiler authors: L. Le Guillou, C. Juramy"
+
+    # Now writing the functions
+
+    yield "## ======================================================"
+    yield "# [functions]"
+    yield "##"
+
+    for func_id in xrange(len(seq.functions)):
+        func = seq.functions[func_id]
+        yield "## ------------------------------------------------------"
+        yield "## function: #%d" % func_id
+        yield "##   name:  %s" % func.name
+        yield "##   description:  %s" % func.fullname
+        yield "##   execution time:  %d" % func.total_time()
+        yield "##"
+
+        for addr, value in func.iter_bytecode(func_id,
+                                              slices_base_addr = slices_base_addr,
+                                              outputs_base_addr = outputs_base_addr):
+            yield "0x%06x: 0x%08x" % (addr, value)
+
+    # Now writing the subroutines and mains
+
+    yield "## ======================================================"
+    yield "# [subroutines/mains]"
+    yield "##"
+
+    yield "## ------------------------------------------------------"
+
+    yield "## Main/Subroutine relative addresses"
+    yield "## (program base addr 0x300000)"
+    yield "## "
+    for name, reladdr in seq.program.subroutines.iteritems():
+        yield "# %s: 0x%06x" % (name, reladdr)
+
+    yield "## ------------------------------------------------------"
+
+    for addr, value in seq.program.iter_bytecode(program_base_addr = program_base_addr):
+        yield "0x%06x: 0x%08x" % (addr, value)
+
+    # Now writing the pointers
+
+    yield "## ======================================================"
+    yield "# [pointers]"
+    yield "##"
+
+    for name, ptr in seq.pointers.iteritems():
+        yield "0x%06x: 0x%06x   # %s:  %s" % (ptr.address,
+                                              ptr.value,
+                                              ptr.pointer_type,
+                                              ptr.name)
+
+    yield "## ======================================================"
+
+def compfile_bytes(seq, seqfile):
+    """
+    Content of the text compiled file, in memory (for a loader that does not need the file).
+    :param seq: Sequencer
+    :param seqfile: source file name
+    :return: str
+    """
+    return "".join([line + "\n" for line in compfile_lines(seq, seqfile)])
+
 def write_compfile(seq, seqfile, compname=''):
 
     # creating output name
@@ -42,88 +125,599 @@ def write_compfile(seq, seqfile, compname=''):
         if compfile == os.path.basename(seqfile):
             compfile = os.path.basename(seqfile) + ".compiled"
 
+    # single buffered write
     compf = open(compfile, "w")
+    compf.write(compfile_bytes(seq, seqfile))
+    compf.close()
 
-    # Small header to described the file
-
-    print >> compf, "## LSST REB compiled sequencer file"
-    print >> compf, "## REB: REB5"
-    print >> compf, "## Source:", seqfile
-    print >> compf, "## Compilation date:", datetime.datetime.utcnow()
-    # print >> compf, "## Compiler:", "python seqcompiler", version
-    print >> compf, "## Compiler:", "python seqcompiler", version
-    print >> compf, "## Compiler authors:", "L. Le Guillou, C. Juramy"
-
-    # Now writing the functions
+    return compfile
 
-    print >> compf, "## ======================================================"
-    print >> compf, "# [functions]"
-    print >> compf, "##"
+def compiled_image(seq):
+    """
+    Memory image of the compiled sequencer: same addresses and values as
+    written by write_compfile() (functions, program, then pointers).
+    :param seq: Sequencer
+    :return: dict address: value
+    """
+    image = {}
 
     for func_id in xrange(len(seq.functions)):
         func = seq.functions[func_id]
-        funcbc = func.bytecode(func_id,
-                               slices_base_addr = slices_base_addr,
-                               outputs_base_addr = outputs_base_addr)
-        print >> compf, "## ------------------------------------------------------"
-        print >> compf, "## function: #%d" % func_id
-        print >> compf, "##   name: ", func.name
-        print >> compf, "##   description: ", func.fullname
-        print >> compf, "##   execution time: ", func.total_time()
-        print >> compf, "##"
-
-        addrs = funcbc.keys()
-        addrs.sort()
-        for addr in addrs:
-            print >> compf, "0x%06x: 0x%08x" % (addr, funcbc[addr])
+        image.update(func.iter_bytecode(func_id,
+                                        slices_base_addr = slices_base_addr,
+                                        outputs_base_addr = outputs_base_addr))
 
-    # Now writing the subroutines and mains
+    image.update(seq.program.iter_bytecode(program_base_addr = program_base_addr))
 
-    print >> compf, "## ======================================================"
-    print >> compf, "# [subroutines/mains]"
-    print >> compf, "##"
+    for name, ptr in seq.pointers.iteritems():
+        image[ptr.address] = ptr.value
 
-    print >> compf, "## ------------------------------------------------------"
+    return image
 
-    print >> compf, "## Main/Subroutine relative addresses"
-    print >> compf, "## (program base addr 0x300000)"
-    print >> compf, "## "
-    for name, reladdr in seq.program.subroutines.iteritems():
-        print >> compf, "# %s: 0x%06x" % (name, reladdr)
+def changed_words(image, previous_image):
+    """
+    Memory words of the image that differ from the previously compiled image.
+    Words present only in the previous image are left out: they are not
+    overwritten by a full compilation either.
+    :param image: dict address: value
+    :param previous_image: dict address: value
+    :return: dict address: value
+    """
+    return dict((addr, value) for addr, value in image.iteritems()
+                if previous_image.get(addr) != value)
 
-    print >> compf, "## ------------------------------------------------------"
+def write_bursts(words):
+    """
+    Groups memory words into bursts of consecutive addresses.
+    :param words: dict address: value
+    :return: list of (start address, list of values), by increasing address
+    """
+    bursts = []
 
-    progbc = seq.program.bytecode(program_base_addr = program_base_addr)
-    addrs = progbc.keys()
+    addrs = words.keys()
     addrs.sort()
     for addr in addrs:
-        print >> compf, "0x%06x: 0x%08x" % (addr, progbc[addr])
+        if bursts and addr == bursts[-1][0] + len(bursts[-1][1]):
+            bursts[-1][1].append(words[addr])
+        else:
+            bursts.append((addr, [words[addr]]))
 
-    # Now writing the pointers
+    return bursts
 
-    print >> compf, "## ======================================================"
-    print >> compf, "# [pointers]"
-    print >> compf, "##"
+def incremental_compile(seq, previous_image):
+    """
+    Compiles the sequencer and lists the memory writes needed to go from the
+    previously compiled image to the new one.
+    :param seq: Sequencer
+    :param previous_image: dict address: value, as returned by compiled_image()
+    :return: new image, list of write bursts (see write_bursts())
+    """
+    image = compiled_image(seq)
 
-    ptrs = seq.pointers
+    return image, write_bursts(changed_words(image, previous_image))
 
-    for name, ptr in ptrs.iteritems():
-        print >> compf, "0x%06x: 0x%06x   # %s:  %s" % (ptr.address,
-                                                        ptr.value,
-                                                        ptr.pointer_type,
-                                                        ptr.name)
+# ========================================================================
+# Binary compiled image
+#
+# Little-endian layout:
+#   header: magic, format version, number of sections
+#   section table: section name, byte offset in the file, number of records
+#   sections 'outputs', 'slices', 'program', 'pointers': (address, value) uint32 pairs,
+#   by increasing address
+#   section 'symbols': names of the channels, functions, subroutines and pointers
+
+binary_magic = 'LSSTSEQB'
+binary_version = 1
+
+header_dtype = np.dtype([('magic', 'S8'), ('version', '<u4'), ('nsections', '<u4')])
+section_dtype = np.dtype([('name', 'S8'), ('offset', '<u4'), ('count', '<u4')])
+word_dtype = np.dtype([('address', '<u4'), ('value', '<u4')])
+# CHANNEL: address = channel number; FUNC: address = function id, size = number of slices;
+# SUBR: address = relative program address; pointers (by type): address = pointer address, size = value
+symbol_dtype = np.dtype([('kind', 'S8'), ('address', '<u4'), ('size', '<u4'), ('name', 'S48')])
+
+binary_sections = ['outputs', 'slices', 'program', 'pointers', 'symbols']
+
+def binary_records(seq):
+    """
+    Records of each section of the binary compiled image.
+    :param seq: Sequencer
+    :return: dict section name: np.array
+    """
+    image = compiled_image(seq)
+    addrs = np.array(sorted(image.keys()), dtype=np.uint32)
+    words = np.empty(len(addrs), dtype=word_dtype)
+    words['address'] = addrs
+    words['value'] = [image[addr] for addr in addrs]
+
+    records = {}
+    # sections by memory area
+    areas = addrs & 0xff0000
+    records['outputs'] = words[areas == outputs_base_addr]
+    records['slices'] = words[areas == slices_base_addr]
+    records['program'] = words[areas == program_base_addr]
+    records['pointers'] = words[areas > program_base_addr]
+
+    symbols = []
+    for c in seq.channels.dictionary:
+        if isinstance(c, int):
+            symbols.append(('CHANNEL', c, 0, seq.channels[c]))
+    for func_id in xrange(len(seq.functions)):
+        func = seq.functions[func_id]
+        symbols.append(('FUNC', func_id, func.nslices, func.name))
+    for name, reladdr in seq.program.subroutines.iteritems():
+        symbols.append(('SUBR', reladdr, 0, name))
+    for name, ptr in seq.pointers.iteritems():
+        symbols.append((ptr.pointer_type, ptr.address, ptr.value, name))
 
-    print >> compf, "## ======================================================"
+    for symbol in symbols:
+        if len(symbol[3]) > symbol_dtype['name'].itemsize:
+            raise ValueError('Name too long for the binary symbol table: %s' % symbol[3])
+    records['symbols'] = np.array(symbols, dtype=symbol_dtype)
 
-    compf.close()
+    return records
 
-    return compfile
+def write_binfile(seq, seqfile, compname=''):
+    """
+    Writes the binary compiled image of the sequencer (see CompiledImage to load it).
+    :param seq: Sequencer
+    :param seqfile: source file name
+    :param compname: output file name, by default derived from the source file name
+    :return: output file name
+    """
+    # creating output name
+    if compname:
+        binfile = compname
+    else:  # default name
+        binfile = os.path.basename(seqfile).replace(".seq", ".bin").replace(".txt", ".bin")
+        if binfile == os.path.basename(seqfile):
+            binfile = os.path.basename(seqfile) + ".bin"
+
+    records = binary_records(seq)
+
+    header = np.array([(binary_magic, binary_version, len(binary_sections))], dtype=header_dtype)
+    table = np.empty(len(binary_sections), dtype=section_dtype)
+    offset = header_dtype.itemsize + len(binary_sections) * section_dtype.itemsize
+    for i, name in enumerate(binary_sections):
+        table[i] = (name, offset, len(records[name]))
+        offset += records[name].nbytes
+
+    binf = open(binfile, "wb")
+    binf.write(header.tostring())
+    binf.write(table.tostring())
+    for name in binary_sections:
+        binf.write(records[name].tostring())
+    binf.close()
+
+    return binfile
+
+class CompiledImage(object):
+    """
+    Binary compiled image, memory-mapped: sections are read from the file
+    only when they are accessed.
+    """
+
+    def __init__(self, binfile):
+        self.binfile = binfile
+        self.data = np.memmap(binfile, dtype=np.uint8, mode='r')
+
+        header = self.data[:header_dtype.itemsize].view(header_dtype)[0]
+        if header['magic'] != binary_magic:
+            raise ValueError('Not a binary compiled sequencer file: %s' % binfile)
+        if header['version'] != binary_version:
+            raise ValueError('Unsupported binary compiled sequencer version %d in %s' %
+                             (header['version'], binfile))
+
+        tablestart = header_dtype.itemsize
+        tablestop = tablestart + header['nsections'] * section_dtype.itemsize
+        self.sections = {}
+        for name, offset, count in self.data[tablestart:tablestop].view(section_dtype):
+            if name == 'symbols':
+                dtype = symbol_dtype
+            else:
+                dtype = word_dtype
+            self.sections[name] = self.data[offset:offset + count * dtype.itemsize].view(dtype)
+
+    def __repr__(self):
+        return "CompiledImage: %s, %s" % (self.binfile,
+                                          ", ".join(["%d %s" % (len(self.sections[name]), name)
+                                                     for name in binary_sections]))
+
+    def image(self):
+        """
+        Memory image as a dictionary (see compiled_image()).
+        :return: dict address: value
+        """
+        image = {}
+        for name in binary_sections:
+            if name != 'symbols':
+                section = self.sections[name]
+                image.update(zip(section['address'].tolist(), section['value'].tolist()))
+
+        return image
+
+    def symbols(self, kind):
+        """
+        Symbols of the given kind.
+        :param kind: 'CHANNEL', 'FUNC', 'SUBR' or pointer type
+        :return: list of (address, size, name)
+        """
+        symbols = self.sections['symbols']
+        return zip(symbols['address'][symbols['kind'] == kind].tolist(),
+                   symbols['size'][symbols['kind'] == kind].tolist(),
+                   symbols['name'][symbols['kind'] == kind].tolist())
+
+    def channels(self):
+        """
+        :return: bidi.BidiMap of the channels
+        """
+        chans = self.symbols('CHANNEL')
+        return bidi.BidiMap([c for c, size, name in chans], [name for c, size, name in chans])
+
+    def function(self, func_id, channels=None):
+        """
+        Function as stored in the image. Its arrays are read-only views
+        on the file: use Function.copy() to modify it.
+        :param func_id:
+        :param channels: channel map, read from the image if None
+        :return: Function
+        """
+        if channels is None:
+            channels = self.channels()
+
+        for address, nslices, name in self.symbols('FUNC'):
+            if address == func_id:
+                break
+        else:
+            raise ValueError('No function %d in %s' % (func_id, self.binfile))
+
+        first = slices_base_addr | (func_id << 4)
+        islice = np.searchsorted(self.sections['slices']['address'], first)
+        first = outputs_base_addr | (func_id << 4)
+        ioutput = np.searchsorted(self.sections['outputs']['address'], first)
+
+        func = Function(name=name, channels=channels)
+        func.durations = self.sections['slices']['value'][islice:islice + 16].view(np.int32)
+        func.words = self.sections['outputs']['value'][ioutput:ioutput + 16]
+        if func_id == 0:
+            # only the first slice is stored for function #0
+            nslices = min(nslices, 1)
+        func.nslices = nslices
+
+        return func
+
+    def program(self):
+        """
+        Program decoded from the image.
+        :return: Program
+        """
+        prog = Program()
+        section = self.sections['program']
+        fields = Instruction.decode_array(section['value'])
+        for addr, instrfields in zip(section['address'].tolist(), fields):
+            prog.instructions[addr & ~program_base_addr] = Instruction.fromfields(instrfields)
+
+        for address, size, name in self.symbols('SUBR'):
+            prog.subroutines[name] = address
+        subroutines_names = dict((address, name) for name, address in prog.subroutines.iteritems())
+        for instr in prog.instructions.itervalues():
+            if instr.opcode in [Instruction.OP_JumpToSubroutine, Instruction.OP_JumpSubPointerRepeat]:
+                instr.subroutine = subroutines_names.get(instr.address)
+
+        return prog
+
+    def pointers(self):
+        """
+        Pointers stored in the image.
+        :return: dict name: SequencerPointer
+        """
+        ptrs = {}
+        for pointer_type in SequencerPointer.Pointer_types:
+            for address, value, name in self.symbols(pointer_type):
+                # bypasses the constructor, which allocates a new address
+                ptr = SequencerPointer.__new__(SequencerPointer)
+                ptr.pointer_type = pointer_type
+                ptr.name = name
+                ptr.address = address
+                ptr.value = value
+                ptr.target = ''
+                ptrs[name] = ptr
+
+        return ptrs
+
+    def sequencer(self):
+        """
+        Sequencer rebuilt from the image, with function arrays mapped from the file.
+        :return: Sequencer
+        """
+        channels = self.channels()
+        functions = {}
+        functions_desc = {}
+        for func_id, nslices, name in self.symbols('FUNC'):
+            functions[func_id] = self.function(func_id, channels)
+            functions_desc[name] = {'idfunc': func_id, 'function': functions[func_id]}
+
+        return Sequencer(channels=channels,
+                         channels_desc={},
+                         functions=functions,
+                         functions_desc=functions_desc,
+                         program=self.program(),
+                         parameters={},
+                         pointers=self.pointers())
+
+# ========================================================================
+# Readback verification
+
+def image_arrays(seq):
+    """
+    Memory image of the compiled sequencer as arrays sorted by address.
+    :param seq: Sequencer or CompiledImage
+    :return: addresses, values (np.array of uint32)
+    """
+    if isinstance(seq, CompiledImage):
+        words = np.concatenate([seq.sections[name] for name in binary_sections if name != 'symbols'])
+        words = np.sort(words, order='address')
+        return words['address'], words['value']
+
+    image = compiled_image(seq)
+    addresses = np.array(sorted(image.keys()), dtype=np.uint32)
+    values = np.array([image[addr] for addr in addresses], dtype=np.uint32)
+
+    return addresses, values
+
+def memory_owners(seq, addresses):
+    """
+    Names of what is stored at the given memory addresses: functions (by function id),
+    subroutines (by start address) and pointers (by address).
+    :param seq: Sequencer
+    :param addresses: np.array
+    :return: list of (memory area, owner name) for each address
+    """
+    areas = addresses & 0xff0000
+    func_ids = (addresses >> 4) & 0xf
+
+    # subroutine containing each program address: last one starting before
+    substarts = sorted([(reladdr, name) for name, reladdr in seq.program.subroutines.iteritems()])
+    subindex = np.searchsorted([reladdr for reladdr, name in substarts],
+                               addresses & ~program_base_addr, side='right') - 1
+
+    ptrnames = {}
+    for name in sorted(seq.pointers):
+        ptr = seq.pointers[name]
+        ptrnames.setdefault(ptr.address, []).append(name)
+
+    owners = []
+    for i, addr in enumerate(addresses.tolist()):
+        if areas[i] in [outputs_base_addr, slices_base_addr]:
+            func = seq.functions.get(int(func_ids[i]))
+            if areas[i] == outputs_base_addr:
+                area = 'outputs'
+            else:
+                area = 'slices'
+            if func is None:
+                owners.append((area, 'function #%d' % func_ids[i]))
+            else:
+                owners.append((area, 'function #%d %s' % (func_ids[i], func.name)))
+        elif areas[i] == program_base_addr:
+            if subindex[i] < 0:
+                owners.append(('program', 'program'))
+            else:
+                owners.append(('program', 'subroutine %s' % substarts[subindex[i]][1]))
+        else:
+            owners.append(('pointers', 'pointer %s' % ', '.join(ptrnames.get(addr, ['0x%06x' % addr]))))
+
+    return owners
+
+def verify_readback(seq, addresses, values=None):
+    """
+    Compares a readback of the REB memory with the compiled sequencer.
+    Only the addresses of the compiled image are checked; an address of the image
+    missing from the readback counts as a mismatch.
+    :param seq: Sequencer or CompiledImage
+    :param addresses: array of addresses read back, or dict address: value
+    (for instance a simulated memory, or CompiledImage.image())
+    :param values: array of values read back (None if addresses is a dict)
+    :return: list of mismatched regions (consecutive addresses with the same owner), as dictionaries:
+    start, stop (addresses), area, owner, expected (list of values), found (list of values, None if missing)
+    """
+    if values is None:
+        readback = addresses
+        addresses = np.array(readback.keys(), dtype=np.uint32)
+        values = np.array([readback[addr] for addr in addresses], dtype=np.uint32)
+    else:
+        addresses = np.asarray(addresses, dtype=np.uint32)
+        values = np.asarray(values, dtype=np.uint32)
+    order = np.argsort(addresses, kind='mergesort')
+    addresses = addresses[order]
+    values = values[order]
+
+    expaddrs, expvalues = image_arrays(seq)
+
+    # looks up each address of the image in the readback
+    index = np.minimum(np.searchsorted(addresses, expaddrs), max(len(addresses) - 1, 0))
+    if len(addresses):
+        present = addresses[index] == expaddrs
+        found = values[index]
+    else:
+        present = np.zeros(len(expaddrs), dtype=bool)
+        found = np.zeros(len(expaddrs), dtype=np.uint32)
+    mismatched = np.nonzero(~present | (found != expvalues))[0]
+    if len(mismatched) == 0:
+        return []
+
+    if isinstance(seq, CompiledImage):
+        seq = seq.sequencer()
+    owners = memory_owners(seq, expaddrs[mismatched])
+
+    regions = []
+    for i, owner in zip(mismatched.tolist(), owners):
+        addr = int(expaddrs[i])
+        if present[i]:
+            value = int(found[i])
+        else:
+            value = None
+        if regions and regions[-1]['stop'] == addr and (regions[-1]['area'], regions[-1]['owner']) == owner:
+            regions[-1]['stop'] = addr + 1
+            regions[-1]['expected'].append(int(expvalues[i]))
+            regions[-1]['found'].append(value)
+        else:
+            regions.append({'start': addr, 'stop': addr + 1, 'area': owner[0], 'owner': owner[1],
+                            'expected': [int(expvalues[i])], 'found': [value]})
+
+    return regions
+
+def readback_report(regions):
+    """
+    Text report of the mismatched regions from verify_readback().
+    :param regions:
+    :return: string
+    """
+    if not regions:
+        return "Readback matches the compiled image"
+
+    lines = []
+    for region in regions:
+        lines.append("0x%06x-0x%06x  %-8s %s: %d mismatched words" % (region['start'], region['stop'] - 1,
+                                                                    region['area'], region['owner'],
+                                                                    len(region['expected'])))
+
+    return "\n".join(lines)
+
+# ========================================================================
+# Batch compilation of directory trees
+
+def find_seqfiles(topdir):
+    """
+    Lists the sequencer files under the directory, in a deterministic order.
+    :param topdir:
+    :return: sorted list of paths relative to topdir
+    """
+    seqfiles = []
+    for dirpath, dirnames, filenames in os.walk(topdir):
+        dirnames.sort()
+        for fname in filenames:
+            if fname.endswith('.seq'):
+                seqfiles.append(os.path.relpath(os.path.join(dirpath, fname), topdir))
+
+    return sorted(seqfiles)
+
+def main_names(seq):
+    """
+    Names of the mains of the compiled program: subroutines terminated by END instead of RTS.
+    :param seq: Sequencer
+    :return: sorted list of names
+    """
+    mains = []
+    for name, addr in seq.program.subroutines.iteritems():
+        while addr in seq.program.instructions:
+            opcode = seq.program.instructions[addr].opcode
+            if opcode == Instruction.OP_EndOfProgram:
+                mains.append(name)
+            if opcode in [Instruction.OP_EndOfProgram, Instruction.OP_ReturnFromSubroutine]:
+                break
+            addr += 1
+
+    return sorted(mains)
+
+def compile_directory(task):
+    """
+    Compiles the given sequencer files, all in the same directory, in a single process
+    so that the included files are parsed only once (see grammar.parse_file).
+    :param task: (topdir, directory relative to topdir, list of file names, outdir, binary, cache)
+    :return: list of summary dictionaries, one per file
+    """
+    topdir, reldir, fnames, outdir, binary, cache = task
+
+    # include file names are relative to the directory of the sequencer file
+    cwd = os.getcwd()
+    os.chdir(os.path.join(topdir, reldir))
+
+    summaries = []
+    for fname in fnames:
+        relname = os.path.join(reldir, fname)
+        summary = {'file': relname, 'status': 'ok', 'error': None, 'output': None, 'mains': {}}
+        try:
+            seq = Sequencer.fromtxtfile(fname, verbose=False, cache=cache)
+
+            if outdir is not None:
+                if binary:
+                    outname = os.path.splitext(relname)[0] + '.bin'
+                else:
+                    outname = os.path.splitext(relname)[0] + '.compiled'
+                fulloutname = os.path.join(outdir, outname)
+                try:
+                    os.makedirs(os.path.dirname(fulloutname))
+                except OSError as e:
+                    # may have been created by another process of the pool in the meantime
+                    if e.errno != errno.EEXIST:
+                        raise
+                if binary:
+                    write_binfile(seq, fname, compname=fulloutname)
+                else:
+                    write_compfile(seq, fname, compname=fulloutname)
+                summary['output'] = outname
+
+            for main in main_names(seq):
+                cycles = seq.subroutine_cycles(seq.program.subroutines[main])
+                summary['mains'][main] = {'cycles': cycles}
+                if 'clockperiod' in seq.parameters:
+                    summary['mains'][main]['time_us'] = cycles * seq.parameters['clockperiod'] * 1e6
+        except Exception as e:
+            summary['status'] = 'error'
+            summary['error'] = '%s: %s' % (e.__class__.__name__, e)
+        summaries.append(summary)
+
+    os.chdir(cwd)
+
+    return summaries
+
+def compile_tree(topdir, outdir=None, summaryfile=None, processes=None, binary=False, cache=False):
+    """
+    Compiles all the sequencer files under the directory, across a pool of processes
+    (one task per directory).
+    :param topdir:
+    :param outdir: where compiled files are written, with the same tree structure (none written if None)
+    :param summaryfile: JSON summary file name (none written if None)
+    :param processes: size of the process pool, number of CPUs if None
+    :param binary: writes binary compiled images instead of text
+    :param cache: uses the on-disk cache of compiled sequencers (see seqcache)
+    :return: list of summary dictionaries (file, status, error, output, mains), sorted by file name
+    """
+    topdir = os.path.abspath(topdir)
+    if outdir is not None:
+        outdir = os.path.abspath(outdir)
+
+    bydir = {}
+    for relname in find_seqfiles(topdir):
+        reldir, fname = os.path.split(relname)
+        bydir.setdefault(reldir, []).append(fname)
+    tasks = [(topdir, reldir, bydir[reldir], outdir, binary, cache) for reldir in sorted(bydir)]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(compile_directory, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    summaries = sorted([summary for result in results for summary in result], key=lambda x: x['file'])
+
+    if summaryfile is not None:
+        sumf = open(summaryfile, 'w')
+        json.dump({'compiler': version,
+                   'files': summaries,
+                   'errors': len([summary for summary in summaries if summary['status'] != 'ok'])},
+                  sumf, indent=1, sort_keys=True)
+        sumf.close()
+
+    return summaries
 
 # ========================================================================
 if __name__ == '__main__':
     parser = optparse.OptionParser(usage = \
     """
     %prog [-v] <sequencer-file> [<compiled-file>]
+    %prog -t [-j <processes>] [-s <summary-file>] <directory> [<output-directory>]
 
     Sequencer compiler for the LSST REB FPGA.
 
@@ -132,11 +726,22 @@ if __name__ == '__main__':
     version (address/value list) of the same program, ready
     to be written in the REB FPGA program memory.
 
+    With -t, all the sequencer files under the directory are compiled
+    by a pool of processes, with a JSON summary of the results.
+
     The LSST REB sequencer programming language is specified
     in LCA-XXXXX: 'LSST REB Sequencer Language - Use Manual'.
     """)
     parser.add_option('-v', '--verbose', default=True, action='store_true',
                       help='Verbose run')
+    parser.add_option('-b', '--binary', default=False, action='store_true',
+                      help='Binary compiled image instead of text')
+    parser.add_option('-t', '--tree', default=False, action='store_true',
+                      help='Compile all sequencer files under a directory')
+    parser.add_option('-j', '--jobs', default=None, type='int',
+                      help='Number of processes for -t (default: number of CPUs)')
+    parser.add_option('-s', '--summary', default='summary.json',
+                      help='JSON summary file for -t (default: summary.json)')
 
     (options, args) = parser.parse_args()
 
@@ -151,6 +756,20 @@ if __name__ == '__main__':
 
     seqfile = args[0]
 
+    if options.tree:
+        outdir = None
+        if len(args) >= 2:
+            outdir = args[1]
+        summaries = compile_tree(seqfile, outdir, summaryfile=options.summary,
+                                 processes=options.jobs, binary=options.binary)
+        for summary in summaries:
+            if summary['status'] != 'ok':
+                print >>sys.stderr, 'error: compilation of file "%s" failed: %s' % (summary['file'],
+                                                                                  summary['error'])
+        print "%d files compiled, %d errors" % (len(summaries),
+                                                len([summary for summary in summaries
+                                                     if summary['status'] != 'ok']))
+        sys.exit(0)
 
     if len(args) >= 2:
         compfile = args[1]
@@ -166,5 +785,8 @@ if __name__ == '__main__':
         sys.exit(2)
 
     # Now, writing the various parts into the resulting file
-    write_compfile(seq, seqfile, compname=compfile)
+    if options.binary:
+        write_binfile(seq, seqfile, compname=compfile)
+    else:
+        write_compfile(seq, seqfile, compname=compfile)
 
@@ -7,6 +7,7 @@
 from __future__ import print_function
 import re
 import bidi
+import timeline
 import numpy as np
 
 ## -----------------------------------------------------------------------
@@ -53,18 +54,63 @@ class Program(object):
         Return the 32 bits byte code for the FPGA compiled program.
         (with relative memory addresses)
         """
+        return dict(self.iter_bytecode(program_base_addr))
 
+    def iter_bytecode(self, program_base_addr = 0x0):
+        """
+        Generates the (address, 32 bits byte code) pairs of the program,
+        by increasing address.
+        """
         instrs = self.instructions
-        addrs = instrs.keys()
-        addrs.sort()
 
-        bcs = {}
-        for addr in addrs:
-            instr = instrs[addr]
-            bc = instr.bytecode()
-            bcs[addr | program_base_addr] = bc
+        for addr in sorted(instrs):
+            yield addr | program_base_addr, instrs[addr].bytecode()
+
+    def toarray(self, size=0x400):
+        """
+        Program memory as an array of 32 bits byte codes, encoded at once.
+        Memory outside of the program is 0.
+        :param size: size of the program memory (words)
+        :return: np.array of uint32
+        """
+        addrs = sorted(self.instructions)
+        fields = np.array([self.instructions[addr].fields() for addr in addrs],
+                          dtype=Instruction.Fields_dtype)
+
+        words = np.zeros(size, dtype=np.uint32)
+        if addrs:
+            words[addrs] = Instruction.encode_array(fields)
+
+        return words
+
+    @classmethod
+    def fromarray(cls, words, start_address=0):
+        """
+        Program decoded from an array of 32 bits byte codes, for instance a readback
+        of the program memory. Words equal to 0 are taken as empty memory.
+        :param words: array of uint32
+        :param start_address: address of the first word (relative)
+        :return: Program
+        """
+        words = np.asarray(words, dtype=np.uint32)
+        addrs = np.nonzero(words)[0]
+        fields = Instruction.decode_array(words[addrs])
+
+        prog = cls()
+        for addr, instrfields in zip(addrs.tolist(), fields):
+            prog.instructions[start_address + addr] = Instruction.fromfields(instrfields)
+
+        return prog
 
-        return bcs
+
+def disassemble(words, start_address=0):
+    """
+    Listing of an array of program memory words (see Program.fromarray).
+    :param words: array of uint32
+    :param start_address: address of the first word (relative)
+    :return: string
+    """
+    return repr(Program.fromarray(words, start_address))
 
 
 class SequencerPointer(object):
@@ -81,8 +127,11 @@ class SequencerPointer(object):
     #Ptr_Subr_Base = 0x370000
     #Rep_Subr_Base = 0x380000
 
-    Mapping_Ptr = dict(zip(Pointer_types,
-                           [0x340000, 0x350000, 0x360000, 0x370000, 0x380000]))
+    # base addresses of the pointers, by type (constant)
+    Base_Ptr = dict(zip(Pointer_types,
+                        [0x340000, 0x350000, 0x360000, 0x370000, 0x380000]))
+    # next free address, by type
+    Mapping_Ptr = dict(Base_Ptr)
 
     def __init__(self, pointertype, name, value=None, target=''):
         """
@@ -156,8 +205,7 @@ class SequencerPointer(object):
         :return:
         """
 
-        cls.Mapping_Ptr = dict(zip(cls.Pointer_types,
-                           [0x340000, 0x350000, 0x360000, 0x370000, 0x380000]))
+        cls.Mapping_Ptr = dict(cls.Base_Ptr)
 
     @classmethod
     def from_repr(cls, ptrstring):
@@ -215,9 +263,17 @@ class Instruction(object):
                              OP_EndOfProgram])
     Call_codes = [OP_CallFunction, OP_CallPointerFunction, OP_CallFuncPointerRepeat, OP_CallPointerFuncPointerRepeat]
     Jsr_codes = [OP_JumpToSubroutine, OP_JumpPointerSubroutine, OP_JumpSubPointerRepeat, OP_JumpPointerSubPointerRepeat]
+    Valid_codes = Call_codes + Jsr_codes + [OP_ReturnFromSubroutine, OP_EndOfProgram]
 
     SubAddressShift = 16
 
+    # decoded instruction fields, for arrays of instructions (see decode_array)
+    Fields_dtype = np.dtype([('opcode', np.uint8),
+                             ('function_id', np.uint8),
+                             ('infinite_loop', np.bool_),
+                             ('repeat', np.uint32),
+                             ('address', np.uint16)])
+
     pattern_CALL = re.compile(
         "CALL\s+func\((\d+)\)\s+repeat\(((\d+)|infinity)\)")
     pattern_JSR_addr = re.compile(
@@ -474,7 +530,7 @@ class Instruction(object):
                                    function_id=function_id,
                                    repeat=repeat)
 
-        elif opcode == cls.Jsr_codes:
+        elif opcode in cls.Jsr_codes:
             address = (bc >> cls.SubAddressShift) & 0x3ff
             # print address
             repeat = bc & ((1 << cls.SubAddressShift) - 1)
@@ -486,6 +542,87 @@ class Instruction(object):
 
         return Instruction(opcode=opcode)
 
+    @classmethod
+    def decode_array(cls, words):
+        """
+        Decodes an array of 32 bits byte codes at once (same decoding as frombytecode).
+        :param words: array of uint32
+        :return: np.array of Fields_dtype
+        """
+        words = np.asarray(words, dtype=np.uint32)
+        opcode = words >> 28
+
+        invalid = ~np.in1d(opcode, cls.Valid_codes)
+        if invalid.any():
+            first = np.nonzero(invalid)[0][0]
+            raise ValueError("Invalid FPGA bytecode (invalid opcode) at index %d: 0x%08x" % (first, words[first]))
+
+        call = np.in1d(opcode, cls.Call_codes)
+        jsr = np.in1d(opcode, cls.Jsr_codes)
+
+        fields = np.zeros(len(words), dtype=cls.Fields_dtype)
+        fields['opcode'] = opcode
+        fields['function_id'] = np.where(call, (words >> 24) & 0xf, 0)
+        fields['infinite_loop'] = call & ((words & (1 << 23)) != 0)
+        fields['repeat'] = np.where(call & ~fields['infinite_loop'], words & 0x3fffff,
+                                    np.where(jsr, words & ((1 << cls.SubAddressShift) - 1), 0))
+        fields['address'] = np.where(jsr, (words >> cls.SubAddressShift) & 0x3ff, 0)
+
+        return fields
+
+    @classmethod
+    def encode_array(cls, fields):
+        """
+        Encodes an array of decoded instructions at once (same encoding as bytecode).
+        :param fields: np.array of Fields_dtype
+        :return: np.array of uint32
+        """
+        opcode = fields['opcode'].astype(np.uint32)
+
+        invalid = ~np.in1d(opcode, cls.Valid_codes)
+        if invalid.any():
+            raise ValueError("Invalid instruction at index %d" % np.nonzero(invalid)[0][0])
+
+        call = np.in1d(opcode, cls.Call_codes)
+        jsr = np.in1d(opcode, cls.Jsr_codes)
+
+        words = (opcode & 0xf) << 28
+        callwords = ((fields['function_id'].astype(np.uint32) & 0xf) << 24) | \
+            np.where(fields['infinite_loop'], np.uint32(1 << 23), fields['repeat'] & 0x3fffff)
+        jsrwords = ((fields['address'].astype(np.uint32) & 0x3ff) << cls.SubAddressShift) | \
+            (fields['repeat'] & ((1 << cls.SubAddressShift) - 1))
+        words |= np.where(call, callwords, np.where(jsr, jsrwords, 0)).astype(np.uint32)
+
+        return words
+
+    @classmethod
+    def fromfields(cls, fields):
+        """
+        Creates an instruction from one element of a decoded array (see decode_array).
+        """
+        opcode = int(fields['opcode'])
+        if opcode in cls.Call_codes:
+            return Instruction(opcode=opcode,
+                               function_id=int(fields['function_id']),
+                               infinite_loop=bool(fields['infinite_loop']),
+                               repeat=int(fields['repeat']))
+        elif opcode in cls.Jsr_codes:
+            return Instruction(opcode=opcode,
+                               address=int(fields['address']),
+                               repeat=int(fields['repeat']))
+
+        return Instruction(opcode=opcode)
+
+    def fields(self):
+        """
+        Decoded fields of the instruction, as in decode_array.
+        :return: tuple
+        """
+        if self.opcode in self.Jsr_codes and self.address is None:
+            raise ValueError("Unassembled JSR instruction. No bytecode")
+
+        return (self.opcode, self.function_id, self.infinite_loop, self.repeat, self.address or 0)
+
 
 class Subroutine(object):
     def __init__(self):
@@ -716,6 +853,7 @@ class Sequencer(object):
         self.program = program  # empty program
         self.parameters = parameters  # memory of the parameter values set in XML/txt
         self.pointers = pointers  # memory of pointers set in txt
+        self.cycles_cache = {}  # memory of subroutine durations, see subroutine_cycles()
 
     def get_function(self, funcref):
         # looks up mapping
@@ -953,6 +1091,7 @@ class Sequencer(object):
         """
         Computes timing for a given subroutine, with breakout by instruction.
         Result in microseconds.
+        Without verbose, uses the memoized durations from subroutine_cycles().
         :param subr:
         :return:
         """
@@ -965,8 +1104,398 @@ class Sequencer(object):
 
         start_address = self.program.subroutines[subr]
 
+        if not verbose:
+            return self.subroutine_cycles(start_address) * p
+
         return self.recurse_time(start_address, p, verbose=verbose)
 
+    def subroutine_cycles(self, start_address):
+        """
+        Duration of the subroutine starting at the given address, in clock cycles.
+        Durations are memoized per address, together with the pointer values and function
+        durations they depend on (including through called subroutines). An entry is only
+        recomputed when one of these has changed, so that sweeping a repetition pointer
+        only recomputes the subroutines using it.
+        Call clear_timing_cache() if the program itself is modified.
+        :param start_address:
+        :return: int
+        """
+        if start_address in self.cycles_cache:
+            cycles, deps = self.cycles_cache[start_address]
+            if self.unchanged_dependencies(deps):
+                return cycles
+
+        cycles, deps = self.compute_cycles(start_address)
+        self.cycles_cache[start_address] = (cycles, deps)
+
+        return cycles
+
+    def unchanged_dependencies(self, deps):
+        """
+        Checks that the pointer values and function durations used for a cached duration are still current.
+        :param deps: dictionary ('PTR', name) -> value and ('FUNC', id) -> duration
+        :return: bool
+        """
+        for (deptype, ref), value in deps.items():
+            if deptype == 'PTR':
+                if ref not in self.pointers or self.pointers[ref].value != value:
+                    return False
+            elif ref not in self.functions or self.functions[ref].total_time() != value:
+                return False
+
+        return True
+
+    def compute_cycles(self, start_address):
+        """
+        Auxiliary for subroutine_cycles(): walks the subroutine once, using memoized durations for the
+        subroutines it calls.
+        :param start_address:
+        :return: duration in clock cycles, dependencies
+        """
+        current_address = start_address
+        total_cycles = 0
+        deps = {}
+
+        while current_address in self.program.instructions:
+            instr = self.program.instructions[current_address]
+            if instr.opcode in instr.Call_codes:
+                # parse repetitions, look up function
+                if instr.opcode in [instr.OP_CallFunction, instr.OP_CallPointerFunction]:
+                    repetitions = instr.repeat
+                else:
+                    repetitions = self.pointer_value('REP_FUNC', instr.repeat)
+                    deps[('PTR', self.pointer_name('REP_FUNC', instr.repeat))] = repetitions
+                if instr.opcode in [instr.OP_CallFunction, instr.OP_CallFuncPointerRepeat]:
+                    funcnum = instr.function_id
+                else:
+                    funcnum = self.pointer_value('PTR_FUNC', instr.function_id)
+                    deps[('PTR', self.pointer_name('PTR_FUNC', instr.function_id))] = funcnum
+                func_cycles = self.functions[funcnum].total_time()
+                deps[('FUNC', funcnum)] = func_cycles
+                total_cycles += func_cycles * repetitions
+
+            elif instr.opcode in instr.Jsr_codes:
+                # parse repetitions, look up new address, use memoized duration
+                if instr.opcode in [instr.OP_JumpToSubroutine, instr.OP_JumpPointerSubroutine]:
+                    repetitions = instr.repeat
+                else:
+                    repetitions = self.pointer_value('REP_SUBR', instr.repeat)
+                    deps[('PTR', self.pointer_name('REP_SUBR', instr.repeat))] = repetitions
+                if instr.opcode in [instr.OP_JumpToSubroutine, instr.OP_JumpSubPointerRepeat]:
+                    target_address = instr.address
+                else:
+                    target_address = self.pointer_value('PTR_SUBR', instr.address)
+                    deps[('PTR', self.pointer_name('PTR_SUBR', instr.address))] = target_address
+                total_cycles += self.subroutine_cycles(target_address) * repetitions
+                # dependencies of the called subroutine are also ours
+                deps.update(self.cycles_cache[target_address][1])
+
+            else:
+                break
+
+            current_address += 1
+
+        return total_cycles, deps
+
+    def clear_timing_cache(self):
+        """
+        Forgets all memoized subroutine durations.
+        :return:
+        """
+        self.cycles_cache = {}
+
+    def function_edges(self, funcnum, c, rising=True):
+        """
+        Edges of a clock channel during one execution of a function.
+        :param funcnum:
+        :param c: channel number
+        :param rising:
+        :return: edge times from the start of the function (np.array), state at start, state at end, duration
+        """
+        tl = self.functions[funcnum].timeline().channel(c)
+        if len(tl) == 0:
+            return np.array([], dtype=np.int64), None, None, 0
+
+        return tl.edges(0, rising), int(tl.words[0]), int(tl.words[-1]), tl.total_time()
+
+    def count_edges(self, subr, channel='TRG', rising=True):
+        """
+        Number of rising (or falling) edges of a clock channel during a main or subroutine,
+        computed from the repetitions of the CALL and JSR instructions, without expanding cycles.
+        As in timing(), functions called with repeat(infinity) are not executed.
+        :param subr: name of the main or subroutine
+        :param channel: name or number of the channel
+        :param rising:
+        :return: int
+        """
+        if subr not in self.program.subroutines:
+            print('Unknown subroutine name: %s' % subr)
+            return None
+
+        if isinstance(channel, str):
+            c = self.channels[channel]
+        else:
+            c = channel
+
+        return self.recurse_edges(self.program.subroutines[subr], c, int(rising), {}, {})[0]
+
+    def recurse_edges(self, start_address, c, up, funcmemo, subrmemo):
+        """
+        Auxiliary for count_edges(): edge count of the subroutine starting at the given address.
+        Consecutive blocks add up their edges, plus one at their junction if the first one ends
+        in the opposite state and the second one starts in the edge state.
+        :param start_address:
+        :param c: channel number
+        :param up: state after the edge (1 for rising edges)
+        :param funcmemo: edges already computed, by function number
+        :param subrmemo: results already computed, by subroutine address
+        :return: number of edges, state at start, state at end (None if the subroutine is empty)
+        """
+        if start_address in subrmemo:
+            return subrmemo[start_address]
+
+        count, first, last = 0, None, None
+        current_address = start_address
+
+        while current_address in self.program.instructions:
+            instr = self.program.instructions[current_address]
+            if instr.opcode in instr.Call_codes:
+                # parse repetitions, look up function
+                if instr.opcode in [instr.OP_CallFunction, instr.OP_CallPointerFunction]:
+                    repetitions = instr.repeat
+                else:
+                    repetitions = self.pointer_value('REP_FUNC', instr.repeat)
+                if instr.opcode in [instr.OP_CallFunction, instr.OP_CallFuncPointerRepeat]:
+                    funcnum = instr.function_id
+                else:
+                    funcnum = self.pointer_value('PTR_FUNC', instr.function_id)
+                if funcnum not in funcmemo:
+                    funcmemo[funcnum] = self.function_edges(funcnum, c, up)
+                edges, start, end = funcmemo[funcnum][:3]
+                block = (len(edges), start, end)
+
+            elif instr.opcode in instr.Jsr_codes:
+                # parse repetitions, look up new address, recurse
+                if instr.opcode in [instr.OP_JumpToSubroutine, instr.OP_JumpPointerSubroutine]:
+                    repetitions = instr.repeat
+                else:
+                    repetitions = self.pointer_value('REP_SUBR', instr.repeat)
+                if instr.opcode in [instr.OP_JumpToSubroutine, instr.OP_JumpSubPointerRepeat]:
+                    target_address = instr.address
+                else:
+                    target_address = self.pointer_value('PTR_SUBR', instr.address)
+                block = self.recurse_edges(target_address, c, up, funcmemo, subrmemo)
+
+            else:
+                break
+
+            n, start, end = block
+            if repetitions > 0 and start is not None:
+                # edges inside the block and between its repetitions
+                count += repetitions * n + (repetitions - 1) * int(end != up and start == up)
+                # edge between the previous block and this one
+                if last is not None:
+                    count += int(last != up and start == up)
+                else:
+                    first = start
+                last = end
+
+            current_address += 1
+
+        subrmemo[start_address] = (count, first, last)
+        return subrmemo[start_address]
+
+    def edge_times(self, subr, channel='TRG', rising=True):
+        """
+        Times (clock cycles from the start of the main or subroutine) of the rising (or falling) edges
+        of a clock channel, generated lazily in consecutive arrays, one per sequence of function calls.
+        As in timing(), functions called with repeat(infinity) are not executed.
+        Example: np.concatenate(list(seq.edge_times('Read', 'TRG')))
+        :param subr: name of the main or subroutine
+        :param channel: name or number of the channel
+        :param rising:
+        :return: generator of np.array
+        """
+        if subr not in self.program.subroutines:
+            raise ValueError('Unknown subroutine name: %s' % subr)
+
+        if isinstance(channel, str):
+            c = self.channels[channel]
+        else:
+            c = channel
+
+        # current time and state of the channel, shared along the recursion
+        state = {'time': 0, 'last': None, 'funcmemo': {}, 'subrmemo': {}}
+
+        return self.walk_edges(self.program.subroutines[subr], c, int(rising), state)
+
+    def walk_edges(self, start_address, c, up, state):
+        """
+        Auxiliary for edge_times(): generates the edge times of the subroutine starting at the given address.
+        :param start_address:
+        :param c: channel number
+        :param up: state after the edge (1 for rising edges)
+        :param state: current time, last state of the channel, memos
+        :return: generator of np.array
+        """
+        funcmemo = state['funcmemo']
+        current_address = start_address
+
+        while current_address in self.program.instructions:
+            instr = self.program.instructions[current_address]
+            if instr.opcode in instr.Call_codes:
+                # parse repetitions, look up function
+                if instr.opcode in [instr.OP_CallFunction, instr.OP_CallPointerFunction]:
+                    repetitions = instr.repeat
+                else:
+                    repetitions = self.pointer_value('REP_FUNC', instr.repeat)
+                if instr.opcode in [instr.OP_CallFunction, instr.OP_CallFuncPointerRepeat]:
+                    funcnum = instr.function_id
+                else:
+                    funcnum = self.pointer_value('PTR_FUNC', instr.function_id)
+                if funcnum not in funcmemo:
+                    funcmemo[funcnum] = self.function_edges(funcnum, c, up)
+                edges, start, end, duration = funcmemo[funcnum]
+
+                if repetitions > 0 and start is not None:
+                    # start time of each repetition, with an edge there if the state changes
+                    starts = state['time'] + duration * np.arange(repetitions, dtype=np.int64)
+                    junctions = np.empty(repetitions, dtype=bool)
+                    junctions[0] = state['last'] is not None and state['last'] != up and start == up
+                    junctions[1:] = end != up and start == up
+                    times = np.hstack((starts[:, np.newaxis], starts[:, np.newaxis] + edges))
+                    keep = np.hstack((junctions[:, np.newaxis], np.ones((repetitions, len(edges)), dtype=bool)))
+                    yield times[keep]
+
+                    state['time'] += duration * repetitions
+                    state['last'] = end
+
+            elif instr.opcode in instr.Jsr_codes:
+                # parse repetitions, look up new address, recurse
+                if instr.opcode in [instr.OP_JumpToSubroutine, instr.OP_JumpPointerSubroutine]:
+                    repetitions = instr.repeat
+                else:
+                    repetitions = self.pointer_value('REP_SUBR', instr.repeat)
+                if instr.opcode in [instr.OP_JumpToSubroutine, instr.OP_JumpSubPointerRepeat]:
+                    target_address = instr.address
+                else:
+                    target_address = self.pointer_value('PTR_SUBR', instr.address)
+
+                if repetitions > 0:
+                    n, start, end = self.recurse_edges(target_address, c, up, funcmemo, state['subrmemo'])
+                    if n == 0 and not (end != up and start == up):
+                        # no edge inside the repetitions: skips them, except for the junction with what precedes
+                        if start is not None:
+                            if state['last'] is not None and state['last'] != up and start == up:
+                                yield np.array([state['time']], dtype=np.int64)
+                            state['last'] = end
+                        state['time'] += self.subroutine_cycles(target_address) * repetitions
+                    else:
+                        for r in range(repetitions):
+                            for times in self.walk_edges(target_address, c, up, state):
+                                yield times
+
+            else:
+                break
+
+            current_address += 1
+
+    def timing_polynomial(self, subr):
+        """
+        Duration of a subroutine as a polynomial in the repetition pointers (REP_FUNC, REP_SUBR).
+        The polynomial is a dictionary: monomial -> coefficient in clock cycles, where a monomial
+        is the sorted tuple of the names of the pointers multiplied together (empty for the
+        constant term). For instance {(): 1200, ('ReadCols', 'ReadRows'): 130, ('ReadRows',): 4500}.
+        Pointers to functions and subroutines are resolved with their current values.
+        Evaluate with evaluate_timing_polynomial().
+        :param subr:
+        :return: dict
+        """
+        if subr not in self.program.subroutines:
+            print('Unknown subroutine name: %s' % subr)
+            return None
+
+        return self.recurse_polynomial(self.program.subroutines[subr], {})
+
+    def recurse_polynomial(self, start_address, memo):
+        """
+        Auxiliary for recursivity in timing_polynomial().
+        :param start_address:
+        :param memo: polynomials already derived, by address
+        :return: dict
+        """
+        if start_address in memo:
+            return memo[start_address]
+
+        current_address = start_address
+        poly = {}
+
+        def add_term(monomial, coefficient):
+            monomial = tuple(sorted(monomial))
+            poly[monomial] = poly.get(monomial, 0) + coefficient
+
+        while current_address in self.program.instructions:
+            instr = self.program.instructions[current_address]
+            if instr.opcode in instr.Call_codes:
+                if instr.opcode in [instr.OP_CallFunction, instr.OP_CallFuncPointerRepeat]:
+                    funcnum = instr.function_id
+                else:
+                    funcnum = self.pointer_value('PTR_FUNC', instr.function_id)
+                func_cycles = self.functions[funcnum].total_time()
+                if instr.opcode in [instr.OP_CallFunction, instr.OP_CallPointerFunction]:
+                    add_term((), func_cycles * instr.repeat)
+                else:
+                    add_term((self.pointer_name('REP_FUNC', instr.repeat),), func_cycles)
+
+            elif instr.opcode in instr.Jsr_codes:
+                if instr.opcode in [instr.OP_JumpToSubroutine, instr.OP_JumpSubPointerRepeat]:
+                    target_address = instr.address
+                else:
+                    target_address = self.pointer_value('PTR_SUBR', instr.address)
+                subpoly = self.recurse_polynomial(target_address, memo)
+                if instr.opcode in [instr.OP_JumpToSubroutine, instr.OP_JumpPointerSubroutine]:
+                    for monomial, coefficient in subpoly.items():
+                        add_term(monomial, coefficient * instr.repeat)
+                else:
+                    repname = self.pointer_name('REP_SUBR', instr.repeat)
+                    for monomial, coefficient in subpoly.items():
+                        add_term(monomial + (repname,), coefficient)
+
+            else:
+                break
+
+            current_address += 1
+
+        # drops terms cancelled by zero repetitions
+        for monomial in [m for m in poly if poly[m] == 0]:
+            del poly[monomial]
+
+        memo[start_address] = poly
+        return poly
+
+    def evaluate_timing_polynomial(self, poly, values=None):
+        """
+        Evaluates a polynomial from timing_polynomial() in microseconds, for the given pointer values.
+        Pointers not given in values take their current value.
+        :param poly:
+        :param values: dictionary pointer name -> repetitions
+        :return: float
+        """
+        if values is None:
+            values = {}
+
+        total_cycles = 0
+        for monomial, coefficient in poly.items():
+            term = coefficient
+            for name in monomial:
+                if name in values:
+                    term *= values[name]
+                else:
+                    term *= self.pointers[name].value
+            total_cycles += term
+
+        return total_cycles * self.parameters['clockperiod'] * 1e6
+
     def recurse_full(self, start_address, clockperiod, recurse_level=0, verbose=True):
         """
         Auxiliary for recursivity on sequence breakout and timing.
@@ -1053,6 +1582,12 @@ class Sequencer(object):
 
         current_address = self.program.subroutines[subr]
         saved_address = []
+        # timelines of the functions already looked at
+        functimelines = {}
+        if isinstance(clockname, str):
+            c = self.channels[clockname]
+        else:
+            c = clockname
 
         while current_address in self.program.instructions:
             instr = self.program.instructions[current_address]
@@ -1062,7 +1597,9 @@ class Sequencer(object):
                     funcnum = instr.function_id
                 else:
                     funcnum = self.pointer_value('PTR_FUNC', instr.function_id)
-                if self.functions[funcnum].is_on_anytime(clockname):
+                if funcnum not in functimelines:
+                    functimelines[funcnum] = self.functions[funcnum].timeline()
+                if functimelines[funcnum].is_on_anytime(c):
                     return self.functions[funcnum].name
                 # moves on to next instruction
                 current_address += 1
@@ -1116,7 +1653,83 @@ class Sequencer(object):
 
 ## -----------------------------------------------------------------------
 
+class FunctionSlices(object):
+    """
+    Dictionary-like view (timeslice: value) on one of the arrays of a Function,
+    limited to the timeslices in use. Writing through the view updates the Function.
+    """
+    __slots__ = ('function', 'column')
+
+    def __init__(self, function, column):
+        """
+        :param function: Function
+        :param column: 'durations' or 'words'
+        """
+        self.function = function
+        self.column = column
+
+    def __len__(self):
+        return self.function.nslices
+
+    def __contains__(self, timeslice):
+        return isinstance(timeslice, (int, long, np.integer)) and 0 <= timeslice < self.function.nslices
+
+    def __iter__(self):
+        return iter(range(self.function.nslices))
+
+    def __getitem__(self, timeslice):
+        if timeslice not in self:
+            raise KeyError(timeslice)
+        return int(getattr(self.function, self.column)[timeslice])
+
+    def __setitem__(self, timeslice, value):
+        func = self.function
+        if timeslice == func.nslices:
+            # new timeslice at the end
+            if timeslice >= len(func.durations):
+                raise ValueError('Function %s has already 16 timeslices' % func.name)
+            func.nslices += 1
+        elif timeslice not in self:
+            raise KeyError(timeslice)
+        if self.column == 'words':
+            value &= 0xffffffff
+        getattr(func, self.column)[timeslice] = value
+        func.cumulated_cache = None
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def keys(self):
+        return range(self.function.nslices)
+
+    def values(self):
+        return getattr(self.function, self.column)[:self.function.nslices].tolist()
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def get(self, timeslice, default=None):
+        if timeslice in self:
+            return self[timeslice]
+        return default
+
+
 class Function(object):
+    """
+    Sequencer function: up to 16 timeslices, each with a duration (in clock cycles)
+    and a 32-bit output word. Timeslices 0 to nslices-1 are in use, the others are kept at 0.
+    """
+    __slots__ = ('name', 'fullname', 'channels', 'durations', 'words', 'nslices', 'cumulated_cache')
+
     def __init__(self,
                  name="", fullname="",
                  timelengths={}, outputs={}, channels=Sequencer.default_channels):
@@ -1125,12 +1738,79 @@ class Function(object):
         # self.outputs = {0: '0b01001101...', 1: '0b1111000...', ... }
         self.name = name
         self.fullname = fullname
-        self.timelengths = dict(timelengths)  # 16 max, (last one zero duration)
-        self.outputs = dict(outputs)  # bit setup
         self.channels = channels  # mapping bit/symbolic name
+        self.durations = np.zeros(16, dtype=np.int32)  # 16 max, (last one zero duration)
+        self.words = np.zeros(16, dtype=np.uint32)  # bit setup
+        self.nslices = 0
+        self.cumulated_cache = None
+        self.timelengths = timelengths
+        self.outputs = outputs
 
         # TODO: add flexibility on the clock line bit map
 
+    @property
+    def timelengths(self):
+        """
+        Durations of the timeslices in use, as a dictionary-like view.
+        """
+        return FunctionSlices(self, 'durations')
+
+    @timelengths.setter
+    def timelengths(self, timelengths):
+        timelengths = dict(timelengths)
+        if sorted(timelengths.keys()) != range(len(timelengths)):
+            raise ValueError('Function %s: timeslices should be numbered from 0, got %s' %
+                             (self.name, sorted(timelengths.keys())))
+        if len(timelengths) > len(self.durations):
+            raise ValueError('Function %s: too many timeslices (%d)' % (self.name, len(timelengths)))
+        self.nslices = len(timelengths)
+        self.durations[:] = 0
+        self.durations[:self.nslices] = [timelengths[sl] for sl in range(self.nslices)]
+        # outputs of timeslices no longer in use are dropped
+        self.words[self.nslices:] = 0
+        self.cumulated_cache = None
+
+    @property
+    def outputs(self):
+        """
+        Output words of the timeslices in use, as a dictionary-like view.
+        """
+        return FunctionSlices(self, 'words')
+
+    @outputs.setter
+    def outputs(self, outputs):
+        outputs = dict(outputs)
+        if outputs:
+            self.nslices = max(self.nslices, max(outputs.keys()) + 1)
+        self.words[:] = 0
+        for sl in outputs:
+            self.words[sl] = outputs[sl] & 0xffffffff
+        # new timeslices change the cumulated times
+        self.cumulated_cache = None
+
+    def __getstate__(self):
+        return dict((attr, getattr(self, attr)) for attr in self.__slots__)
+
+    def __setstate__(self, state):
+        for attr in state:
+            setattr(self, attr, state[attr])
+
+    def copy(self):
+        """
+        Copy of the function that can be edited independently (the channel mapping is shared).
+        :rtype: Function
+        """
+        newfunc = Function.__new__(Function)
+        newfunc.name = self.name
+        newfunc.fullname = self.fullname
+        newfunc.channels = self.channels
+        newfunc.durations = self.durations.copy()
+        newfunc.words = self.words.copy()
+        newfunc.nslices = self.nslices
+        newfunc.cumulated_cache = self.cumulated_cache
+
+        return newfunc
+
     def __repr__(self):
         s = "Function: " + self.name + "\n"
         s += "    " + self.fullname + "\n"
@@ -1163,9 +1843,9 @@ class Function(object):
 
         s += (73 * "-") + "\n"
         for sl in range(16):
-            bit_str = "%032d" % int(bin(self.outputs.get(sl, 0x0))[2:])
+            bit_str = "{0:032b}".format(int(self.words[sl]))
             s += "%02d\t %8d\t\t\t %s\n" % (sl,
-                                            self.timelengths.get(sl, 0),
+                                            self.durations[sl],
                                             bit_str)
         return s
 
@@ -1179,9 +1859,8 @@ class Function(object):
         else:
             c = channel
 
-        if timeslice in self.timelengths:
-            state = int(self.outputs[timeslice] & (1 << c) != 0)
-            return state
+        if 0 <= timeslice < self.nslices:
+            return int((self.words[timeslice] >> c) & 1)
 
         return None
 
@@ -1194,12 +1873,7 @@ class Function(object):
         else:
             c = channel
 
-        bc = (1 << c)
-        for timeslice in self.outputs:
-            if (self.outputs[timeslice] & bc):
-                return True
-
-        return False
+        return bool(((self.words[:self.nslices] >> c) & 1).any())
 
     def set_output_channel(self, value, channel, timeslice=None):
         """
@@ -1216,17 +1890,17 @@ class Function(object):
             c = channel
 
         if timeslice is None:
-            if value:
-                for t in self.outputs:
-                    self.outputs[t] = setBit(self.outputs[t], c)
-            else:
-                for t in self.outputs:
-                    self.outputs[t] = clearBit(self.outputs[t], c)
+            selected = slice(0, self.nslices)
+        elif 0 <= timeslice < self.nslices:
+            selected = timeslice
         else:
-            if value:
-                self.outputs[timeslice] = setBit(self.outputs[timeslice], c)
-            else:
-                self.outputs[timeslice] = clearBit(self.outputs[timeslice], c)
+            raise KeyError(timeslice)
+
+        mask = np.uint32(1 << c)
+        if value:
+            self.words[selected] |= mask
+        else:
+            self.words[selected] &= ~mask
 
     def split_timeslice(self, ts, firstduration):
         """
@@ -1238,30 +1912,30 @@ class Function(object):
         """
         if firstduration <= 0 or firstduration > self.timelengths[ts]:
             raise ValueError('Error splitting function timeslice: inappropriate duration %d' % firstduration)
+        if self.nslices == len(self.durations):
+            raise ValueError('Error splitting function timeslice: function %s has already 16 timeslices' %
+                             self.name)
 
-        # shifts timeslices above
-        for t in range(16, ts, -1):
-            if t in self.timelengths:
-                self.timelengths[t+1] = self.timelengths[t]
-                self.outputs[t+1] = self.outputs[t]
-
-        # duplicates to split
-        self.outputs[ts+1] = self.outputs[ts]
+        # shifts timeslices above, duplicating the one to split
+        self.durations[ts+1:self.nslices+1] = self.durations[ts:self.nslices].copy()
+        self.words[ts+1:self.nslices+1] = self.words[ts:self.nslices].copy()
+        self.nslices += 1
+        self.cumulated_cache = None
 
         # split times
-        self.timelengths[ts+1] = self.timelengths[ts] - firstduration
-        self.timelengths[ts] = firstduration
+        self.durations[ts+1] -= firstduration
+        self.durations[ts] = firstduration
 
         # special timeslices
         if ts==0:
             # need to shift subtraction of 1 from second to first TS
-            self.timelengths[ts+1] += 1
-            self.timelengths[ts] -= 1
-            if self.timelengths[ts] == 0:
+            self.durations[ts+1] += 1
+            self.durations[ts] -= 1
+            if self.durations[ts] == 0:
                 raise ValueError('Error trying to program 0 duration to first timeslice')
 
-        if ts+2 not in self.timelengths:
-            if self.timelengths[ts+1] <= 0:
+        if ts+2 == self.nslices:
+            if self.durations[ts+1] <= 0:
                 raise ValueError('Error trying to program 0 duration to last timeslice')
 
     def cumulated_time(self):
@@ -1269,22 +1943,15 @@ class Function(object):
         Returns the total time spent in the function after each timeslice.
         :rtype: list
         """
-        running_total = 0
-        cumulated = []
-
-        for t in range(16):
-            if t in self.timelengths:
-                running_total += self.timelengths[t]
-
+        if self.cumulated_cache is None:
+            cumulated = np.cumsum(self.durations[:self.nslices], dtype=np.int64)
+            if self.nslices:
                 # special timeslices
-                if t == 0:
-                    running_total += 1
-                if t+1 not in self.timelengths:
-                    running_total += 2
-
-                cumulated.append(running_total)
+                cumulated += 1
+                cumulated[-1] += 2
+            self.cumulated_cache = cumulated
 
-        return cumulated
+        return self.cumulated_cache.tolist()
 
     def set_output_at_time(self, value, channel, clktime, wrap=False):
         """
@@ -1317,37 +1984,107 @@ class Function(object):
                 self.set_output_channel(value, channel, timeslice=ts)
                 break
 
+    def set_outputs_at_times(self, value, channel, clktimes, wrap=False):
+        """
+        Batch version of set_output_at_time(): returns one copy of the function per given time,
+        with the output set at that time. All the timeslice splits are computed at once on arrays.
+        :param value:
+        :param channel:
+        :param clktimes: list of clock times
+        :param wrap: if True, times after the end of the function wrap around
+        :return: list of Function, with None where set_output_at_time() would raise ValueError
+        """
+        if isinstance(channel, str):
+            c = self.channels[channel]
+        else:
+            c = channel
+
+        clktimes = np.asarray(clktimes, dtype=np.int64)
+        npoints = len(clktimes)
+        if self.nslices == 0:
+            return [None] * npoints
+
+        # add time before first timeslice to have all posts
+        cumulated = np.concatenate(([0], self.cumulated_time()))
+        if wrap:
+            clktimes = np.where(clktimes >= cumulated[-1], clktimes % cumulated[-1], clktimes)
+        valid = (clktimes >= 0) & (clktimes < cumulated[-1])
+
+        # timeslice containing each time, and whether it needs to be split
+        ts = np.clip(np.searchsorted(cumulated, clktimes, side='right') - 1, 0, self.nslices - 1)
+        split = cumulated[ts] != clktimes
+        firstduration = clktimes - cumulated[ts]
+        valid &= ~split | ((firstduration <= self.durations[ts]) & (self.nslices < len(self.durations)))
+
+        # shifts timeslices above the split one, duplicating it
+        columns = np.arange(len(self.durations))
+        source = columns - (split[:, np.newaxis] & (columns > ts[:, np.newaxis]))
+        durations = self.durations[source]
+        words = self.words[source]
+        nslices = self.nslices + split
+
+        # split times, only for the points that can be split (no room for a new timeslice otherwise)
+        rows = np.nonzero(split & valid)[0]
+        durations[rows, ts[rows]] = firstduration[rows]
+        durations[rows, ts[rows] + 1] = self.durations[ts[rows]] - firstduration[rows]
+
+        # special timeslices
+        first = rows[ts[rows] == 0]
+        durations[first, 1] += 1
+        durations[first, 0] -= 1
+        valid[first[durations[first, 0] == 0]] = False
+        last = rows[ts[rows] + 2 == nslices[rows]]
+        valid[last[durations[last, ts[last] + 1] <= 0]] = False
+
+        # puts value in the right timeslice, the newly-splitted one if any
+        mask = np.uint32(1 << c)
+        points = np.nonzero(valid)[0]
+        target = (points, ts[points] + split[points])
+        if value:
+            words[target] |= mask
+        else:
+            words[target] &= ~mask
+
+        newfuncs = []
+        for i in range(npoints):
+            if not valid[i]:
+                newfuncs.append(None)
+                continue
+            newfunc = self.copy()
+            newfunc.durations = durations[i]
+            newfunc.words = words[i]
+            newfunc.nslices = int(nslices[i])
+            newfunc.cumulated_cache = None
+            newfuncs.append(newfunc)
+
+        return newfuncs
+
     def total_time(self):
         """
         Returns total duration of functions (expressed as clock cycles).
         Takes into account additionnal cycles at beginning and end.
         :return:
         """
-        return sum([self.timelengths[t] for t in self.timelengths])+3
+        return int(self.durations[:self.nslices].sum()) + 3
+
+    def timeline(self):
+        """
+        Returns the run-length encoded timeline of the outputs for one execution of the function.
+        :rtype: timeline.Timeline
+        """
+        return timeline.Timeline.fromfunction(self)
 
     def scope(self, channel):
         """
         Returns a list with on/off values for the given channel, with one item per FPGA cycle.
         :return:
         """
-        ntime = self.total_time()
-        timescope = [0] * ntime
-        i = 0
-
-        for tslice in sorted(self.timelengths.keys()):
-            duration = self.timelengths[tslice]
-            # special cases at beginning and end of function
-            if tslice == 0:
-                duration += 1
-            if tslice+1 not in self.timelengths:
-                duration += 2
-
-            if self.is_on(channel, tslice):
-                for d in range(duration):
-                    timescope[i+d] = 1
-            i += duration
+        if isinstance(channel, str):
+            c = self.channels[channel]
+        else:
+            c = channel
 
-        return timescope
+        return self.timeline().states([c], 0, self.total_time())[0].tolist()
 
     def bytecode(self, function_id, slices_base_addr=0x200000, outputs_base_addr=0x100000):
         """
@@ -1358,26 +2095,30 @@ class Function(object):
         if function_id not in range(16):
             raise ValueError("Invalid Function ID")
 
+        return dict(self.iter_bytecode(function_id, slices_base_addr, outputs_base_addr))
+
+    def iter_bytecode(self, function_id, slices_base_addr=0x200000, outputs_base_addr=0x100000):
+        """
+        Generates the (address, value) pairs of the function bytecode (see bytecode()),
+        by increasing address.
+        """
+        if function_id not in range(16):
+            raise ValueError("Invalid Function ID")
+
         slices_addr = slices_base_addr | (function_id << 4)
         outputs_addr = outputs_base_addr | (function_id << 4)
 
-        bcodes = {}
-
         # Set the given function slices and outputs
         # function #0 -> special case, only the first slice has meaning
+        if function_id == 0:
+            nslices = min(self.nslices, 1)
+        else:
+            nslices = self.nslices
 
-        for sl in range(16):
-            slice_addr = slices_addr | sl
-            duration = self.timelengths.get(sl, 0) & 0xffff
-            if (function_id == 0) and (sl > 0):
-                duration = 0
-            bcodes[slice_addr] = duration
-
-            output_addr = outputs_addr | sl
-            output = self.outputs.get(sl, 0) & 0xffffffff
-            if (function_id == 0) and (sl > 0):
-                output = 0
-            bcodes[output_addr] = output
-
-        return bcodes
+        durations = [int(d) & 0xffff for d in self.durations[:nslices]] + [0] * (16 - nslices)
+        words = [int(w) for w in self.words[:nslices]] + [0] * (16 - nslices)
 
+        blocks = [(outputs_addr, words), (slices_addr, durations)]
+        for base_addr, values in sorted(blocks):
+            for sl in range(16):
+                yield base_addr | sl, values[sl]
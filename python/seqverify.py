@@ -0,0 +1,460 @@
+#
+# LSST
+# Static verification of compiled sequencer programs
+#
+# Checks a compiled Sequencer for the errors that the compiler lets through and that
+# would otherwise only show up on the REB: call graph (undefined JSR targets,
+# recursion, depth of the call stack, subroutines not terminated by RTS/END,
+# unreachable subroutines), pointers (registry overflow, undefined or invalid targets,
+# repeat values too large for the instruction fields), function ids and slices
+# (more than 16 slices, zero or negative durations, durations too large for the
+# 16-bit slice registers).
+# Nothing is executed: the whole tree of sequencer files is verified in a few seconds.
+#
+# Syntax in a script:
+# import rebtxt, seqverify
+# seq = rebtxt.Sequencer.fromtxtfile("FP_ITL_2s_ir2_v26.seq", verbose=False)
+# print(seqverify.verify_report(seqverify.verify_sequencer(seq)))
+#
+# Syntax as main:
+# python seqverify.py FP_ITL_2s_ir2_v26.seq
+# python seqverify.py -t ../run5
+from __future__ import print_function
+import sys
+import os
+import optparse
+import multiprocessing
+
+import rebtxt
+import seqcompiler
+from sequencer import Instruction, SequencerPointer
+
+# depth of the subroutine call stack in the FPGA
+default_max_depth = 16
+# size of the program memory (instructions)
+program_size = 0x400
+# widths of the repeat values stored in pointers
+pointer_max_value = {'REP_FUNC': 0x3fffff, 'REP_SUBR': 0xffff}
+
+
+def problem(level, where, message):
+    """
+    :param level: 'error' or 'warning'
+    :param where: name of the subroutine, function or pointer concerned
+    :param message:
+    :return: dict
+    """
+    return {'level': level, 'where': where, 'message': message}
+
+
+def subroutine_ends(seq):
+    """
+    Finds where each subroutine terminates.
+    :param seq: Sequencer
+    :return: dict start address: (address of the last instruction, its opcode, or None if the
+    subroutine runs out of the program without RTS or END)
+    """
+    ends = {}
+    for addr in seq.program.subroutines.values():
+        start = addr
+        opcode = None
+        while addr in seq.program.instructions:
+            opcode = seq.program.instructions[addr].opcode
+            if opcode in [Instruction.OP_EndOfProgram, Instruction.OP_ReturnFromSubroutine]:
+                break
+            addr += 1
+        else:
+            addr -= 1
+            opcode = None
+        ends[start] = (addr, opcode)
+
+    return ends
+
+
+def call_graph(seq, ends):
+    """
+    Subroutine calls, with the targets of JSR through pointers taken from the current
+    pointer values.
+    :param seq: Sequencer
+    :param ends: from subroutine_ends()
+    :return: dict start address: list of (address of the JSR, target address, or None if undefined)
+    """
+    graph = {}
+    for start, (end, opcode) in ends.iteritems():
+        calls = []
+        for addr in range(start, end + 1):
+            instr = seq.program.instructions[addr]
+            if instr.opcode not in Instruction.Jsr_codes:
+                continue
+            if instr.opcode in [Instruction.OP_JumpToSubroutine, Instruction.OP_JumpSubPointerRepeat]:
+                target = instr.address
+            else:
+                target = seq.pointer_value('PTR_SUBR', instr.address)
+            calls.append((addr, target))
+        graph[start] = calls
+
+    return graph
+
+
+def stack_depths(graph, names):
+    """
+    Maximum depth of the call stack reached from each subroutine (0 for a subroutine that
+    calls no other one), and recursive calls.
+    :param graph: from call_graph()
+    :param names: subroutine name by start address
+    :return: dict start address: depth, list of the cycles found (lists of names)
+    """
+    depths = {}
+    cycles = []
+    visiting = []
+
+    def visit(start):
+        if start in depths:
+            return depths[start]
+        if start in visiting:
+            cycles.append([names[addr] for addr in visiting[visiting.index(start):]] + [names[start]])
+            return 0
+        visiting.append(start)
+        depth = 0
+        for addr, target in graph[start]:
+            if target in graph:
+                depth = max(depth, visit(target) + 1)
+        visiting.pop()
+        depths[start] = depth
+        return depth
+
+    for start in sorted(graph):
+        visit(start)
+
+    return depths, cycles
+
+
+def check_program(seq, max_depth=default_max_depth):
+    """
+    Verifies the call graph of the program.
+    :param seq: Sequencer
+    :param max_depth: depth of the call stack
+    :return: list of problems
+    """
+    problems = []
+    names = dict((addr, name) for name, addr in seq.program.subroutines.iteritems())
+
+    last = max(seq.program.instructions.keys() + [0])
+    if last >= program_size:
+        problems.append(problem('error', 'program',
+                                'program ends at 0x%03x, beyond program memory (0x%03x instructions)' %
+                                (last, program_size)))
+
+    ends = subroutine_ends(seq)
+    graph = call_graph(seq, ends)
+    for start in sorted(ends):
+        end, opcode = ends[start]
+        if opcode is None:
+            problems.append(problem('error', names[start], 'runs out of the program without RTS or END'))
+        else:
+            for addr in range(start + 1, end + 1):
+                if addr in names:
+                    problems.append(problem('error', names[start], 'falls through into %s' % names[addr]))
+                    break
+
+    # calls
+    mains = set(start for start in ends if ends[start][1] == Instruction.OP_EndOfProgram)
+    for start in sorted(graph):
+        for addr, target in graph[start]:
+            if target is None:
+                problems.append(problem('error', names[start],
+                                        'JSR at 0x%03x through undefined pointer' % addr))
+            elif target not in graph:
+                problems.append(problem('error', names[start],
+                                        'JSR at 0x%03x to 0x%03x, not the start of a subroutine' % (addr, target)))
+            elif target in mains:
+                problems.append(problem('error', names[start],
+                                        'JSR at 0x%03x to %s, which terminates with END' % (addr, names[target])))
+
+    depths, cycles = stack_depths(graph, names)
+    for cycle in cycles:
+        problems.append(problem('error', cycle[0], 'recursive call: %s' % ' -> '.join(cycle)))
+    for start in sorted(mains):
+        if depths[start] > max_depth:
+            problems.append(problem('error', names[start],
+                                    'call stack depth %d above the limit of %d' % (depths[start], max_depth)))
+
+    # reachability from the mains and from the subroutine pointers
+    roots = set(mains)
+    for ptr in seq.pointers.values():
+        if ptr.pointer_type == 'PTR_SUBR' and ptr.value in graph:
+            roots.add(ptr.value)
+    reached = set()
+    stack = list(roots)
+    while stack:
+        start = stack.pop()
+        if start in reached:
+            continue
+        reached.add(start)
+        stack.extend([target for addr, target in graph[start] if target in graph])
+    for start in sorted(set(graph) - reached):
+        problems.append(problem('warning', names[start], 'unreachable subroutine'))
+
+    return problems
+
+
+def check_pointers(seq):
+    """
+    Verifies the pointers and their use by the program.
+    :param seq: Sequencer
+    :return: list of problems
+    """
+    problems = []
+    starts = set(seq.program.subroutines.values())
+    ends = subroutine_ends(seq)
+
+    bytype = {}
+    for name in sorted(seq.pointers):
+        ptr = seq.pointers[name]
+        bytype.setdefault(ptr.pointer_type, []).append(name)
+        if ptr.value is None:
+            problems.append(problem('error', name, 'no value for %s pointer' % ptr.pointer_type))
+        elif ptr.pointer_type == 'PTR_FUNC':
+            if ptr.value not in seq.functions:
+                problems.append(problem('error', name, 'points to undefined function #%d' % ptr.value))
+        elif ptr.pointer_type in ['MAIN', 'PTR_SUBR']:
+            if ptr.value not in starts:
+                problems.append(problem('error', name, 'points to 0x%03x, not the start of a subroutine' %
+                                        ptr.value))
+            elif ptr.pointer_type == 'MAIN' and ends[ptr.value][1] != Instruction.OP_EndOfProgram:
+                problems.append(problem('error', name, 'points to %s, which does not terminate with END' %
+                                        ptr.target))
+        elif not 0 <= ptr.value <= pointer_max_value[ptr.pointer_type]:
+            problems.append(problem('error', name, 'repeat value %d does not fit in %s' %
+                                    (ptr.value, ptr.pointer_type)))
+
+    # registries
+    for pointer_type, ptrnames in sorted(bytype.iteritems()):
+        if pointer_type == 'MAIN':
+            capacity = 1
+        else:
+            capacity = 16
+        if len(ptrnames) > capacity:
+            problems.append(problem('error', pointer_type, '%d pointers for a registry of %d: %s' %
+                                    (len(ptrnames), capacity, ', '.join(ptrnames))))
+        for name in ptrnames:
+            ptr = seq.pointers[name]
+            if ptr.address - SequencerPointer.Base_Ptr[pointer_type] not in range(capacity):
+                problems.append(problem('error', name, 'address %s outside of the %s registry' %
+                                        (ptr.address, pointer_type)))
+
+    # pointers used by the instructions
+    for addr in sorted(seq.program.instructions):
+        instr = seq.program.instructions[addr]
+        used = []
+        if instr.opcode in [Instruction.OP_CallPointerFunction, Instruction.OP_CallPointerFuncPointerRepeat]:
+            used.append(('PTR_FUNC', instr.function_id))
+        if instr.opcode in [Instruction.OP_CallFuncPointerRepeat, Instruction.OP_CallPointerFuncPointerRepeat] \
+                and not instr.infinite_loop:
+            used.append(('REP_FUNC', instr.repeat))
+        if instr.opcode in [Instruction.OP_JumpPointerSubroutine, Instruction.OP_JumpPointerSubPointerRepeat]:
+            used.append(('PTR_SUBR', instr.address))
+        if instr.opcode in [Instruction.OP_JumpSubPointerRepeat, Instruction.OP_JumpPointerSubPointerRepeat]:
+            used.append(('REP_SUBR', instr.repeat))
+        for pointer_type, num in used:
+            if seq.pointer_value(pointer_type, num) is None:
+                problems.append(problem('error', '0x%03x' % addr, '%s uses undefined %s pointer #%d' %
+                                        (instr.name, pointer_type, num)))
+
+    return problems
+
+
+def check_functions(seq):
+    """
+    Verifies function ids, number of slices and slice durations.
+    Slice durations above 0xffff are truncated in the bytecode: this is an error for
+    functions called a finite number of times (the timing changes), and only a warning
+    for functions called in infinite loops (waiting patterns such as SlowFlush).
+    :param seq: Sequencer
+    :return: list of problems
+    """
+    problems = []
+
+    # functions whose duration matters: called with a finite number of repetitions
+    timed = set()
+    for instr in seq.program.instructions.values():
+        if instr.opcode not in Instruction.Call_codes or instr.infinite_loop:
+            continue
+        if instr.opcode in [Instruction.OP_CallFunction, Instruction.OP_CallFuncPointerRepeat]:
+            timed.add(instr.function_id)
+        else:
+            timed.add(seq.pointer_value('PTR_FUNC', instr.function_id))
+
+    for func_id in sorted(seq.functions):
+        func = seq.functions[func_id]
+        if func_id not in range(16):
+            problems.append(problem('error', func.name, 'function id %d above 15' % func_id))
+            continue
+
+        desc = seq.functions_desc.get(func.name, {})
+        # number of slices in the source (only 16 are kept by the compiler)
+        nslices = desc.get('nslices', func.nslices)
+        if nslices > 16:
+            problems.append(problem('error', func.name, '%d slices, only 16 can be programmed' % nslices))
+
+        if func_id == 0:
+            # only the first slice is programmed
+            durations = func.durations[:min(func.nslices, 1)]
+        else:
+            durations = func.durations[:func.nslices]
+        for ts, duration in enumerate(durations):
+            if duration > 0xffff:
+                problems.append(problem(['warning', 'error'][func_id in timed], func.name,
+                                        'slice %d: duration %d above 0xffff, truncated to %d in the bytecode' %
+                                        (ts, duration, duration & 0xffff)))
+            elif duration < 0 and ts not in [0, len(durations) - 1]:
+                problems.append(problem('error', func.name, 'slice %d: negative duration %d' % (ts, duration)))
+            elif duration < 0 or (duration == 0 and len(durations) > 1 and ts in [0, len(durations) - 1]):
+                # same limits as in Function.split_timeslice()
+                problems.append(problem('error', func.name, 'slice %d: %s slice too short' %
+                                        (ts, ['first', 'last'][ts > 0])))
+            elif duration == 0 and ts not in [0, len(durations) - 1]:
+                problems.append(problem('warning', func.name, 'slice %d: zero duration' % ts))
+
+    # calls
+    for addr in sorted(seq.program.instructions):
+        instr = seq.program.instructions[addr]
+        if instr.opcode in [Instruction.OP_CallFunction, Instruction.OP_CallFuncPointerRepeat]:
+            if instr.function_id not in seq.functions:
+                problems.append(problem('error', '0x%03x' % addr, '%s of undefined function #%d' %
+                                        (instr.name, instr.function_id)))
+
+    return problems
+
+
+def verify_sequencer(seq, max_depth=default_max_depth):
+    """
+    Static verification of a compiled sequencer.
+    :param seq: Sequencer
+    :param max_depth: depth of the FPGA call stack
+    :return: list of problems (dictionaries with level, where, message), errors first
+    """
+    problems = check_program(seq, max_depth) + check_pointers(seq) + check_functions(seq)
+
+    return sorted(problems, key=lambda x: x['level'] != 'error')
+
+
+def verify_report(problems):
+    """
+    Text report of the problems from verify_sequencer().
+    :param problems:
+    :return: string
+    """
+    if not problems:
+        return "No problem found"
+
+    lines = []
+    for p in problems:
+        lines.append("%-8s %-24s %s" % (p['level'], p['where'], p['message']))
+
+    return "\n".join(lines)
+
+# ========================================================================
+# Batch verification of directory trees
+
+def verify_directory(task):
+    """
+    Verifies the given sequencer files, all in the same directory, in a single process
+    (see seqcompiler.compile_directory).
+    :param task: (topdir, directory relative to topdir, list of file names, max_depth, cache)
+    :return: list of summary dictionaries, one per file
+    """
+    topdir, reldir, fnames, max_depth, cache = task
+
+    # include file names are relative to the directory of the sequencer file
+    cwd = os.getcwd()
+    os.chdir(os.path.join(topdir, reldir))
+
+    summaries = []
+    for fname in fnames:
+        summary = {'file': os.path.join(reldir, fname), 'status': 'ok', 'error': None, 'problems': []}
+        try:
+            seq = rebtxt.Sequencer.fromtxtfile(fname, verbose=False, cache=cache)
+            summary['problems'] = verify_sequencer(seq, max_depth)
+        except Exception as e:
+            summary['status'] = 'error'
+            summary['error'] = '%s: %s' % (e.__class__.__name__, e)
+        summaries.append(summary)
+
+    os.chdir(cwd)
+
+    return summaries
+
+def verify_tree(topdir, processes=None, max_depth=default_max_depth, cache=False):
+    """
+    Verifies all the sequencer files under the directory, across a pool of processes
+    (one task per directory).
+    :param topdir:
+    :param processes: size of the process pool, number of CPUs if None
+    :param max_depth: depth of the FPGA call stack
+    :param cache: uses the on-disk cache of compiled sequencers (see seqcache)
+    :return: list of summary dictionaries (file, status, error, problems), sorted by file name
+    """
+    topdir = os.path.abspath(topdir)
+
+    bydir = {}
+    for relname in seqcompiler.find_seqfiles(topdir):
+        reldir, fname = os.path.split(relname)
+        bydir.setdefault(reldir, []).append(fname)
+    tasks = [(topdir, reldir, bydir[reldir], max_depth, cache) for reldir in sorted(bydir)]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(verify_directory, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    return sorted([summary for result in results for summary in result], key=lambda x: x['file'])
+
+# ========================================================================
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage=
+    """
+    %prog [-d <depth>] <sequencer-file>
+    %prog -t [-j <processes>] [-d <depth>] <directory>
+
+    Static verification of sequencer programs for the LSST REB FPGA.
+    Exits with status 1 if errors are found.
+    """)
+    parser.add_option('-t', '--tree', default=False, action='store_true',
+                      help='Verify all sequencer files under a directory')
+    parser.add_option('-j', '--jobs', default=None, type='int',
+                      help='Number of processes for -t (default: number of CPUs)')
+    parser.add_option('-d', '--depth', default=default_max_depth, type='int',
+                      help='Depth of the FPGA call stack (default: %d)' % default_max_depth)
+    parser.add_option('-w', '--warnings', default=False, action='store_true',
+                      help='Also report warnings')
+
+    (options, args) = parser.parse_args()
+
+    if len(args) < 1:
+        parser.print_help()
+        sys.exit(1)
+
+    if options.tree:
+        summaries = verify_tree(args[0], processes=options.jobs, max_depth=options.depth)
+    else:
+        summaries = verify_directory(('', os.path.dirname(args[0]) or '.', [os.path.basename(args[0])],
+                                      options.depth, False))
+
+    nerrors = 0
+    for summary in summaries:
+        if summary['status'] != 'ok':
+            nerrors += 1
+            print('%s: compilation failed: %s' % (summary['file'], summary['error']))
+            continue
+        problems = [p for p in summary['problems'] if options.warnings or p['level'] == 'error']
+        if problems:
+            print('%s:' % summary['file'])
+            print(verify_report(problems))
+        if [p for p in problems if p['level'] == 'error']:
+            nerrors += 1
+
+    print('%d files verified, %d with errors' % (len(summaries), nerrors))
+    sys.exit(nerrors > 0)
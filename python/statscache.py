@@ -0,0 +1,230 @@
+#
+# LSST
+# Sidecar files caching the statistics of CCD files
+#
+# The statistics tables computed by segstats.py for a FITS file are stored in a sidecar
+# .npz file next to it (or in the user cache directory if the data directory is not
+# writable). The sidecar is valid as long as the size and modification time of the FITS
+# file are unchanged, and holds one entry per region of interest and list of segments,
+# so that later calls with the same ROI definitions read the sidecar instead of the data.
+# Statistics can also be taken from the AVERAGE/STDEV and AVGBIAS/STDVBIAS keywords of
+# the extension headers, when present.
+#
+# Syntax in a script:
+# import statscache
+# tables, histograms = statscache.ccd_table("s00/tm-scan.fits", {'overscan': (slice(100, 1900), slice(540, 576))})
+# means, stds = statscache.roi_stats("s00/tm-scan.fits", slice(100, 1900), slice(540, 576), headers=statscache.overscan_keywords)
+from __future__ import print_function
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+import fitsdata
+import segstats
+
+# global for the location of sidecars of files in read-only directories
+cachedir = os.path.join(os.path.expanduser('~'), '.cache', 'segstats')
+
+# changes when the content of the tables changes, to invalidate older sidecars
+cache_version = 1
+
+# header keywords for the mean and standard deviation of the image and overscan regions
+image_keywords = ('AVERAGE', 'STDEV')
+overscan_keywords = ('AVGBIAS', 'STDVBIAS')
+
+
+def sidecar_file(fitsfile):
+    """
+    Name of the sidecar of a FITS file: next to it, or in cachedir if its directory is not writable.
+    :param fitsfile:
+    :return: string
+    """
+    datadir = os.path.dirname(os.path.abspath(fitsfile))
+    if os.access(datadir, os.W_OK):
+        return os.path.abspath(fitsfile) + '.stats.npz'
+
+    return os.path.join(cachedir, hashlib.sha1(os.path.abspath(fitsfile).encode('utf-8')).hexdigest() + '.npz')
+
+
+def source_id(fitsfile):
+    """
+    Identifies the version of the FITS file.
+    :param fitsfile:
+    :return: np.array (version, size, modification time)
+    """
+    st = os.stat(fitsfile)
+
+    return np.array([cache_version, st.st_size, st.st_mtime], dtype=np.float64)
+
+
+def cacheable(rows, cols):
+    """
+    Whether the statistics of a region of interest can be computed by segstats and kept
+    in the sidecar: rows and columns must be slices with positive steps.
+    :param rows:
+    :param cols:
+    :return: bool
+    """
+    return all(isinstance(s, slice) and (s.step is None or s.step > 0) for s in (rows, cols))
+
+
+def roi_key(rows, cols, segments):
+    """
+    Key of the entry for a region of interest and segments.
+    :param rows: slice (see cacheable())
+    :param cols: slice
+    :param segments: list of segment numbers
+    :return: string
+    """
+    desc = "%r %r %r" % ((rows.start, rows.stop, rows.step), (cols.start, cols.stop, cols.step), list(segments))
+
+    return hashlib.sha1(desc.encode('utf-8')).hexdigest()[:16]
+
+
+def load(fitsfile):
+    """
+    Reads the sidecar of the FITS file.
+    :param fitsfile:
+    :return: dict of arrays, empty if there is no valid sidecar
+    """
+    try:
+        npz = np.load(sidecar_file(fitsfile), allow_pickle=False)
+    except Exception:
+        # missing or corrupted: will be overwritten
+        return {}
+
+    try:
+        entries = dict((name, npz[name]) for name in npz.files)
+    except Exception:
+        entries = {}
+    npz.close()
+
+    if 'source' not in entries or not np.array_equal(entries['source'], source_id(fitsfile)):
+        return {}
+
+    return entries
+
+
+def store(fitsfile, entries):
+    """
+    Writes the sidecar of the FITS file. Failures to write are ignored, the statistics
+    will be recomputed next time.
+    :param fitsfile:
+    :param entries: dict of arrays
+    :return:
+    """
+    fname = sidecar_file(fitsfile)
+    entries = dict(entries)
+    entries['source'] = source_id(fitsfile)
+
+    tmpname = None
+    try:
+        if not os.path.isdir(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname))
+        # writes to a temporary file first so that readers never see a partial sidecar
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(fname), suffix='.tmp')
+        sfile = os.fdopen(fd, 'wb')
+        np.savez(sfile, **entries)
+        sfile.close()
+        os.rename(tmpname, fname)
+    except (IOError, OSError):
+        if tmpname is not None and os.path.exists(tmpname):
+            os.remove(tmpname)
+
+
+def ccd_table(fitsfile, rois, segments=range(16), ccdname='', cache=True):
+    """
+    Statistics tables of the segments of a CCD file (see segstats.ccd_table()), from the
+    sidecar for the ROIs already there. The others are computed in a single pass and
+    added to the sidecar.
+    :param fitsfile:
+    :param rois: dict name: (rows, cols), slices with positive steps (see cacheable())
+    :param segments: segment numbers (0-15)
+    :param ccdname: for the 'ccd' column of the tables
+    :param cache: if False, the sidecar is neither read nor written
+    :return: dict name: structured np.array, dict name: list of (counts, edges) histograms
+    """
+    for name, (rows, cols) in rois.items():
+        if not cacheable(rows, cols):
+            raise ValueError('Region of interest %s: rows and columns should be slices with positive steps' % name)
+    segments = list(segments)
+    keys = dict((name, roi_key(rows, cols, segments)) for name, (rows, cols) in rois.items())
+    entries = load(fitsfile) if cache else {}
+
+    missing = dict((name, rois[name]) for name in rois if 'table_' + keys[name] not in entries)
+    if missing:
+        tables, histograms = segstats.ccd_table(fitsfile, missing, segments, ccdname)
+        for name in missing:
+            entries['table_' + keys[name]] = tables[name]
+            entries['counts_' + keys[name]] = np.concatenate([h[0] for h in histograms[name]])
+            entries['edges_' + keys[name]] = np.concatenate([h[1] for h in histograms[name]])
+            entries['nbins_' + keys[name]] = np.array([len(h[0]) for h in histograms[name]])
+            entries['nedges_' + keys[name]] = np.array([len(h[1]) for h in histograms[name]])
+        if cache:
+            store(fitsfile, entries)
+
+    tables = {}
+    histograms = {}
+    for name in rois:
+        key = keys[name]
+        tables[name] = entries['table_' + key].copy()
+        tables[name]['ccd'] = ccdname
+        counts = np.split(entries['counts_' + key], np.cumsum(entries['nbins_' + key])[:-1])
+        edges = np.split(entries['edges_' + key], np.cumsum(entries['nedges_' + key])[:-1])
+        histograms[name] = list(zip(counts, edges))
+
+    return tables, histograms
+
+
+def header_stats(fitsfile, keywords, segments=range(16)):
+    """
+    Mean and standard deviation of the segments from their header.
+    :param fitsfile:
+    :param keywords: keywords of the mean and standard deviation, image_keywords or overscan_keywords
+    :param segments: segment numbers (0-15)
+    :return: np.arrays of means and standard deviations, or None if a keyword is missing
+    """
+    meankey, stdkey = keywords
+    hdulist = fitsdata.open_fits(fitsfile)
+    try:
+        headers = [hdulist[seg + 1].header for seg in segments]
+    finally:
+        hdulist.close()
+
+    if not all(meankey in h and stdkey in h for h in headers):
+        return None
+
+    return np.array([h[meankey] for h in headers]), np.array([h[stdkey] for h in headers])
+
+
+def roi_stats(fitsfile, rows, cols, segments=range(16), headers=None, cache=True):
+    """
+    Mean and standard deviation of a region of interest of the segments.
+    Regions of interest that are not slices (see cacheable()) are read and computed
+    directly, without the sidecar.
+    :param fitsfile:
+    :param rows:
+    :param cols:
+    :param segments: segment numbers (0-15)
+    :param headers: keywords (image_keywords or overscan_keywords) of header values to use
+    instead, when all segments have them
+    :param cache: uses the sidecar
+    :return: np.arrays of means and standard deviations
+    """
+    if headers is not None:
+        stats = header_stats(fitsfile, headers, segments)
+        if stats is not None:
+            return stats
+
+    if not cacheable(rows, cols):
+        hdulist = fitsdata.open_fits(fitsfile)
+        try:
+            data = [fitsdata.segment_roi(hdulist, seg + 1, rows, cols) for seg in segments]
+        finally:
+            hdulist.close()
+        return np.array([d.mean() for d in data]), np.array([d.std() for d in data])
+
+    table = ccd_table(fitsfile, {'roi': (rows, cols)}, segments, cache=cache)[0]['roi']
+
+    return table['mean'], table['std']
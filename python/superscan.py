@@ -12,7 +12,6 @@
 #
 
 import os
-import copy
 import numpy as np
 import scope
 from matplotlib import pyplot as plt
@@ -27,47 +26,91 @@ def set_trigger_function(self, trigtime, trigfunc):
     :return:
     """
     # need to copy from the base function (to be able to re-use it)
-    newtrigfunc = copy.deepcopy(trigfunc)
+    newtrigfunc = trigfunc.copy()
     # will wrap after total duration of function
     newtrigfunc.set_output_at_time(1, 'TRG', trigtime, wrap=True)
     self.reb.set_function(newtrigfunc.name, newtrigfunc)
     print newtrigfunc
 
 
+def superscan_functions(seq, readfunc='ReadPixel', scanpoints=None):
+    """
+    Computes at once all the versions of the readout function for the super-scan,
+    with the trigger moved to each scan point (and removed elsewhere).
+    The model sequencer is left unchanged.
+    :param seq: sequencer.Sequencer
+    :param readfunc: name of the readout function
+    :param scanpoints: trigger times (clock cycles), by default every 2 cycles up to 200
+    :return: dict scan point: Function (points where the trigger cannot be set are left out)
+    """
+    if scanpoints is None:
+        scanpoints = range(0, 200, 2)  # to be changed if pixel read time is higher
+
+    # base function with no trigger signal
+    trigfunc = seq.functions_desc[readfunc]['function'].copy()
+    trigfunc.set_output_channel(0, 'TRG')  # clears all timeslice
+
+    # will wrap after total duration of function
+    newtrigfuncs = trigfunc.set_outputs_at_times(1, 'TRG', scanpoints, wrap=True)
+
+    return dict((offset, func) for offset, func in zip(scanpoints, newtrigfuncs) if func is not None)
+
+
+def superscan_bytecodes(seq, readfunc='ReadPixel', scanpoints=None, functions=None):
+    """
+    Compiled outputs of the super-scan: only the memory of the readout function changes
+    from one scan point to the other, so each scan point gets the function bytecode
+    that differs from the compiled model sequencer.
+    :param seq: sequencer.Sequencer
+    :param readfunc: name of the readout function
+    :param scanpoints: trigger times (clock cycles)
+    :param functions: output of superscan_functions(), if already computed
+    :return: dict scan point: {address: value}
+    """
+    func_id = seq.functions_desc[readfunc]['idfunc']
+    modelbc = seq.functions[func_id].bytecode(func_id)
+    if functions is None:
+        functions = superscan_functions(seq, readfunc, scanpoints)
+
+    scanbc = {}
+    for offset, func in functions.iteritems():
+        funcbc = func.bytecode(func_id)
+        scanbc[offset] = dict((addr, funcbc[addr]) for addr in funcbc if funcbc[addr] != modelbc[addr])
+
+    return scanbc
+
+
 def generate_seqfiles(self, modelfile, readfunc='ReadPixel', scanpoints=None):
     """
     Generates the sequencer timing files for the superscan based on the model file.
+    The model file is parsed once, all the scan points are computed in one pass, then
+    the readout function of each scan point is loaded in turn into the REB (self.reb).
     :param self:
-    :param exptype:
-    :param exptime:
-    :param tm:
-    :param validamps:
-    :return:
+    :param modelfile:
+    :param readfunc:
+    :param scanpoints:
+    :return: dict file name: function bytecode differing from the model
     """
-
-    if scanpoints is None:
-        scaniter = xrange(0, 200, 2)  # to be changed if pixel read time is higher
-        niter = 100
-    else:
-        scaniter = scanpoints
-        niter = len(scanpoints)
-
     # gets sequencer object
-    seq = rebtxt.Sequencer.fromtxtfile(modelfile, verbose=False)
-
-    # creates base function with no trigger signal
-    trigfunc = seq.functions_desc[readfunc]['function']  # function object
-    trigfunc.set_output_channel(0, 'TRG')  # clears all timeslice
+    seq = rebtxt.Sequencer.fromtxtfile(modelfile, verbose=False, cache=True)
 
+    functions = superscan_functions(seq, readfunc, scanpoints)
+    bytecodes = superscan_bytecodes(seq, readfunc, functions=functions)
+    if scanpoints is None:
+        scanpoints = sorted(functions)
 
-    for iterscan, offset in enumerate(scaniter):
-        # recreates the ReadPixel function with the right trigger
-        try:
-            self.set_trigger_function(offset, trigfunc)
-        except:
+    scanbc = {}
+    for offset in scanpoints:
+        if offset not in functions:
+            # trigger cannot be set at this time
             continue
+        # recreates the readout function with the right trigger
+        self.reb.set_function(functions[offset].name, functions[offset])
 
         fname = "scantime_%d_%s" % (offset, os.path.split(modelfile)[1])
+        scanbc[fname] = bytecodes[offset]
+
+    return scanbc
 
 
 def getdata_superscan(datadir, listchan, listlines=None, listcols=None):
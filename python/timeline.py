@@ -0,0 +1,281 @@
+#
+# LSST
+# Run-length encoded timeline of the sequencer outputs
+#
+# The state of the 32 sequencer outputs over time is held as array-backed columns:
+# start and duration of each run (in clock cycles) and the 32-bit output word during the run.
+# Timelines are sliced, concatenated and repeated as runs, without going down to individual
+# clock cycles; dense per-channel arrays are only built for a requested time window.
+# A whole main (through JSR/CALL, repetitions and pointers) is rendered as a Timeline by render().
+#
+# Syntax in a script:
+# import rebtxt, timeline
+# seq = rebtxt.Sequencer.fromtxtfile("seq-newflush.txt", verbose=False)
+# tl = timeline.render(seq, "Acquisition")
+# states = tl.states([seq.channels['TRG']], 0, 10000)
+from __future__ import print_function
+import numpy as np
+
+
+class Timeline(object):
+    """
+    Run-length encoded state of the sequencer outputs.
+    """
+
+    def __init__(self, durations=None, words=None, merge=True):
+        """
+        :param durations: run durations in clock cycles
+        :param words: 32-bit output word of each run
+        :param merge: if True, merges consecutive runs with the same word and drops empty runs
+        """
+        if durations is None:
+            durations = []
+        if words is None:
+            words = []
+        self.durations = np.asarray(durations, dtype=np.int64)
+        self.words = np.asarray(words, dtype=np.uint32)
+        if len(self.durations) != len(self.words):
+            raise ValueError('Mismatched timeline columns: %d durations, %d words' %
+                             (len(self.durations), len(self.words)))
+
+        if merge:
+            self.compact()
+
+        self.starts = np.cumsum(self.durations) - self.durations
+
+    def __len__(self):
+        return len(self.durations)
+
+    def __repr__(self):
+        return "Timeline: %d runs, %d clock cycles" % (len(self), self.total_time())
+
+    def __add__(self, other):
+        return Timeline.concatenate([self, other])
+
+    def compact(self):
+        """
+        Merges consecutive runs with the same output word, and drops empty runs.
+        :return:
+        """
+        keep = self.durations > 0
+        durations = self.durations[keep]
+        words = self.words[keep]
+
+        if len(words) > 1:
+            # index of the first run of each group of identical words
+            first = np.concatenate(([True], words[1:] != words[:-1]))
+            groupstarts = np.nonzero(first)[0]
+            durations = np.add.reduceat(durations, groupstarts)
+            words = words[groupstarts]
+
+        self.durations = durations
+        self.words = words
+
+    def total_time(self):
+        """
+        Total duration (clock cycles).
+        :return: int
+        """
+        return int(self.durations.sum())
+
+    @classmethod
+    def fromfunction(cls, func):
+        """
+        Timeline of a single execution of a function, with the extra cycles the FPGA adds
+        at the beginning (1) and at the end (2) of the function.
+        :param func: sequencer.Function
+        :return: Timeline
+        """
+        durations = func.durations[:func.nslices].astype(np.int64)
+        words = func.words[:func.nslices].copy()
+        if func.nslices:
+            durations[0] += 1
+            durations[-1] += 2
+
+        return cls(durations, words)
+
+    @classmethod
+    def concatenate(cls, timelines):
+        """
+        Timeline made of the given timelines one after the other.
+        :param timelines: list of Timeline
+        :return: Timeline
+        """
+        if not timelines:
+            return cls()
+
+        return cls(np.concatenate([tl.durations for tl in timelines]),
+                   np.concatenate([tl.words for tl in timelines]))
+
+    def repeat(self, n):
+        """
+        Timeline for n consecutive repetitions of this one.
+        :param n:
+        :return: Timeline
+        """
+        return Timeline(np.tile(self.durations, n), np.tile(self.words, n))
+
+    def slice(self, tstart=0, tstop=None):
+        """
+        Part of the timeline in the time window [tstart, tstop[, with times counted from tstart.
+        :param tstart: in clock cycles
+        :param tstop: in clock cycles, end of the timeline if None
+        :return: Timeline
+        """
+        ends = self.starts + self.durations
+        if tstop is None:
+            tstop = self.total_time()
+
+        # runs overlapping the window, clipped to it
+        first = np.searchsorted(ends, tstart, side='right')
+        last = np.searchsorted(ends, tstop, side='left') + 1
+        clipped = (np.minimum(ends[first:last], tstop) -
+                   np.maximum(self.starts[first:last], tstart))
+
+        return Timeline(clipped, self.words[first:last])
+
+    def channel(self, c):
+        """
+        Timeline of a single channel: words are 0 or 1.
+        :param c: channel number
+        :return: Timeline
+        """
+        return Timeline(self.durations, (self.words >> c) & 1)
+
+    def transitions(self, c=None):
+        """
+        Times at which the outputs (or the given channel only) change.
+        :param c: channel number, all outputs if None
+        :return: np.array
+        """
+        if c is not None:
+            return self.channel(c).transitions()
+
+        # runs are merged, so each run after the first starts with a change
+        return self.starts[1:]
+
+    def edges(self, c, rising=True):
+        """
+        Times of the rising (or falling) edges of the given channel.
+        :param c: channel number
+        :param rising:
+        :return: np.array
+        """
+        tl = self.channel(c)
+        if rising:
+            return tl.starts[1:][tl.words[1:] == 1]
+
+        return tl.starts[1:][tl.words[1:] == 0]
+
+    def is_on_anytime(self, c):
+        """
+        Tests if the given channel is on at any time.
+        :param c: channel number
+        :return: bool
+        """
+        return bool(((self.words >> c) & 1).any())
+
+    def states(self, channels, tstart=0, tstop=None, packed=False):
+        """
+        Expands to one state per clock cycle for the given channels, in the time window [tstart, tstop[.
+        :param channels: list of channel numbers
+        :param tstart: in clock cycles
+        :param tstop: in clock cycles, end of the timeline if None
+        :param packed: if True, states are bit-packed along time (np.packbits)
+        :return: np.array of uint8, one line per channel
+        """
+        if tstop is None:
+            tstop = self.total_time()
+
+        tl = self.slice(tstart, tstop)
+        cyclewords = np.repeat(tl.words, tl.durations)
+        # beyond the end of the timeline, outputs are taken as 0
+        if len(cyclewords) < tstop - tstart:
+            cyclewords = np.concatenate((cyclewords,
+                                         np.zeros(tstop - tstart - len(cyclewords), dtype=np.uint32)))
+
+        states = np.empty((len(channels), tstop - tstart), dtype=np.uint8)
+        for i, c in enumerate(channels):
+            states[i] = (cyclewords >> c) & 1
+
+        if packed:
+            return np.packbits(states, axis=1)
+
+        return states
+
+
+def render(seq, subr, infinite=1):
+    """
+    Renders a whole main or subroutine as a Timeline.
+    :param seq: sequencer.Sequencer
+    :param subr: name of the main or subroutine
+    :param infinite: number of repetitions used for functions called with repeat(infinity)
+    (rendering then goes on with the next instruction, which the FPGA never reaches)
+    :return: Timeline
+    """
+    if subr not in seq.program.subroutines:
+        raise ValueError('Unknown subroutine name: %s' % subr)
+
+    return render_address(seq, seq.program.subroutines[subr], infinite, {}, {})
+
+
+def render_address(seq, start_address, infinite=1, funcmemo=None, subrmemo=None):
+    """
+    Auxiliary for render(): renders the subroutine starting at the given address.
+    :param seq: sequencer.Sequencer
+    :param start_address:
+    :param infinite: number of repetitions used for functions called with repeat(infinity)
+    :param funcmemo: timelines already computed, by function number
+    :param subrmemo: timelines already computed, by subroutine address
+    :return: Timeline
+    """
+    if funcmemo is None:
+        funcmemo = {}
+    if subrmemo is None:
+        subrmemo = {}
+    if start_address in subrmemo:
+        return subrmemo[start_address]
+
+    current_address = start_address
+    parts = []
+
+    while current_address in seq.program.instructions:
+        instr = seq.program.instructions[current_address]
+        if instr.opcode in instr.Call_codes:
+            # parse repetitions, look up function
+            if instr.infinite_loop:
+                repetitions = infinite
+            elif instr.opcode in [instr.OP_CallFunction, instr.OP_CallPointerFunction]:
+                repetitions = instr.repeat
+            else:
+                repetitions = seq.pointer_value('REP_FUNC', instr.repeat)
+            if instr.opcode in [instr.OP_CallFunction, instr.OP_CallFuncPointerRepeat]:
+                funcnum = instr.function_id
+            else:
+                funcnum = seq.pointer_value('PTR_FUNC', instr.function_id)
+            if funcnum not in funcmemo:
+                funcmemo[funcnum] = Timeline.fromfunction(seq.functions[funcnum])
+            tl = funcmemo[funcnum]
+
+        elif instr.opcode in instr.Jsr_codes:
+            # parse repetitions, look up new address, recurse
+            if instr.opcode in [instr.OP_JumpToSubroutine, instr.OP_JumpPointerSubroutine]:
+                repetitions = instr.repeat
+            else:
+                repetitions = seq.pointer_value('REP_SUBR', instr.repeat)
+            if instr.opcode in [instr.OP_JumpToSubroutine, instr.OP_JumpSubPointerRepeat]:
+                target_address = instr.address
+            else:
+                target_address = seq.pointer_value('PTR_SUBR', instr.address)
+            tl = render_address(seq, target_address, infinite, funcmemo, subrmemo)
+
+        else:
+            break
+
+        if repetitions > 0:
+            parts.append(tl.repeat(repetitions))
+
+        current_address += 1
+
+    subrmemo[start_address] = Timeline.concatenate(parts)
+    return subrmemo[start_address]
@@ -13,6 +13,7 @@
 # Syntax in a script:
 # import timing
 # timing.breakout("seq-newflush.txt", "Acquisition")
+# timing.edge_count("seq-newflush.txt", "Acquisition", "TRG", check=True)
 
 import sys
 
@@ -26,7 +27,7 @@ def breakout(seqfile, exptype):
     :param exptype:
     :return:
     """
-    seq = rebtxt.Sequencer.fromtxtfile(seqfile, verbose=False)
+    seq = rebtxt.Sequencer.fromtxtfile(seqfile, verbose=False, cache=True)
 
     if exptype in seq.program.subroutines:
         reprseq = seq.sequence(exptype, verbose=False)
@@ -41,11 +42,31 @@ def breakout(seqfile, exptype):
         
         
 def function_time(seqfile, funcname):
-    seq = rebtxt.Sequencer.fromtxtfile(seqfile, verbose=False)
+    seq = rebtxt.Sequencer.fromtxtfile(seqfile, verbose=False, cache=True)
     func = seq.functions_desc[funcname]['function']
     return func.total_time()
 
 
+def edge_count(seqfile, subr, channel='TRG', check=False):
+    """
+    Number of rising edges of the channel during the main or subroutine
+    (for TRG: number of pixels read).
+    :param seqfile:
+    :param subr:
+    :param channel:
+    :param check: also generates the edge times and checks that there are as many
+    :return: int
+    """
+    seq = rebtxt.Sequencer.fromtxtfile(seqfile, verbose=False, cache=True)
+    count = seq.count_edges(subr, channel)
+    if check:
+        ntimes = sum(len(times) for times in seq.edge_times(subr, channel))
+        if ntimes != count:
+            raise ValueError('%s in %s: %d %s edges counted, %d edge times' % (subr, seqfile, count, channel, ntimes))
+
+    return count
+
+
 if __name__ == '__main__':
     if len(sys.argv) < 3:
         print("timing.py requires sequencer file and main/subroutine/function name")